@@ -0,0 +1,217 @@
+"""Compares scan and probe strategies on a simulated failing disk.
+
+    python benchmarks/compare_strategies.py                          # All strategies, 1 TB, 10 damaged areas
+    python benchmarks/compare_strategies.py scan hotspots --size-gb 4000 --areas 50 --json out.json
+
+Each strategy runs against a fresh copy of the same simulated disk (see
+simulated_disk.py), and is scored on the simulated time it took and how
+many of the clusters with unreadable, weak or flaky sectors in them it
+found. The same --seed always gives the same disk and the same results.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitmap import FullBitmap
+from hotspot import HotspotScan
+from probe import ClusterProbe
+from rewrite import rewrite_clusters
+from scan import SurfaceScan
+from simulated_disk import DiskModel, SimulatedDisk, install
+from volume import Volume
+
+
+def make_disk(args):
+    """A simulated volume of --size-gb, with its bitmap --used-percent
+    full in runs of many lengths, and --areas damaged areas."""
+    cluster_size = 4096
+    total_clusters = args.size_gb * (1000 ** 3) // cluster_size
+    sectors_per_cluster = cluster_size // 512
+    model = DiskModel.generate(total_clusters * sectors_per_cluster, args.areas, args.radius, args.density,
+                               args.seed, error_ms=args.error_ms)
+    disk = SimulatedDisk(total_clusters, model, cluster_size)
+    rng = random.Random(args.seed)
+    pattern = bytearray()
+    while len(pattern) < 1024 * 1024:
+        used = rng.random() * 100 < args.used_percent
+        pattern += (b'\xff' if used else b'\0') * int(rng.paretovariate(1.2))
+    disk.set_bitmap(pattern[:1024 * 1024])
+    return disk
+
+
+def damaged_clusters(disk):
+    """The clusters holding unreadable sectors, and those holding weak or
+    flaky ones, as (set, set)."""
+    spc = disk.cluster_size // disk.bytes_per_sector
+    model = disk.model
+    return (set(sector // spc for sector in model.bad),
+            set(sector // spc for sector in list(model.weak) + list(model.flaky)) - set(s // spc for s in model.bad))
+
+
+def seed_clusters(disk):
+    """One known bad cluster per damaged area: the bad sector nearest its
+    middle, as a SMART error log or an event log entry would give."""
+    spc = disk.cluster_size // disk.bytes_per_sector
+    bad = disk.model.bad
+    seeds = set()
+    for centre in disk.model.centres:
+        nearest = min(bad, key=lambda sector: abs(sector - centre), default=None)
+        if nearest is not None:
+            seeds.add(nearest // spc)
+    return sorted(seeds)
+
+
+def strategy_probe(volume, disk, args):
+    """Only the known bad clusters, one test read each, as a batch query does."""
+    cluster_probe = ClusterProbe(volume, args.slow_ms)
+    bad, slow = set(), set()
+    for cluster in seed_clusters(disk):
+        err, out_size, ms, slow_sectors = cluster_probe.probe(cluster)
+        if err:
+            bad.add(cluster)
+        elif slow_sectors:
+            slow.add(cluster)
+    return bad, slow
+
+
+def strategy_scan(volume, disk, args):
+    """A surface scan of the whole volume."""
+    surface_scan = SurfaceScan(volume, args.chunk_size * 1024 * 1024, args.queue_depth, args.slow_ms)
+    try:
+        surface_scan.scan()
+    finally:
+        surface_scan.close()
+    return (set(cluster for cluster, err, sectors in surface_scan.findings),
+            set(cluster for cluster, sectors in surface_scan.slow))
+
+
+def strategy_scan_free(volume, disk, args):
+    """A surface scan of the free clusters only."""
+    surface_scan = SurfaceScan(volume, args.chunk_size * 1024 * 1024, args.queue_depth, args.slow_ms)
+    try:
+        surface_scan.scan_runs(*FullBitmap(volume.load_bitmap()).free_runs())
+    finally:
+        surface_scan.close()
+    return (set(cluster for cluster, err, sectors in surface_scan.findings),
+            set(cluster for cluster, sectors in surface_scan.slow))
+
+
+def strategy_hotspots(volume, disk, args):
+    """Reading outward from each known bad cluster until --margin clean
+    clusters surround the damage."""
+    hotspots = HotspotScan(volume, args.margin, args.chunk_size * 1024 * 1024, args.slow_ms)
+    try:
+        hotspots.explore([(cluster, cluster) for cluster in seed_clusters(disk)])
+    finally:
+        hotspots.close()
+    return (set(cluster for cluster, err, sectors in hotspots.findings),
+            set(cluster for cluster, sectors in hotspots.slow))
+
+
+STRATEGIES = {
+    'probe': strategy_probe,
+    'scan': strategy_scan,
+    'scan-free': strategy_scan_free,
+    'hotspots': strategy_hotspots,
+}
+
+
+def run_strategy(name, args):
+    disk = make_disk(args)
+    bad_truth, weak_truth = damaged_clusters(disk)
+    started = time.perf_counter()
+    with install(disk) as clock, contextlib.redirect_stdout(io.StringIO()):
+        volume = Volume('X', unbuffered=True).open()
+        opened = clock.now
+        bad, slow = STRATEGIES[name](volume, disk, args)
+        found_time = clock.now
+        reads, seeks = disk.model.reads, disk.model.seeks
+        rewritten = None
+        if args.rewrite:
+            free = [cluster for cluster in sorted(bad | slow) if not disk.bitmap[cluster // 8] & (1 << (cluster % 8))]
+            if free:
+                results = rewrite_clusters(volume, free)
+                rewritten = sum(1 for cluster, move_err, read_err in results if not move_err and not read_err)
+        volume.close()
+        finished = clock.now
+    return {
+        'strategy': name,
+        'simulated_seconds': found_time - opened,
+        'rewrite_seconds': finished - found_time if args.rewrite else None,
+        'real_seconds': time.perf_counter() - started,
+        'reads': reads,
+        'seeks': seeks,
+        'bad_clusters': len(bad_truth),
+        'bad_found': len(bad & bad_truth),
+        'weak_clusters': len(weak_truth),
+        'weak_found': len((bad | slow) & weak_truth),
+        'rewritten': rewritten,
+        'reallocated_sectors': disk.model.reallocated,
+    }
+
+
+def format_seconds(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return '%d:%02d:%02d' % (hours, rest // 60, rest % 60) if hours or rest >= 60 else '%.1fs' % seconds
+
+
+def print_table(results):
+    print('%-10s %12s %10s %10s %14s %14s' % ('Strategy', 'Sim. time', 'Reads', 'Seeks', 'Bad found', 'Weak found'))
+    for r in results:
+        print('%-10s %12s %10s %10s %8s/%-5s %8s/%-5s' % (
+            r['strategy'], format_seconds(r['simulated_seconds']), r['reads'], r['seeks'],
+            r['bad_found'], r['bad_clusters'], r['weak_found'], r['weak_clusters']))
+        if r['rewritten'] is not None:
+            print('           rewrote %s cluster(s) in %s, %s sector(s) reallocated'
+                  % (r['rewritten'], format_seconds(r['rewrite_seconds']), r['reallocated_sectors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare scan strategies on a simulated failing disk.')
+    parser.add_argument('names', nargs='*', metavar='STRATEGY',
+                        help='strategies to run (default: all of %s).' % ', '.join(STRATEGIES))
+    parser.add_argument('--size-gb', type=int, default=1000, help='volume size (default: %(default)s GB).')
+    parser.add_argument('--used-percent', type=float, default=50, help='how full the volume is (default: %(default)s).')
+    parser.add_argument('--areas', type=int, default=10, help='number of damaged areas (default: %(default)s).')
+    parser.add_argument('--radius', type=int, default=2000,
+                        help='typical radius of a damaged area in sectors (default: %(default)s).')
+    parser.add_argument('--density', type=float, default=0.01,
+                        help='fraction of the sectors near the middle of an area that are bad (default: %(default)s).')
+    parser.add_argument('--error-ms', type=float, default=1500.0,
+                        help='time the drive spends retrying before a read fails (default: %(default)s ms).')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the disk (default: %(default)s).')
+    parser.add_argument('--chunk-size', metavar='MB', type=int, default=4)
+    parser.add_argument('--queue-depth', type=int, default=1)
+    parser.add_argument('--slow-ms', type=float, default=200)
+    parser.add_argument('--margin', type=int, default=256, help='clean clusters for hotspots (default: %(default)s).')
+    parser.add_argument('--rewrite', action='store_true',
+                        help='also rewrite the free damaged clusters each strategy found, and time that.')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to FILE as JSON.')
+    args = parser.parse_args()
+
+    names = args.names or list(STRATEGIES)
+    unknown = set(names) - set(STRATEGIES)
+    if unknown:
+        parser.error('unknown strategy(s): %s' % ', '.join(sorted(unknown)))
+
+    results = []
+    for name in names:
+        print('Running %s...' % name)
+        results.append(run_strategy(name, args))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=1)
+            f.write('\n')
+        print('Wrote results to %s' % args.json)
+
+
+if __name__ == '__main__':
+    main()
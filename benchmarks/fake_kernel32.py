@@ -0,0 +1,376 @@
+"""An in-process stand-in for the kernel32 calls the tool makes, so that the
+Volume code paths can be run (and timed) off Windows.
+
+It serves one volume, described by a FakeDisk: its geometry, a bitmap, the
+streams using each cluster, and which sectors fail to read. Reads cost no
+real I/O, so what benchmarks see is the tool's own overhead.
+
+    disk = FakeDisk(total_clusters=1 << 20)
+    kernel32 = install(disk)
+    volume = Volume('X').open()
+
+A FakeMachine serves several volumes, each through its own FakeKernel32, for
+code that enumerates every volume on the system.
+"""
+import bisect
+import ctypes
+import struct
+
+import volume as win_volume
+from win_types import *
+
+ERROR_FILE_NOT_FOUND = 2
+ERROR_NO_MORE_FILES = 18
+ERROR_HANDLE_EOF = 38
+ERROR_INVALID_PARAMETER = 87
+ERROR_MORE_DATA = 234
+ERROR_JOURNAL_NOT_ACTIVE = 1179
+ERROR_CRC = 23
+
+# The volume GUID path FindFirstVolumeW gives for a FakeKernel32's one volume
+FAKE_VOLUME_NAME = '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\'
+
+
+class FakeDisk:
+    """The volume a FakeKernel32 serves."""
+
+    def __init__(self, total_clusters=1 << 20, cluster_size=4096, bytes_per_sector=512,
+                 start=1024 * 1024, disk_number=0, extents=None):
+        self.total_clusters = total_clusters
+        self.cluster_size = cluster_size
+        self.bytes_per_sector = bytes_per_sector
+        self.start = start
+        self.disk_number = disk_number
+        # (disk number, starting offset, length) of each piece of a spanned
+        # volume, concatenated in order; by default one extent at `start`
+        self.extents = extents or [(disk_number, start, total_clusters * cluster_size)]
+        self.bitmap = bytearray((total_clusters + 7) // 8)
+        self.streams = {}       # cluster -> list of (flags, file name) using it
+        self.bad_sectors = []   # Sorted volume-relative sector numbers that fail with a CRC error
+        self.serial = 0x1234abcd
+
+    def set_bitmap(self, data):
+        """Replaces the bitmap, repeating `data` to fill it."""
+        size = len(self.bitmap)
+        self.bitmap[:] = (bytes(data) * (size // len(data) + 1))[:size]
+
+    def add_stream(self, first, count, name, flags=0x01000000):
+        """Marks clusters first..first+count-1 as used by a stream."""
+        for cluster in range(first, first + count):
+            self.bitmap[cluster // 8] |= 1 << (cluster % 8)
+            self.streams.setdefault(cluster, []).append((flags, name))
+
+    def add_bad_sector(self, sector):
+        bisect.insort(self.bad_sectors, sector)
+
+
+def _target(arg):
+    """The ctypes object behind a byref() argument, or the argument itself."""
+    return getattr(arg, '_obj', arg)
+
+
+class _VolumeEnumeration:
+    """FindFirstVolumeW and friends, over `self.volumes`: a list of (volume
+    GUID path, mount points, FakeDisk)."""
+
+    def FindFirstVolumeW(self, buf, size):
+        if not self.volumes:
+            self._fail(ERROR_NO_MORE_FILES)
+            return INVALID_HANDLE
+        find = self.next_handle
+        self.next_handle += 1
+        self.finds[find] = 0
+        buf.value = self.volumes[0][0]
+        return find
+
+    def FindNextVolumeW(self, find, buf, size):
+        self.finds[find] += 1
+        if self.finds[find] >= len(self.volumes):
+            return self._fail(ERROR_NO_MORE_FILES)
+        buf.value = self.volumes[self.finds[find]][0]
+        return 1
+
+    def FindVolumeClose(self, find):
+        del self.finds[find]
+        return 1
+
+    def GetVolumePathNamesForVolumeNameW(self, name, buf, size, out_len):
+        for volume_name, mount_points, disk in self.volumes:
+            if volume_name == name:
+                names = ''.join(path + '\0' for path in mount_points) + '\0'
+                _target(out_len).value = len(names)
+                if len(names) > size:
+                    return self._fail(ERROR_MORE_DATA)
+                buf[:len(names)] = names
+                return 1
+        return self._fail(ERROR_FILE_NOT_FOUND)
+
+
+class FakeKernel32(_VolumeEnumeration):
+    """The kernel32 functions volume.py, bitmap.py and scan.py call, backed
+    by a FakeDisk. Calls it doesn't know about raise AttributeError."""
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.volumes = [(FAKE_VOLUME_NAME, ['X:\\'], disk)]
+        self.last_error = 0
+        self.positions = {}     # Handle -> file pointer
+        self.finds = {}         # FindFirstVolumeW handle -> index in volumes
+        self.next_handle = 100
+
+    def GetLastError(self):
+        return self.last_error
+
+    def _fail(self, err):
+        self.last_error = err
+        return 0
+
+    def CreateFileW(self, name, access, share, security, disposition, flags, template):
+        handle = self.next_handle
+        self.next_handle += 1
+        self.positions[handle] = 0
+        return handle
+
+    def CloseHandle(self, handle):
+        self.positions.pop(handle, None)
+        return 1
+
+    def FormatMessageW(self, flags, source, code, language, buf, size, args):
+        buf.value = 'Fake error %s' % code
+        return len(buf.value)
+
+    def GetDiskFreeSpaceW(self, path, sectors_per_cluster, bytes_per_sector, free_clusters, total_clusters):
+        disk = self.disk
+        _target(sectors_per_cluster).value = disk.cluster_size // disk.bytes_per_sector
+        _target(bytes_per_sector).value = disk.bytes_per_sector
+        _target(free_clusters).value = 0
+        _target(total_clusters).value = disk.total_clusters
+        return 1
+
+    def GetVolumeInformationW(self, path, name_buf, name_size, serial, max_component, flags, fs_buf, fs_size):
+        if serial is not None:
+            _target(serial).value = self.disk.serial
+        if flags is not None:
+            _target(flags).value = 0
+        if fs_buf is not None:
+            fs_buf.value = 'NTFS'
+        return 1
+
+    def SetFilePointerEx(self, handle, distance, new_position, method):
+        self.positions[handle] = _target(distance).value
+        return 1
+
+    def ReadFile(self, handle, buf, size, out_size, overlapped):
+        disk = self.disk
+        position = self.positions[handle]
+        first = position // disk.bytes_per_sector
+        i = bisect.bisect_left(disk.bad_sectors, first)
+        if i < len(disk.bad_sectors) and disk.bad_sectors[i] * disk.bytes_per_sector < position + size:
+            _target(out_size).value = 0
+            return self._fail(ERROR_CRC)
+        _target(out_size).value = size
+        self.last_error = 0
+        return 1
+
+    def DeviceIoControl(self, handle, code, in_buf, in_size, out_buf, out_size, returned, overlapped):
+        self.last_error = 0
+        handler = self.IOCTLS.get(code)
+        if handler is None:
+            return self._fail(ERROR_INVALID_PARAMETER)
+        return handler(self, _target(in_buf), _target(out_buf), out_size, _target(returned))
+
+    def _is_volume_mounted(self, in_buf, out_buf, out_size, returned):
+        return 1
+
+    def _get_disk_extents(self, in_buf, out_buf, out_size, returned):
+        extents = self.disk.extents
+        header = VOLUME_DISK_EXTENTS.from_buffer(out_buf)
+        header.NumberOfDiskExtents = len(extents)
+        room = (out_size - VOLUME_DISK_EXTENTS.Extents.offset) // ctypes.sizeof(DISK_EXTENT)
+        if room < len(extents):
+            return self._fail(ERROR_MORE_DATA)
+        for i, (disk_number, start, length) in enumerate(extents):
+            extent = DISK_EXTENT.from_buffer(out_buf, VOLUME_DISK_EXTENTS.Extents.offset + i * ctypes.sizeof(DISK_EXTENT))
+            extent.DiskNumber = disk_number
+            extent.StartingOffset = start
+            extent.ExtentLength = length
+        returned.value = VOLUME_DISK_EXTENTS.Extents.offset + len(extents) * ctypes.sizeof(DISK_EXTENT)
+        return 1
+
+    def _logical_to_physical(self, in_buf, out_buf, out_size, returned):
+        offset = in_buf.LogicalOffset
+        for disk_number, start, length in self.disk.extents:
+            if offset < length:
+                out_buf.NumberOfPhysicalOffsets = 1
+                out_buf.PhysicalOffset[0].DiskNumber = disk_number
+                out_buf.PhysicalOffset[0].Offset = start + offset
+                returned.value = ctypes.sizeof(out_buf)
+                return 1
+            offset -= length
+        return self._fail(ERROR_INVALID_PARAMETER)
+
+    def _physical_to_logical(self, in_buf, out_buf, out_size, returned):
+        logical = 0
+        for disk_number, start, length in self.disk.extents:
+            if disk_number == in_buf.DiskNumber and start <= in_buf.Offset < start + length:
+                out_buf.LogicalOffset = logical + in_buf.Offset - start
+                returned.value = ctypes.sizeof(out_buf)
+                return 1
+            logical += length
+        return self._fail(ERROR_INVALID_PARAMETER)
+
+    def _get_retrieval_pointer_base(self, in_buf, out_buf, out_size, returned):
+        out_buf.value = 0
+        return 1
+
+    def _query_usn_journal(self, in_buf, out_buf, out_size, returned):
+        return self._fail(ERROR_JOURNAL_NOT_ACTIVE)
+
+    def _get_volume_bitmap(self, in_buf, out_buf, out_size, returned):
+        disk = self.disk
+        start = in_buf.value & ~7
+        bits = max(0, disk.total_clusters - start)
+        room = out_size - ctypes.sizeof(VOLUME_BITMAP_BUFFER)
+        size = max(0, min(room, (bits + 7) // 8))
+        address = ctypes.addressof(out_buf)
+        ctypes.memmove(address, struct.pack('<QQ', start, bits), 16)
+        if size:
+            ctypes.memmove(address + 16, (ctypes.c_char * size).from_buffer(disk.bitmap, start // 8), size)
+        returned.value = 16 + size
+        if size < (bits + 7) // 8:
+            return self._fail(ERROR_MORE_DATA)
+        return 1
+
+    def _lookup_stream_from_cluster(self, in_buf, out_buf, out_size, returned):
+        clusters = (ctypes.c_ulonglong * in_buf.NumberOfClusters).from_address(
+            ctypes.addressof(in_buf) + LOOKUP_STREAM_FROM_CLUSTER_INPUT.Cluster.offset)
+        matches = []
+        for cluster in clusters:
+            matches.extend((cluster, flags, name) for flags, name in self.disk.streams.get(cluster, ()))
+        entry_sizes = [(LOOKUP_STREAM_FROM_CLUSTER_ENTRY.FileName.offset
+                        + (len(name) + 1) * ctypes.sizeof(ctypes.c_wchar) + 7) & ~7
+                       for cluster, flags, name in matches]
+        first = (ctypes.sizeof(LOOKUP_STREAM_FROM_CLUSTER_OUTPUT) + 7) & ~7
+        required = first + sum(entry_sizes)
+        address = ctypes.addressof(out_buf)
+        header = LOOKUP_STREAM_FROM_CLUSTER_OUTPUT.from_address(address)
+        header.Offset = first if matches else 0
+        header.NumberOfMatches = len(matches)
+        header.BufferSizeRequired = required
+        if required > out_size:
+            return self._fail(ERROR_MORE_DATA)
+        offset = first
+        for i, ((cluster, flags, name), size) in enumerate(zip(matches, entry_sizes)):
+            entry = LOOKUP_STREAM_FROM_CLUSTER_ENTRY.from_address(address + offset)
+            entry.OffsetToNext = size if i < len(matches) - 1 else 0
+            entry.Flags = flags
+            entry.Cluster = cluster
+            name_buf = ctypes.create_unicode_buffer(name)
+            ctypes.memmove(address + offset + LOOKUP_STREAM_FROM_CLUSTER_ENTRY.FileName.offset,
+                           name_buf, ctypes.sizeof(name_buf))
+            offset += size
+        returned.value = required
+        return 1
+
+    IOCTLS = {
+        FSCTL_IS_VOLUME_MOUNTED: _is_volume_mounted,
+        IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS: _get_disk_extents,
+        IOCTL_VOLUME_LOGICAL_TO_PHYSICAL: _logical_to_physical,
+        IOCTL_VOLUME_PHYSICAL_TO_LOGICAL: _physical_to_logical,
+        FSCTL_GET_RETRIEVAL_POINTER_BASE: _get_retrieval_pointer_base,
+        FSCTL_QUERY_USN_JOURNAL: _query_usn_journal,
+        FSCTL_GET_VOLUME_BITMAP: _get_volume_bitmap,
+        FSCTL_LOOKUP_STREAM_FROM_CLUSTER: _lookup_stream_from_cluster,
+    }
+
+
+class FakeMachine(_VolumeEnumeration):
+    """Several volumes, each a FakeDisk served by its own FakeKernel32, for
+    the code that looks through every volume on the system (disk_index.py).
+    Calls on a handle go to the FakeKernel32 that opened it, and calls on a
+    path to the volume the path is on.
+
+        machine = FakeMachine([('\\\\?\\Volume{...}\\', ['C:\\'], disk), ...])
+        win_volume.kernel32 = machine
+    """
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.kernel32s = []
+        for i, (name, mount_points, disk) in enumerate(volumes):
+            kernel32 = FakeKernel32(disk)
+            kernel32.next_handle = 1000 * (i + 1)     # Keeps handles unique across volumes
+            self.kernel32s.append(kernel32)
+        self.owners = {}        # Handle -> the FakeKernel32 that opened it
+        self.finds = {}
+        self.next_handle = 100
+        self.last_error = 0
+        self.last_called = self     # Whichever last set the error GetLastError() returns
+
+    FormatMessageW = FakeKernel32.FormatMessageW
+
+    def GetLastError(self):
+        return self.last_called.last_error
+
+    def _fail(self, err):
+        self.last_called = self
+        self.last_error = err
+        return 0
+
+    def _for_path(self, path):
+        """The FakeKernel32 of the volume a volume name, GUID path, mount
+        point or file path is on, or None."""
+        path = path.rstrip('\\')
+        if path.startswith('\\\\.\\'):
+            path = path[4:]
+        for (name, mount_points, disk), kernel32 in zip(self.volumes, self.kernel32s):
+            for root in [name] + mount_points:
+                root = root.rstrip('\\')
+                if path == root or path.startswith(root + '\\'):
+                    return kernel32
+        return None
+
+    def _call(self, kernel32, name, *args):
+        self.last_called = kernel32
+        return getattr(kernel32, name)(*args)
+
+    def CreateFileW(self, name, *args):
+        kernel32 = self._for_path(name)
+        if kernel32 is None:
+            self._fail(ERROR_FILE_NOT_FOUND)
+            return INVALID_HANDLE
+        handle = self._call(kernel32, 'CreateFileW', name, *args)
+        self.owners[handle] = kernel32
+        return handle
+
+    def CloseHandle(self, handle):
+        return self._call(self.owners.pop(handle), 'CloseHandle', handle)
+
+    def SetFilePointerEx(self, handle, *args):
+        return self._call(self.owners[handle], 'SetFilePointerEx', handle, *args)
+
+    def ReadFile(self, handle, *args):
+        return self._call(self.owners[handle], 'ReadFile', handle, *args)
+
+    def DeviceIoControl(self, handle, *args):
+        return self._call(self.owners[handle], 'DeviceIoControl', handle, *args)
+
+    def GetDiskFreeSpaceW(self, path, *args):
+        kernel32 = self._for_path(path)
+        if kernel32 is None:
+            return self._fail(ERROR_FILE_NOT_FOUND)
+        return self._call(kernel32, 'GetDiskFreeSpaceW', path, *args)
+
+    def GetVolumeInformationW(self, path, *args):
+        kernel32 = self._for_path(path)
+        if kernel32 is None:
+            return self._fail(ERROR_FILE_NOT_FOUND)
+        return self._call(kernel32, 'GetVolumeInformationW', path, *args)
+
+
+def install(disk):
+    """Points volume.kernel32 (which every module calls through) at a
+    FakeKernel32 for `disk`, and returns it."""
+    kernel32 = FakeKernel32(disk)
+    win_volume.kernel32 = kernel32
+    return kernel32
@@ -0,0 +1,246 @@
+"""Benchmarks for the bitmap handling, stream lookup decoding and cluster
+probing, run against fake_kernel32 so they work on any platform.
+
+    python benchmarks/run_benchmarks.py             # Run, and compare with baselines.json
+    python benchmarks/run_benchmarks.py --save      # Run, and record the results as the new baselines
+
+Every result is a rate (higher is better). A result more than --tolerance
+below its baseline is reported as a regression, and the exit status is then
+1. Baselines are only comparable on the machine they were recorded on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bitmap
+from bitmap import FullBitmap, VolumeBitmap
+from fake_kernel32 import FakeDisk, install
+from query_sector import query_clusters
+from scan import SurfaceScan
+from volume import Volume
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+
+def make_disk(bitmap_mb, seed=1):
+    """A fake volume with a bitmap of `bitmap_mb` MB (8M clusters per MB),
+    fragmented like a well-used volume: runs of used and free clusters with
+    lengths spread over several orders of magnitude."""
+    disk = FakeDisk(total_clusters=bitmap_mb * 8 * 1024 * 1024)
+    rng = random.Random(seed)
+    pattern = bytearray()
+    used = False
+    while len(pattern) < 1024 * 1024:
+        run_bytes = int(rng.paretovariate(1.2))
+        pattern += (b'\xff' if used else b'\0') * run_bytes
+        if run_bytes < 4:
+            pattern.append(rng.randrange(256))     # Runs that don't end on a byte boundary
+        used = not used
+    disk.set_bitmap(pattern[:1024 * 1024])
+    return disk
+
+
+def open_volume(disk):
+    install(disk)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Volume('X', unbuffered=True).open()
+
+
+def timed(func, repeat):
+    """Best time in seconds of `repeat` calls to func()."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_bitmap_load(args):
+    volume = open_volume(make_disk(args.bitmap_mb))
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = timed(volume.load_bitmap, args.repeat)
+    return {'bitmap_load_mb_per_s': args.bitmap_mb / seconds}
+
+
+def bench_bitmap_query(args):
+    volume = open_volume(make_disk(args.bitmap_mb))
+    with contextlib.redirect_stdout(io.StringIO()):
+        full = FullBitmap(volume.load_bitmap())
+    rng = random.Random(2)
+    clusters = [rng.randrange(full.total_clusters) for _ in range(args.lookups)]
+
+    def query_full():
+        for cluster in clusters:
+            full.is_set(cluster)
+
+    def query_windowed():
+        windowed = VolumeBitmap(volume)
+        for cluster in clusters:
+            windowed.is_set(cluster)
+
+    # Scattered lookups miss the window cache, like a batch of unrelated sectors
+    scattered = clusters[:args.lookups // 10]
+
+    def query_scattered():
+        windowed = VolumeBitmap(volume)
+        for cluster in scattered:
+            windowed.is_set(cluster)
+
+    return {
+        'full_is_set_per_s': len(clusters) / timed(query_full, args.repeat),
+        'windowed_is_set_per_s': len(clusters) / timed(query_windowed, args.repeat),
+        'windowed_scattered_is_set_per_s': len(scattered) / timed(query_scattered, args.repeat),
+    }
+
+
+def bench_free_runs(args):
+    # The pure Python fallback is far slower, so give it less to do
+    size_mb = min(args.bitmap_mb, 64 if bitmap.numpy is not None else 1)
+    volume = open_volume(make_disk(size_mb))
+    with contextlib.redirect_stdout(io.StringIO()):
+        full = FullBitmap(volume.load_bitmap())
+    backend = 'numpy' if bitmap.numpy is not None else 'python'
+    return {
+        'free_runs_%s_mb_per_s' % backend: size_mb / timed(full.free_runs, args.repeat),
+        'report_%s_mb_per_s' % backend: size_mb / timed(full.report, args.repeat),
+    }
+
+
+def bench_lookup_decode(args):
+    """FSCTL_LOOKUP_STREAM_FROM_CLUSTER output with many entries per call:
+    every cluster used by several streams (hard links, alternate streams)."""
+    disk = make_disk(1)
+    for i in range(args.lookup_clusters):
+        for link in range(args.matches_per_cluster):
+            disk.add_stream(1000 + i, 1, r'\Users\someone\Documents\project %s\file %s (%s).dat' % (i // 100, i, link))
+    volume = open_volume(disk)
+    groups = [list(range(c, min(c + 64, 1000 + args.lookup_clusters)))
+              for c in range(1000, 1000 + args.lookup_clusters, 64)]
+    entries = args.lookup_clusters * args.matches_per_cluster
+
+    def decode():
+        for group in groups:
+            volume.lookup_clusters(group)
+
+    def lookup_files():
+        volume.lookup_cluster_files(range(1000, 1000 + args.lookup_clusters))
+
+    return {
+        'lookup_entries_decoded_per_s': entries / timed(decode, args.repeat),
+        'lookup_cluster_files_per_s': args.lookup_clusters / timed(lookup_files, args.repeat),
+    }
+
+
+def bench_probe(args):
+    """End to end: resolve, look up and test-read clusters as a batch query
+    does, with a mix of used and free clusters and some unreadable ones."""
+    disk = make_disk(1)
+    rng = random.Random(3)
+    clusters = sorted(rng.sample(range(disk.total_clusters), args.probe_clusters))
+    for cluster in clusters[::4]:
+        disk.add_stream(cluster, 1, r'\data\file%s.bin' % cluster)
+    for cluster in clusters[::50]:
+        disk.add_bad_sector(cluster * disk.cluster_size // disk.bytes_per_sector + 3)
+    volume = open_volume(disk)
+    sectors_per_cluster = volume.cluster_size // volume.bytes_per_sector
+    first_sector = volume.start // volume.bytes_per_sector
+    rows = {c: (first_sector + c * sectors_per_cluster,) * 2 for c in clusters}
+
+    def probe():
+        query_clusters(volume, VolumeBitmap(volume), rows)
+
+    def scan():
+        surface_scan = SurfaceScan(volume, 4 * 1024 * 1024)
+        surface_scan.scan(0, args.scan_clusters - 1)
+        surface_scan.close()
+
+    return {
+        'probe_clusters_per_s': len(clusters) / timed(probe, args.repeat),
+        'scan_clusters_per_s': args.scan_clusters / timed(scan, args.repeat),
+    }
+
+
+BENCHMARKS = {
+    'bitmap_load': bench_bitmap_load,
+    'bitmap_query': bench_bitmap_query,
+    'free_runs': bench_free_runs,
+    'lookup_decode': bench_lookup_decode,
+    'probe': bench_probe,
+}
+
+
+def compare(results, baselines, tolerance):
+    """Prints each result against its baseline; returns the names of the regressions."""
+    regressions = []
+    for name, value in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            print('%-40s %14.1f   (no baseline)' % (name, value))
+            continue
+        change = value / baseline - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-40s %14.1f   %+6.1f%% vs %.1f%s' % (name, value, 100 * change, baseline, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmarks against a fake kernel32.')
+    parser.add_argument('names', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run (default: all of %s).' % ', '.join(BENCHMARKS))
+    parser.add_argument('--save', action='store_true', help='record the results in %s.' % BASELINES)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='how far below baseline counts as a regression (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measurement; the best is kept.')
+    parser.add_argument('--bitmap-mb', type=int, default=256,
+                        help='size of the synthetic volume bitmap (default: %(default)s MB, an 8 TB '
+                             'volume of 4 KB clusters; 2048 gives the bitmap of a 64 TB volume).')
+    parser.add_argument('--lookups', type=int, default=1000000)
+    parser.add_argument('--lookup-clusters', type=int, default=4096)
+    parser.add_argument('--matches-per-cluster', type=int, default=4)
+    parser.add_argument('--probe-clusters', type=int, default=20000)
+    parser.add_argument('--scan-clusters', type=int, default=1 << 22)
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+
+    results = {}
+    for name in names:
+        print('Running %s...' % name)
+        results.update(BENCHMARKS[name](args))
+
+    saved = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            saved = json.load(f)
+    regressions = compare(results, saved.get('results', {}), args.tolerance)
+    if args.save:
+        saved.setdefault('results', {}).update((name, round(value, 1)) for name, value in results.items())
+        saved['machine'] = '%s, Python %s' % (platform.platform(), platform.python_version())
+        saved['bitmap_mb'] = args.bitmap_mb
+        with open(BASELINES, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('Saved baselines to %s' % BASELINES)
+    elif regressions:
+        print('%s regression(s).' % len(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""A simulated failing hard disk behind the kernel32 calls, for trying out
+scan and probe strategies off Windows and without a failing drive.
+
+It extends fake_kernel32 with a DiskModel: which sectors are unreadable,
+which only read after a latency spike, and which fail some of the time,
+plus what seeks, transfers and commands cost. Every read, write and ioctl
+advances a SimulatedClock by what it would have taken, and the modules
+that time reads are pointed at that clock, so slow-read detection sees the
+simulated latencies and a strategy's cost is the simulated wall time at the
+end. Nothing is stored per sector but the damage, so terabyte volumes only
+cost their bitmap (32 MB per TB with 4 KB clusters).
+
+    model = DiskModel.generate(total_sectors, areas=20, seed=1)
+    disk = SimulatedDisk(total_clusters, model)
+    with install(disk) as clock:
+        volume = Volume('X', unbuffered=True).open()
+        ...
+
+Everything is deterministic for a given model seed.
+"""
+import bisect
+import contextlib
+import ctypes
+import math
+import random
+import re
+import time
+
+import probe
+import readers
+import scan
+import volume as win_volume
+from fake_kernel32 import ERROR_CRC, FakeDisk, FakeKernel32, _target
+from win_types import *
+
+ERROR_ACCESS_DENIED = 5
+ERROR_IO_PENDING = 997
+ERROR_DISK_FULL = 112
+
+NOT_FULL = re.compile(b'[^\\xff]')     # A bitmap byte with a free cluster in it
+
+
+class SimulatedClock:
+    """Stands in for the time module in the modules that time reads; the
+    time only moves when the simulated disk does some work."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class DiskModel:
+    """Where a disk is damaged and what its operations cost.
+
+    Sector numbers are relative to the start of the volume. `bad` sectors
+    always fail (until written, when the drive reallocates them), `weak`
+    ones (sector -> milliseconds) read successfully but only after a
+    latency spike, and `flaky` ones (sector -> probability) fail that
+    fraction of the reads that touch them.
+
+    A read costs `command_ms`, then a seek if it doesn't start where the
+    last one ended (`settle_ms` plus up to `full_stroke_ms`, growing with
+    the square root of the distance, plus half a revolution on average),
+    then the transfer at a rate falling from `outer_mb_s` at the start of
+    the disk to `inner_mb_s` at the end. A read that hits a bad sector
+    takes `error_ms` more, for the drive's internal retries, and stops
+    there.
+    """
+
+    def __init__(self, total_sectors, bytes_per_sector=512, bad=(), weak=None, flaky=None, seed=1,
+                 command_ms=0.1, settle_ms=1.0, full_stroke_ms=15.0, rpm=7200,
+                 outer_mb_s=200.0, inner_mb_s=100.0, error_ms=1500.0):
+        self.total_sectors = total_sectors
+        self.bytes_per_sector = bytes_per_sector
+        self.bad = sorted(set(bad))
+        self.weak = dict(weak or {})
+        self.flaky = dict(flaky or {})
+        self._weak_sorted = sorted(self.weak)
+        self._flaky_sorted = sorted(self.flaky)
+        self.rng = random.Random(seed)
+        self.command_ms = command_ms
+        self.settle_ms = settle_ms
+        self.full_stroke_ms = full_stroke_ms
+        self.half_revolution_ms = 30000.0 / rpm
+        self.outer_mb_s = outer_mb_s
+        self.inner_mb_s = inner_mb_s
+        self.error_ms = error_ms
+        self.head = 0               # Sector after the last one transferred
+        self.centres = []           # Middle of each damaged area, for generated models
+        self.reallocated = 0        # Bad, weak or flaky sectors written over
+        self.reads = 0
+        self.writes = 0
+        self.seeks = 0
+
+    @classmethod
+    def generate(cls, total_sectors, areas=10, radius=2000, density=0.05, seed=1, **kwargs):
+        """A model with `areas` damaged areas at random places. Each has a
+        radius (in sectors) spread around `radius`; within it sectors are
+        bad with a probability of `density`, falling off towards the edge,
+        and a halo twice as wide has weak and flaky sectors."""
+        rng = random.Random(seed)
+        bad, weak, flaky = set(), {}, {}
+        centres = []
+        for _ in range(areas):
+            centre = rng.randrange(total_sectors)
+            centres.append(centre)
+            r = max(1, int(radius * rng.paretovariate(2.0) / 2))
+            for _ in range(max(1, int(4 * r * density))):
+                # Sectors near the centre are likelier to be bad
+                sector = centre + int(rng.gauss(0, r / 2))
+                if 0 <= sector < total_sectors:
+                    bad.add(sector)
+            for _ in range(max(1, int(r * density))):
+                sector = centre + rng.randrange(-2 * r, 2 * r + 1)
+                if 0 <= sector < total_sectors and sector not in bad:
+                    if rng.random() < 0.7:
+                        weak[sector] = rng.uniform(200, 2000)
+                    else:
+                        flaky[sector] = rng.uniform(0.1, 0.5)
+        model = cls(total_sectors, bad=bad, weak=weak, flaky=flaky, seed=seed, **kwargs)
+        model.centres = sorted(centres)
+        return model
+
+    @staticmethod
+    def _in_range(sectors, first, end):
+        return sectors[bisect.bisect_left(sectors, first):bisect.bisect_left(sectors, end)]
+
+    def _position_ms(self, sector):
+        """Command overhead and the seek (if any) to `sector`."""
+        ms = self.command_ms
+        if sector != self.head:
+            distance = abs(sector - self.head) / self.total_sectors
+            ms += self.settle_ms + (self.full_stroke_ms - self.settle_ms) * math.sqrt(distance)
+            ms += self.half_revolution_ms
+            self.seeks += 1
+        return ms
+
+    def _transfer_ms(self, sector, count):
+        rate = self.outer_mb_s - (self.outer_mb_s - self.inner_mb_s) * sector / self.total_sectors
+        return count * self.bytes_per_sector / (rate * 1000.0)
+
+    def read(self, sector, count):
+        """Reads `count` sectors. Returns (error code, milliseconds taken)."""
+        self.reads += 1
+        ms = self._position_ms(sector)
+        end = sector + count
+        failed = None
+        bad = self._in_range(self.bad, sector, end)
+        if bad:
+            failed = bad[0]
+        for flaky in self._in_range(self._flaky_sorted, sector, end if failed is None else failed):
+            if self.rng.random() < self.flaky[flaky]:
+                failed = flaky
+                break
+        if failed is not None:
+            ms += self._transfer_ms(sector, failed - sector) + self.error_ms
+            self.head = failed + 1
+            return ERROR_CRC, ms
+        ms += self._transfer_ms(sector, count)
+        ms += sum(self.weak[s] for s in self._in_range(self._weak_sorted, sector, end))
+        self.head = end
+        return 0, ms
+
+    def write(self, sector, count):
+        """Writes `count` sectors; any damaged ones among them are
+        reallocated. Returns the milliseconds taken."""
+        self.writes += 1
+        ms = self._position_ms(sector) + self._transfer_ms(sector, count)
+        end = sector + count
+        i, j = bisect.bisect_left(self.bad, sector), bisect.bisect_left(self.bad, end)
+        self.reallocated += j - i
+        del self.bad[i:j]
+        for sectors, damage in ((self._weak_sorted, self.weak), (self._flaky_sorted, self.flaky)):
+            i, j = bisect.bisect_left(sectors, sector), bisect.bisect_left(sectors, end)
+            for s in sectors[i:j]:
+                del damage[s]
+            self.reallocated += j - i
+            del sectors[i:j]
+        self.head = end
+        return ms
+
+
+class SimulatedDisk(FakeDisk):
+    """A FakeDisk whose reads and writes go through a DiskModel."""
+
+    def __init__(self, total_clusters, model, cluster_size=4096, ioctl_ms=0.05, **kwargs):
+        super().__init__(total_clusters, cluster_size, model.bytes_per_sector, **kwargs)
+        self.model = model
+        self.ioctl_ms = ioctl_ms
+        self.clock = SimulatedClock()
+        self.busy_until = 0.0   # When the drive finishes the commands queued so far
+
+    def add_bad_sector(self, sector):
+        bisect.insort(self.model.bad, sector)
+
+    def service(self, cost_ms):
+        """Queues a command taking `cost_ms` behind the ones already queued;
+        returns the simulated time it completes."""
+        self.busy_until = max(self.busy_until, self.clock.now) + cost_ms / 1000.0
+        return self.busy_until
+
+    def allocate(self, count):
+        """Marks the first `count` free clusters used; returns them."""
+        clusters = []
+        match = NOT_FULL.search(self.bitmap)
+        while match and len(clusters) < count:
+            byte = match.start()
+            for bit in range(8):
+                cluster = byte * 8 + bit
+                if len(clusters) < count and cluster < self.total_clusters and not self.bitmap[byte] & (1 << bit):
+                    self.bitmap[byte] |= 1 << bit
+                    clusters.append(cluster)
+            match = NOT_FULL.search(self.bitmap, byte + 1)
+        return clusters
+
+    def release(self, clusters):
+        for cluster in clusters:
+            self.bitmap[cluster // 8] &= ~(1 << (cluster % 8)) & 0xff
+
+
+class SimulatedKernel32(FakeKernel32):
+    """FakeKernel32 plus overlapped reads, the dummy file writes and moves
+    the rewrite does, and the time every call takes on a SimulatedDisk."""
+
+    def __init__(self, disk):
+        super().__init__(disk)
+        self.files = {}         # Handle of a file on the volume -> [LCN of each VCN]
+        self.completions = {}   # Address of an OVERLAPPED -> (time done, error code, bytes read)
+
+    def CreateFileW(self, name, access, share, security, disposition, flags, template):
+        handle = super().CreateFileW(name, access, share, security, disposition, flags, template)
+        if not name.startswith('\\\\.\\'):
+            self.files[handle] = []
+        return handle
+
+    def CloseHandle(self, handle):
+        clusters = self.files.pop(handle, None)
+        if clusters:
+            self.disk.release(clusters)     # Dummy files are opened delete-on-close
+        return super().CloseHandle(handle)
+
+    def CreateEventW(self, security, manual_reset, initial_state, name):
+        return super().CreateFileW(name, 0, 0, None, 0, 0, None)
+
+    def _read(self, position, size):
+        """Returns (error code, bytes read, time the read completes)."""
+        disk = self.disk
+        err, ms = disk.model.read(position // disk.bytes_per_sector, -(-size // disk.bytes_per_sector))
+        return err, 0 if err else size, disk.service(ms)
+
+    def ReadFile(self, handle, buf, size, out_size, overlapped):
+        if overlapped is not None:
+            ov = _target(overlapped)
+            err, done, finished = self._read(ov.Offset | ov.OffsetHigh << 32, size)
+            self.completions[ctypes.addressof(ov)] = finished, err, done
+            return self._fail(ERROR_IO_PENDING)
+        err, done, finished = self._read(self.positions[handle], size)
+        self.disk.clock.now = finished
+        _target(out_size).value = done
+        if err:
+            return self._fail(err)
+        self.last_error = 0
+        return 1
+
+    def GetOverlappedResult(self, handle, overlapped, out_size, wait):
+        finished, err, done = self.completions.pop(ctypes.addressof(_target(overlapped)))
+        clock = self.disk.clock
+        clock.now = max(clock.now, finished)
+        _target(out_size).value = done
+        if err:
+            return self._fail(err)
+        self.last_error = 0
+        return 1
+
+    def CancelIoEx(self, handle, overlapped):
+        return 1
+
+    def WriteFile(self, handle, data, size, out_size, overlapped):
+        disk = self.disk
+        clusters = disk.allocate(-(-size // disk.cluster_size))
+        if not clusters:
+            return self._fail(ERROR_DISK_FULL)
+        self.files[handle].extend(clusters)
+        spc = disk.cluster_size // disk.bytes_per_sector
+        ms = sum(disk.model.write(cluster * spc, spc) for cluster in clusters)
+        disk.clock.now = disk.service(ms)
+        _target(out_size).value = size
+        self.last_error = 0
+        return 1
+
+    def DeviceIoControl(self, handle, code, in_buf, in_size, out_buf, out_size, returned, overlapped):
+        disk = self.disk
+        disk.clock.now = disk.service(disk.ioctl_ms)
+        if code == FSCTL_GET_RETRIEVAL_POINTERS:
+            return self._get_retrieval_pointers(handle, _target(in_buf), _target(out_buf), out_size,
+                                                _target(returned))
+        return super().DeviceIoControl(handle, code, in_buf, in_size, out_buf, out_size, returned, overlapped)
+
+    def _get_retrieval_pointers(self, handle, in_buf, out_buf, out_size, returned):
+        lcns = self.files.get(handle, [])
+        start_vcn = in_buf.value
+        extents = []        # [next VCN, LCN]
+        for vcn in range(start_vcn, len(lcns)):
+            if extents and lcns[vcn] == extents[-1][1] + vcn - extents[-1][2]:
+                extents[-1][0] = vcn + 1
+            else:
+                extents.append([vcn + 1, lcns[vcn], vcn])
+        if not extents:
+            return self._fail(38)     # ERROR_HANDLE_EOF
+        header = RETRIEVAL_POINTERS_BUFFER.NextVcn.offset
+        room = (out_size - header) // ctypes.sizeof(RETRIEVAL_POINTERS_EXTENT)
+        address = ctypes.addressof(out_buf)
+        rpb = RETRIEVAL_POINTERS_BUFFER.from_address(address)
+        rpb.ExtentCount = min(room, len(extents))
+        rpb.StartingVcn = start_vcn
+        for i, (next_vcn, lcn, first_vcn) in enumerate(extents[:room]):
+            extent = RETRIEVAL_POINTERS_EXTENT.from_address(address + header + i * ctypes.sizeof(RETRIEVAL_POINTERS_EXTENT))
+            extent.NextVcn = next_vcn
+            extent.Lcn = lcn
+        returned.value = header + rpb.ExtentCount * ctypes.sizeof(RETRIEVAL_POINTERS_EXTENT)
+        if room < len(extents):
+            return self._fail(234)    # ERROR_MORE_DATA
+        return 1
+
+    def _move_file(self, in_buf, out_buf, out_size, returned):
+        disk = self.disk
+        mfd = MOVE_FILE_DATA.from_address(ctypes.addressof(in_buf))
+        lcns = self.files[mfd.FileHandle]
+        vcn, lcn, count = mfd.StartingVcn, mfd.StartingLcn, mfd.ClusterCount
+        targets = range(lcn, lcn + count)
+        if vcn + count > len(lcns) or any(disk.bitmap[c // 8] & (1 << (c % 8)) and c not in lcns
+                                          for c in targets):
+            return self._fail(ERROR_ACCESS_DENIED)
+        spc = disk.cluster_size // disk.bytes_per_sector
+        ms = disk.model.read(lcns[vcn] * spc, count * spc)[1] + disk.model.write(lcn * spc, count * spc)
+        disk.clock.now = disk.service(ms)
+        disk.release(lcns[vcn:vcn + count])
+        for i, target in enumerate(targets):
+            disk.bitmap[target // 8] |= 1 << (target % 8)
+            lcns[vcn + i] = target
+        return 1
+
+    IOCTLS = dict(FakeKernel32.IOCTLS)
+    IOCTLS[FSCTL_MOVE_FILE] = _move_file
+
+
+@contextlib.contextmanager
+def install(disk):
+    """Points volume.kernel32 at a SimulatedKernel32 for `disk`, and the
+    modules that time reads at its clock, for the duration of a with
+    block; gives the clock. The real kernel32 and time are put back after."""
+    modules = (probe, readers, scan)
+    saved = win_volume.kernel32, [module.time for module in modules]
+    win_volume.kernel32 = SimulatedKernel32(disk)
+    for module in modules:
+        module.time = disk.clock
+    try:
+        yield disk.clock
+    finally:
+        win_volume.kernel32 = saved[0]
+        for module, real_time in zip(modules, saved[1]):
+            module.time = real_time
@@ -0,0 +1,312 @@
+"""Access to the NTFS volume bitmap (one bit per cluster, set if in use)."""
+import array
+import collections
+import logging
+import re
+
+from win_types import VOLUME_BITMAP_BUFFER
+
+try:
+    import numpy
+except ImportError:     # Optional; only needed to make whole-bitmap work fast
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+class FullBitmap:
+    """The whole volume bitmap, as returned by Volume.load_bitmap() (or any
+    writable buffer holding the same, such as a snapshot mapped by
+    snapshot.open_snapshot())."""
+
+    def __init__(self, bm_buf):
+        self.bm_buf = bm_buf
+        header = VOLUME_BITMAP_BUFFER.from_buffer(bm_buf)
+        self.total_clusters = header.StartingLcn + header.BitmapSize
+        self.data = memoryview(bm_buf).cast('B')[16:16 + (header.BitmapSize + 7) // 8]
+
+    def is_set(self, cluster):
+        return bool(self.data[cluster // 8] & 2**(cluster % 8))
+
+    def update(self, start_lcn, data):
+        """Overwrites part of the bitmap with fresh bitmap data starting at
+        `start_lcn` (a multiple of 8), as from Volume.read_bitmap()."""
+        start = start_lcn // 8
+        size = min(len(data), len(self.data) - start)
+        self.data[start:start + size] = data[:size]
+
+    def free_runs(self):
+        return free_runs(self.data, self.total_clusters)
+
+    def report(self, regions=100):
+        return bitmap_report(self.data, self.total_clusters, regions)
+
+
+def free_runs(data, total_clusters, chunk_size=64 * 1024 * 1024):
+    """Finds the runs of free clusters in bitmap data that starts at LCN 0.
+
+    Returns (starts, lengths): two equal-length arrays (NumPy arrays if
+    NumPy is available, otherwise array.array) of each run's first LCN and
+    its length in clusters, in LCN order.
+    """
+    if numpy is None:
+        return _free_runs_python(data, total_clusters)
+    runs = list(_iter_free_runs(data, total_clusters, chunk_size))
+    if not runs:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+    return (numpy.concatenate([starts for starts, lengths in runs]),
+            numpy.concatenate([lengths for starts, lengths in runs]))
+
+
+def _iter_free_runs(data, total_clusters, chunk_size):
+    """Yields (starts, lengths) arrays of free runs one chunk of bitmap
+    data at a time. A run crossing a chunk boundary is only yielded once
+    it ends."""
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    carry = None        # Start of a free run still open at the end of the last chunk
+    for base in range(0, len(data), chunk_size):
+        starts, ends = _chunk_free_runs(data[base:base + chunk_size])
+        starts += base * 8
+        ends += base * 8
+        if carry is not None:
+            if len(starts) and starts[0] == base * 8:
+                starts[0] = carry
+            else:
+                yield numpy.array([carry]), numpy.array([base * 8 - carry])
+            carry = None
+        if len(ends) and ends[-1] == (base + chunk_size) * 8 and base + chunk_size < len(data):
+            carry = starts[-1]
+            starts = starts[:-1]
+            ends = ends[:-1]
+        # Drop the padding bits after the last cluster
+        keep = starts < total_clusters
+        starts = starts[keep]
+        yield starts, numpy.minimum(ends[keep], total_clusters) - starts
+
+
+def _chunk_free_runs(chunk):
+    """Returns (starts, ends) of the free runs in a uint8 array of bitmap
+    bytes, as bit offsets from the start of the chunk.
+
+    Works byte-wise: a run can only end where two neighbouring bytes
+    disagree at their shared edge, or inside a byte that is neither 0x00 nor
+    0xff, so only those bytes are ever looked at bit by bit.
+    """
+    nbits = len(chunk) * 8
+    # For each byte, a mask of the bit positions where a new run starts: bit 0
+    # if the byte's first bit differs from the previous byte's last bit, and
+    # bit k (1..7) if bit k differs from bit k-1 within the byte.
+    edges = ((chunk ^ (chunk >> 1)) & 0x7f) << 1
+    edges[1:] |= (chunk[1:] & 1) ^ (chunk[:-1] >> 7)
+    # When few bytes have a run boundary in them, only those are unpacked
+    if numpy.count_nonzero(edges) > len(chunk) // 16:
+        boundaries = numpy.flatnonzero(numpy.unpackbits(edges, bitorder='little').view(bool))
+    else:
+        mixed = numpy.flatnonzero(edges != 0)
+        bits = numpy.unpackbits(edges[mixed].reshape(-1, 1), axis=1, bitorder='little')
+        rows, cols = numpy.nonzero(bits.view(bool))
+        boundaries = mixed[rows].astype(numpy.int64) * 8 + cols
+    # Runs alternate between free and in-use, starting with the chunk's first bit
+    run_starts = numpy.concatenate(([0], boundaries))
+    run_ends = numpy.concatenate((boundaries, [nbits]))
+    first = 1 if chunk[0] & 1 else 0
+    return run_starts[first::2], run_ends[first::2]
+
+
+def bitmap_report(data, total_clusters, regions=100, chunk_size=16 * 1024 * 1024):
+    """Summarises a whole volume bitmap: used and free cluster counts, a
+    histogram of free run lengths (in power-of-two buckets), the largest
+    contiguous free extent, and the fraction of clusters in use in each of
+    `regions` equal slices of the volume.
+
+    The bitmap is processed a chunk at a time, so apart from the bitmap
+    itself only a few chunk-sized temporaries are ever held. Returns a dict
+    ready for json.dump().
+    """
+    nbytes = (total_clusters + 7) // 8
+    data = memoryview(data).cast('B')[:nbytes]
+    region_bytes = max(1, -(-nbytes // regions))
+    region_used = [0] * -(-nbytes // region_bytes)
+    buckets = collections.Counter()     # log2(run length) -> [runs, clusters]
+    bucket_clusters = collections.Counter()
+    largest = (0, 0)    # (length, start)
+    nruns = 0
+
+    if numpy is None:
+        for i in range(len(region_used)):
+            region = bytes(data[i * region_bytes:(i + 1) * region_bytes])
+            region_used[i] = bin(int.from_bytes(region, 'little')).count('1')
+        run_chunks = [_free_runs_python(data, total_clusters)]
+    else:
+        array_data = numpy.frombuffer(data, dtype=numpy.uint8)
+        for base in range(0, len(array_data), chunk_size):
+            used = _popcount(array_data[base:base + chunk_size])
+            first_region = base // region_bytes
+            edges = numpy.arange(first_region * region_bytes, base + len(used), region_bytes) - base
+            edges[0] = 0
+            for i, count in enumerate(numpy.add.reduceat(used, edges, dtype=numpy.int64)):
+                region_used[first_region + i] += int(count)
+        run_chunks = _iter_free_runs(data, total_clusters, chunk_size)
+
+    for starts, lengths in run_chunks:
+        if not len(starts):
+            continue
+        nruns += len(starts)
+        if numpy is None:
+            for start, length in zip(starts, lengths):
+                buckets[length.bit_length() - 1] += 1
+                bucket_clusters[length.bit_length() - 1] += length
+                largest = max(largest, (length, -start))
+            continue
+        log2 = numpy.frexp(lengths)[1] - 1
+        for bucket, count in enumerate(numpy.bincount(log2)):
+            buckets[bucket] += int(count)
+        for bucket, count in enumerate(numpy.bincount(log2, weights=lengths)):
+            bucket_clusters[bucket] += int(count)
+        i = int(numpy.argmax(lengths))
+        largest = max(largest, (int(lengths[i]), -int(starts[i])))
+
+    # Bits past the last cluster are padding; don't count them as used
+    if total_clusters % 8:
+        region_used[-1] -= bin(data[nbytes - 1] >> (total_clusters % 8)).count('1')
+    used_clusters = sum(region_used)
+    return {
+        'total_clusters': total_clusters,
+        'used_clusters': used_clusters,
+        'free_clusters': total_clusters - used_clusters,
+        'free_runs': nruns,
+        'largest_free_extent': {'start': -largest[1], 'clusters': largest[0]},
+        'free_run_histogram': [
+            {'min_clusters': 2**bucket, 'max_clusters': 2**(bucket + 1) - 1,
+             'runs': buckets[bucket], 'clusters': bucket_clusters[bucket]}
+            for bucket in sorted(buckets) if buckets[bucket]
+        ],
+        'regions': {
+            'clusters_per_region': region_bytes * 8,
+            'occupancy': [
+                round(used / min(region_bytes * 8, total_clusters - i * region_bytes * 8), 4)
+                for i, used in enumerate(region_used)
+            ],
+        },
+    }
+
+
+def _popcount(chunk):
+    """Number of set bits in each byte of a uint8 array."""
+    if hasattr(numpy, 'bitwise_count'):     # NumPy 2.0+
+        return numpy.bitwise_count(chunk)
+    return _POPCOUNT[chunk]
+
+
+_POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], numpy.uint8) if numpy is not None else None
+
+
+_byte_runs = re.compile(rb'\x00+|\xff+|[\x01-\xfe]')
+
+
+def _free_runs_python(data, total_clusters):
+    """Slower fallback for free_runs() without NumPy. Whole free or in-use
+    bytes are still skipped over with a regex rather than a Python loop."""
+    starts = array.array('q')
+    lengths = array.array('q')
+    run_start = None
+    for match in _byte_runs.finditer(bytes(data)):
+        value = match.group()[0]
+        pos = match.start() * 8
+        if value == 0:
+            if run_start is None:
+                run_start = pos
+        elif value == 0xff:
+            if run_start is not None:
+                starts.append(run_start)
+                lengths.append(pos - run_start)
+                run_start = None
+        else:
+            for bit in range(8):
+                if value & (1 << bit):
+                    if run_start is not None:
+                        starts.append(run_start)
+                        lengths.append(pos + bit - run_start)
+                        run_start = None
+                elif run_start is None:
+                    run_start = pos + bit
+    if run_start is not None:
+        starts.append(run_start)
+        lengths.append(len(data) * 8 - run_start)
+    while starts and starts[-1] >= total_clusters:
+        starts.pop()
+        lengths.pop()
+    if starts:
+        lengths[-1] = min(lengths[-1], total_clusters - starts[-1])
+    return starts, lengths
+
+
+def clip_runs(starts, lengths, first, last):
+    """Restricts runs to the clusters first..last (inclusive). Returns
+    (starts, lengths) in the same form as free_runs()."""
+    if numpy is not None:
+        starts = numpy.asarray(starts)
+        ends = numpy.minimum(starts + numpy.asarray(lengths), last + 1)
+        starts = numpy.maximum(starts, first)
+        keep = starts < ends
+        return starts[keep], (ends - starts)[keep]
+    clipped_starts = array.array('q')
+    clipped_lengths = array.array('q')
+    for start, length in zip(starts, lengths):
+        start, end = max(start, first), min(start + length, last + 1)
+        if start < end:
+            clipped_starts.append(start)
+            clipped_lengths.append(end - start)
+    return clipped_starts, clipped_lengths
+
+
+class VolumeBitmap:
+    """Reads the volume bitmap on demand, one window at a time.
+
+    Only the window around each requested LCN is fetched (through the
+    StartingLcn input of FSCTL_GET_VOLUME_BITMAP), and recently used windows
+    are kept in an LRU cache bounded to `cache_bytes`, so nearby queries
+    don't cost any further I/O.
+    """
+
+    def __init__(self, volume, window_bytes=64 * 1024, cache_bytes=16 * 1024 * 1024):
+        self.volume = volume
+        self.window_bytes = window_bytes
+        self.window_clusters = window_bytes * 8
+        self.max_windows = max(1, cache_bytes // window_bytes)
+        self.windows = collections.OrderedDict()    # window number -> bitmap bytes
+        self.hits = 0
+        self.misses = 0
+
+    def window(self, cluster):
+        """Returns (first LCN, bitmap bytes) of the window holding a cluster."""
+        index = cluster // self.window_clusters
+        data = self.windows.get(index)
+        if data is not None:
+            self.hits += 1
+            self.windows.move_to_end(index)
+        else:
+            self.misses += 1
+            start = index * self.window_clusters
+            start_lcn, data = self.volume.read_bitmap(start, self.window_bytes)
+            if start_lcn != start:
+                raise RuntimeError('Bitmap window for LCN %s started at LCN %s' % (start, start_lcn))
+            self.windows[index] = data
+            if len(self.windows) > self.max_windows:
+                self.windows.popitem(last=False)
+        return index * self.window_clusters, data
+
+    def is_set(self, cluster):
+        start, data = self.window(cluster)
+        offs = cluster - start
+        if offs // 8 >= len(data):
+            raise IndexError('Cluster %s is past the end of the volume bitmap' % cluster)
+        return bool(data[offs // 8] & (1 << (offs % 8)))
+
+    def invalidate(self, first=0, last=None):
+        """Drops any cached windows overlapping clusters first..last (inclusive)."""
+        if last is None:
+            self.windows.clear()
+            return
+        for index in range(first // self.window_clusters, last // self.window_clusters + 1):
+            self.windows.pop(index, None)
@@ -0,0 +1,117 @@
+"""Keeping a loaded volume bitmap up to date from the NTFS change journal,
+instead of reloading all of it.
+
+The journal says which files changed, not which clusters, so the files whose
+allocation may have changed are opened by ID and their extents looked up,
+and only the bitmap windows those extents fall in are fetched again. Files
+that were deleted can't be looked up that way; the clusters they freed go on
+looking used until the next full reload, which is the safe way round for the
+dummy file rewrite. Without an active journal, everything is fetched again.
+"""
+import logging
+
+import volume as win_volume
+from bitmap import VolumeBitmap
+from file_index import open_file_by_id
+from volume import get_retrieval_pointers
+
+logger = logging.getLogger(__name__)
+
+USN_REASON_DATA_EXTEND = 0x00000002
+USN_REASON_DATA_TRUNCATION = 0x00000004
+USN_REASON_NAMED_DATA_EXTEND = 0x00000020
+USN_REASON_NAMED_DATA_TRUNCATION = 0x00000040
+USN_REASON_FILE_CREATE = 0x00000100
+USN_REASON_COMPRESSION_CHANGE = 0x00020000
+USN_REASON_STREAM_CHANGE = 0x00200000
+
+# Changes that can allocate clusters to a file or free them
+ALLOCATION_REASONS = (USN_REASON_DATA_EXTEND | USN_REASON_DATA_TRUNCATION | USN_REASON_NAMED_DATA_EXTEND
+                      | USN_REASON_NAMED_DATA_TRUNCATION | USN_REASON_FILE_CREATE
+                      | USN_REASON_COMPRESSION_CHANGE | USN_REASON_STREAM_CHANGE)
+
+REFRESH_WINDOW_BYTES = 64 * 1024    # Bitmap bytes fetched at a time for a FullBitmap
+
+
+class ChangeTracker:
+    """Follows a volume's change journal from the point start() is called.
+
+    Call start() before loading the bitmap, so that nothing changed while it
+    loads is missed, then refresh(bitmap) whenever the bitmap should be
+    brought up to date. Volumes that can't change (images) are never
+    refreshed.
+    """
+
+    def __init__(self, volume):
+        self.volume = volume
+        self.static = not hasattr(volume, 'query_usn_journal')
+        self.journal_id = None
+        self.next_usn = None
+        self.files_checked = 0
+        self.windows_fetched = 0
+        self.full_refreshes = 0
+
+    def start(self):
+        if not self.static:
+            journal = self.volume.query_usn_journal()
+            if journal is not None:
+                self.journal_id = journal.UsnJournalID
+                self.next_usn = journal.NextUsn
+        return self
+
+    def refresh(self, bitmap):
+        """Brings a FullBitmap or VolumeBitmap of the volume up to date with
+        the changes made since start() or the last refresh()."""
+        if self.static:
+            return
+        journal = self.volume.query_usn_journal()
+        changes = None
+        if journal is not None and journal.UsnJournalID == self.journal_id:
+            if journal.NextUsn == self.next_usn:
+                return
+            changes = self.volume.read_usn_changes(self.journal_id, self.next_usn, journal.NextUsn)
+        if journal is not None:
+            self.journal_id = journal.UsnJournalID
+            self.next_usn = journal.NextUsn
+        if changes is None:
+            logger.info('Change journal of %s unavailable or records lost; refreshing the whole bitmap'
+                        % self.volume.name)
+            self.full_refreshes += 1
+            self.refresh_ranges(bitmap, [(0, self.volume.total_clusters - 1)])
+            return
+        ranges = []
+        for frn, reasons in changes.items():
+            if reasons & ALLOCATION_REASONS:
+                ranges.extend((lcn, lcn + count - 1) for vcn, lcn, count in self.file_extents(frn))
+        self.refresh_ranges(bitmap, ranges)
+
+    def file_extents(self, frn):
+        """Returns the (VCN, LCN, count) extents of a file, or none if it is gone."""
+        handle = open_file_by_id(self.volume.handle, frn)
+        if handle is None:
+            return []
+        self.files_checked += 1
+        try:
+            return list(get_retrieval_pointers(handle))
+        except OSError as e:
+            logger.debug('No extents for file %s: %s' % (frn, e))
+            return []
+        finally:
+            win_volume.kernel32.CloseHandle(handle)
+
+    def refresh_ranges(self, bitmap, ranges):
+        """Fetches the bitmap again for each (first, last) cluster range: a
+        VolumeBitmap just drops its cached windows there, a FullBitmap has
+        each window the ranges touch read again and overwritten."""
+        if isinstance(bitmap, VolumeBitmap):
+            for first, last in ranges:
+                bitmap.invalidate(first, last)
+            return
+        window = REFRESH_WINDOW_BYTES * 8
+        windows = set()
+        for first, last in ranges:
+            windows.update(range(first // window, last // window + 1))
+        for index in sorted(windows):
+            start_lcn, data = self.volume.read_bitmap(index * window, REFRESH_WINDOW_BYTES)
+            bitmap.update(start_lcn, data)
+            self.windows_fetched += 1
@@ -0,0 +1,186 @@
+"""A journal of a surface scan's progress, so that an interrupted scan can
+pick up where it left off instead of starting again.
+
+The journal is an append-only file: a header identifying the volume, then
+records of the runs of clusters that have been read and of what was found in
+them. Records are buffered and written out (and synced) every few seconds,
+findings before the runs they were found in, so after a crash the journal
+ends at the last point the scan had got to at most that long before. A torn
+record at the end is ignored and written over.
+"""
+import logging
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'QSSCAN1\0'
+# magic, serial number, bytes per sector, cluster size, total clusters
+_HEADER = struct.Struct('<8sIIIQ')
+# record type, cluster, value, number of items following. For a run that
+# was read: first cluster and count, no items. For an unreadable cluster:
+# the cluster, its error code and the unreadable sectors. For a slow
+# cluster: the cluster, zero and its slow sectors.
+_RECORD = struct.Struct('<BQQI')
+_ITEM = struct.Struct('<Qf')        # sector, milliseconds
+_DONE, _BAD, _SLOW = 1, 2, 3
+
+
+def checkpoint_path(cache_dir, serial):
+    return os.path.join(cache_dir, '%08X.checkpoint' % serial)
+
+
+class ScanCheckpoint:
+    """The journal of the scans of one volume.
+
+    After open(), `done` holds the (first, count) runs already read,
+    `findings` and `slow` what was found in them, in the same form as a
+    SurfaceScan's. Pass the checkpoint to SurfaceScan.scan_runs() to record
+    the runs it reads as it goes, and close() it at the end.
+    """
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.file = None
+        self.done = []
+        self.findings = []
+        self.slow = []
+        self._pending = []          # Runs read since the last flush, merged where contiguous
+        self._findings_written = 0
+        self._slow_written = 0
+        self._next_flush = 0.0
+
+    def open(self, volume):
+        """Opens the journal for `volume`, loading what it has recorded if it
+        was made for the same volume (serial number and geometry), and
+        starting a new one otherwise."""
+        header = _HEADER.pack(_MAGIC, volume.get_serial_number(), volume.bytes_per_sector, volume.cluster_size, volume.total_clusters)
+        try:
+            f = open(self.path, 'r+b')
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            with f:
+                if f.read(_HEADER.size) == header:
+                    end = self._load(f)
+                else:
+                    logger.info('Checkpoint %s is for another volume; starting a new one' % self.path)
+                    end = None
+        if f is None or end is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.file = open(self.path, 'wb')
+            self.file.write(header)
+            self.file.flush()
+        else:
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(end)     # Drop a torn record
+            self.file.seek(end)
+        self._findings_written = len(self.findings)
+        self._slow_written = len(self.slow)
+        self._next_flush = time.monotonic() + self.interval
+        return self
+
+    def _load(self, f):
+        """Reads the records after the header; returns the offset after the
+        last complete one."""
+        data = f.read()
+        pos = 0
+        findings = {}
+        slow = {}
+        while pos + _RECORD.size <= len(data):
+            kind, cluster, value, count = _RECORD.unpack_from(data, pos)
+            end = pos + _RECORD.size + count * _ITEM.size
+            if end > len(data):
+                break
+            items = [_ITEM.unpack_from(data, pos + _RECORD.size + i * _ITEM.size) for i in range(count)]
+            if kind == _DONE:
+                self.done.append((cluster, value))
+            elif kind == _BAD:
+                findings[cluster] = (cluster, value, [sector for sector, ms in items])
+            elif kind == _SLOW:
+                slow[cluster] = (cluster, items)
+            else:
+                break
+            pos = end
+        # A cluster found again after an interrupted chunk was re-read is only kept once
+        self.findings = list(findings.values())
+        self.slow = list(slow.values())
+        return _HEADER.size + pos
+
+    def remaining(self, starts, lengths):
+        """Returns (starts, lengths) of the parts of the given runs (sorted,
+        not overlapping) that haven't been read yet."""
+        done = []
+        for first, count in sorted(self.done):
+            if done and first <= done[-1][1]:
+                done[-1][1] = max(done[-1][1], first + count)
+            else:
+                done.append([first, first + count])
+        out_starts, out_lengths = [], []
+        i = 0
+        for start, length in zip(starts, lengths):
+            start, end = int(start), int(start + length)
+            while i < len(done) and done[i][1] <= start:
+                i += 1
+            j = i
+            while start < end and j < len(done) and done[j][0] < end:
+                if done[j][0] > start:
+                    out_starts.append(start)
+                    out_lengths.append(done[j][0] - start)
+                start = max(start, done[j][1])
+                j += 1
+            if start < end:
+                out_starts.append(start)
+                out_lengths.append(end - start)
+        return out_starts, out_lengths
+
+    def chunk_done(self, first, count, scan):
+        """Records that a SurfaceScan has read clusters first..first+count-1
+        (and recorded anything it found there in its findings and slow
+        lists); writes the journal out if it is time to."""
+        if self._pending and self._pending[-1][0] + self._pending[-1][1] == first:
+            self._pending[-1] = (self._pending[-1][0], self._pending[-1][1] + count)
+        else:
+            self._pending.append((first, count))
+        if time.monotonic() >= self._next_flush:
+            self.flush(scan)
+
+    def flush(self, scan):
+        """Writes out the findings and runs recorded since the last flush,
+        and syncs the file."""
+        records = []
+        for cluster, err, sectors in scan.findings[self._findings_written:]:
+            records.append(_RECORD.pack(_BAD, cluster, err, len(sectors)))
+            records.extend(_ITEM.pack(sector, 0.0) for sector in sectors)
+        for cluster, sectors in scan.slow[self._slow_written:]:
+            records.append(_RECORD.pack(_SLOW, cluster, 0, len(sectors)))
+            records.extend(_ITEM.pack(sector, ms) for sector, ms in sectors)
+        records.extend(_RECORD.pack(_DONE, first, count, 0) for first, count in self._pending)
+        self._findings_written = len(scan.findings)
+        self._slow_written = len(scan.slow)
+        self.done.extend(self._pending)
+        self._pending = []
+        if records:
+            self.file.write(b''.join(records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self._next_flush = time.monotonic() + self.interval
+
+    def close(self, scan=None):
+        """Writes out anything still pending from `scan`, and closes the file."""
+        if self.file is None:
+            return
+        if scan is not None:
+            self.flush(scan)
+        self.file.close()
+        self.file = None
+
+    def remove(self):
+        """Deletes the journal, once the scan it records has finished."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,296 @@
+"""A long-running server that keeps volumes open and answers sector queries
+over a local socket, so that a monitoring agent can turn the sector numbers
+in disk error events into file names without paying for a process start, the
+volume open and the geometry and bitmap queries every time.
+
+The protocol is one JSON object per line each way. A query is
+
+    {"id": 1, "volume": "C", "sector": 123456, "read": true}
+
+("volume" can be left out when only one volume is served; "disk": N in its
+place looks the sector up on physical disk N instead; "read": false skips
+the test read), and its answer is
+
+    {"id": 1, "volume": "C", "sector": 123456, "cluster": 15176, "in_use": true,
+     "files": ["\\Users\\me\\file.dat"], "read": "ok"}
+
+with "cluster" null if the sector isn't on the volume, or {"id": 1, "error":
+"..."} if the query can't be answered. {"op": "volumes"} lists the volumes
+served and {"op": "stats"} returns query counters. Queries on a connection
+are answered as they complete, which may not be in the order they were sent.
+
+Each volume's I/O runs on a thread of its own, since a volume reuses its
+buffers from one call to the next. Identical lookups or test reads of a
+cluster already in flight for another client wait for that one's result
+rather than going to the disk again. At most every --refresh-interval
+seconds, the cached bitmap is brought up to date from the volume's change
+journal before a lookup, so clusters allocated or freed since are seen.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import time
+
+from bitmap import VolumeBitmap
+from changes import ChangeTracker
+from fleet import ImageAction
+from ntfs_image import NtfsImage
+from probe import DEFAULT_SLOW_MS, ClusterProbe
+from query_sector import describe_read, format_stream_flags
+from volume import Volume, VolumeError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+
+class ServedVolume:
+    """An open volume and the state kept warm for it between queries."""
+
+    def __init__(self, label, volume, slow_ms=DEFAULT_SLOW_MS, refresh_interval=1.0):
+        self.label = label
+        self.volume = volume
+        self.tracker = ChangeTracker(volume).start()
+        self.bitmap = VolumeBitmap(volume)
+        self.refresh_interval = refresh_interval
+        self.refresh_time = time.monotonic()
+        self.probe = ClusterProbe(volume, slow_ms)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.in_flight = {}     # (operation, cluster) -> future of its result
+        self.calls = 0          # Lookups and reads that went to the volume...
+        self.coalesced = 0      # ...and ones answered by waiting for an identical one
+
+    def describe(self):
+        volume = self.volume
+        return {
+            'volume': self.label,
+            'name': volume.name,
+            'disk_number': volume.disk_number,
+            'start': volume.start,
+            'bytes_per_sector': volume.bytes_per_sector,
+            'cluster_size': volume.cluster_size,
+            'total_clusters': volume.total_clusters,
+        }
+
+    async def call(self, operation, cluster):
+        """Runs lookup() or read() for a cluster on the volume's thread, or
+        waits for the same call if one is already in flight."""
+        key = (operation, cluster)
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.get_running_loop().run_in_executor(self.executor, getattr(self, operation), cluster)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+        # A client that goes away mustn't cancel the call for the others waiting on it
+        return await asyncio.shield(future)
+
+    def lookup(self, cluster):
+        """Returns (in use, [file names]) for a cluster. Runs on the volume's thread."""
+        now = time.monotonic()
+        if now - self.refresh_time > self.refresh_interval:
+            self.tracker.refresh(self.bitmap)
+            self.refresh_time = now
+        if not self.bitmap.is_set(cluster):
+            return False, []
+        files = self.volume.lookup_cluster_files([cluster]).get(cluster, [])
+        return True, ['%s%s' % (format_stream_flags(flags), name) for flags, name in files]
+
+    def read(self, cluster):
+        """Test-reads a cluster. Runs on the volume's thread."""
+        return describe_read(self.probe, cluster)
+
+    async def sector_to_cluster(self, sector, disk_number=None):
+        """Maps a sector to a cluster on the volume's thread, since for a
+        volume with several extents that is an ioctl on the volume too."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.volume.sector_to_cluster, sector, disk_number)
+
+    def close(self):
+        self.executor.shutdown()
+        self.volume.close()
+
+
+class QueryServer:
+    """Answers queries against a set of ServedVolumes."""
+
+    def __init__(self, volumes):
+        self.volumes = volumes      # label -> ServedVolume
+        self.queries = 0
+        self.errors = 0
+        self.clients = 0
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self.answer(line, writer, lock))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def answer(self, line, writer, lock):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a query must be a JSON object')
+        except ValueError as e:
+            response = {'error': 'bad query: %s' % e}
+        else:
+            try:
+                response = await self.query(request)
+            except (KeyError, ValueError, TypeError) as e:
+                response = {'error': str(e)}
+            except IndexError:
+                response = {'error': 'sector or cluster out of range'}
+            except (OSError, VolumeError) as e:
+                logger.warning('Query %r failed: %s' % (request, e))
+                response = {'error': str(e)}
+            if 'id' in request:
+                response['id'] = request['id']
+        if 'error' in response:
+            self.errors += 1
+        async with lock:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+    async def query(self, request):
+        op = request.get('op', 'query')
+        if op == 'volumes':
+            return {'volumes': [served.describe() for served in self.volumes.values()]}
+        if op == 'stats':
+            return self.stats()
+        if op != 'query':
+            raise ValueError('unknown op %r' % op)
+        self.queries += 1
+        sector = int(request['sector'])
+        served, cluster = await self.locate(request, sector)
+        response = {'volume': served.label if served else None, 'sector': sector, 'cluster': cluster}
+        if cluster is None:
+            return response
+        lookup = served.call('lookup', cluster)
+        if request.get('read', True):
+            (in_use, files), read_result = await asyncio.gather(lookup, served.call('read', cluster))
+            response['read'] = read_result
+        else:
+            in_use, files = await lookup
+        response['in_use'] = in_use
+        response['files'] = files
+        return response
+
+    async def locate(self, request, sector):
+        """Returns (ServedVolume, cluster) for a query's sector; the cluster
+        is None if the sector isn't part of the volume (or any volume served
+        on the disk given)."""
+        if 'disk' in request:
+            disk_number = int(request['disk'])
+            for served in self.volumes.values():
+                cluster = await served.sector_to_cluster(sector, disk_number)
+                if cluster is not None:
+                    return served, cluster
+            return None, None
+        label = request.get('volume')
+        if label is None:
+            if len(self.volumes) != 1:
+                raise ValueError('"volume" is needed when more than one volume is served')
+            served = next(iter(self.volumes.values()))
+        else:
+            served = self.volumes.get(volume_label(label)) or self.volumes.get(label)
+            if served is None:
+                raise ValueError('volume %r is not being served' % label)
+        return served, await served.sector_to_cluster(sector)
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'errors': self.errors,
+            'clients': self.clients,
+            'volumes': {label: {
+                'calls': served.calls,
+                'coalesced': served.coalesced,
+                'bitmap_hits': served.bitmap.hits,
+                'bitmap_misses': served.bitmap.misses,
+                'files_checked': served.tracker.files_checked,
+                'full_refreshes': served.tracker.full_refreshes,
+            } for label, served in self.volumes.items()},
+        }
+
+
+def volume_label(drive_letter):
+    """'c', 'C:' and 'C:\\' are all served as 'C'."""
+    return drive_letter.rstrip(':\\').upper()
+
+
+async def serve(server, host, port, unix_path=None):
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle_client, unix_path)
+        where = unix_path
+    else:
+        listener = await asyncio.start_server(server.handle_client, host, port)
+        where = '%s:%s' % (host, port)
+    print('Serving %s volume(s) on %s' % (len(server.volumes), where))
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep volumes open and answer sector queries over a local socket.')
+    parser.add_argument('drive_letters', metavar='driveletter', nargs='*')
+    parser.add_argument('--image', metavar='FILE', action=ImageAction, dest='images', default=[],
+                        help='serve the NTFS volume in an image file (may be repeated).')
+    parser.add_argument('--mapfile', metavar='FILE', action=ImageAction, dest='images',
+                        help='ddrescue mapfile for the --image before it.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s).')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: %(default)s).')
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix domain socket instead (not on Windows).')
+    parser.add_argument('--slow-ms', metavar='MS', type=float, default=DEFAULT_SLOW_MS,
+                        help='report test reads taking longer than MS milliseconds as slow (default: %(default)s).')
+    parser.add_argument('--refresh-interval', metavar='SECONDS', type=float, default=1.0,
+                        help='most often to check the change journal for allocation changes '
+                             '(default: %(default)s).')
+    args = parser.parse_args()
+    if not args.drive_letters and not args.images:
+        parser.error('give at least one drive letter or --image')
+
+    volumes = {}
+    try:
+        for letter in args.drive_letters:
+            label = volume_label(letter)
+            volumes[label] = ServedVolume(label, Volume(label, unbuffered=True).open(), args.slow_ms, args.refresh_interval)
+        for path, mapfile in args.images:
+            volumes[path] = ServedVolume(path, NtfsImage(path, mapfile=mapfile).open(), args.slow_ms, args.refresh_interval)
+    except VolumeError as e:
+        print(e)
+        for served in volumes.values():
+            served.close()
+        return
+
+    try:
+        asyncio.run(serve(QueryServer(volumes), args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for served in volumes.values():
+            served.close()
+        print('Stopped.')
+
+
+if __name__ == '__main__':
+    main()
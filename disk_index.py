@@ -0,0 +1,203 @@
+"""Index of every volume extent on the system, for looking up sectors by
+physical disk number rather than by drive letter."""
+import bisect
+import ctypes
+import logging
+
+import volume as win_volume
+from volume import get_disk_extents
+from win_types import *
+
+logger = logging.getLogger(__name__)
+
+
+class IndexedVolume:
+    """One volume found by DiskExtentIndex.build()."""
+
+    def __init__(self, name, mount_points, extents):
+        self.name = name                    # Volume GUID path, \\?\Volume{...}\
+        self.mount_points = mount_points    # Drive letters and folder mount points, if any
+        self.extents = extents              # List of (disk number, starting offset, length)
+        self._cluster_size = None
+        self._handle = None
+
+    def __str__(self):
+        if self.mount_points:
+            return '%s (%s)' % (self.name, ', '.join(self.mount_points))
+        return '%s (no drive letter)' % self.name
+
+    @property
+    def cluster_size(self):
+        """Bytes per cluster, or 0 if the volume has no filesystem Windows recognises."""
+        if self._cluster_size is None:
+            kernel32 = win_volume.kernel32
+            spc = ctypes.c_ulong()
+            bps = ctypes.c_ulong()
+            cfree = ctypes.c_ulong()
+            ctotal = ctypes.c_ulong()
+            res = kernel32.GetDiskFreeSpaceW(self.name, ctypes.byref(spc), ctypes.byref(bps),
+                                             ctypes.byref(cfree), ctypes.byref(ctotal))
+            self._cluster_size = spc.value * bps.value if res else 0
+        return self._cluster_size
+
+    def volume_offset(self, disk_number, offset, extent):
+        """Maps a disk offset inside one of this volume's extents to a byte
+        offset within the volume."""
+        if len(self.extents) == 1:
+            return offset - extent[1]
+        # Striped and mirrored layouts aren't visible from the extent list, so ask the volume manager
+        kernel32 = win_volume.kernel32
+        if self._handle is None:
+            self._handle = kernel32.CreateFileW(self.name.rstrip('\\'), 0, 0x3, None, 0x3, 0, None)
+            if self._handle == INVALID_HANDLE:
+                self._handle = None
+                raise ctypes.WinError()
+        phys = VOLUME_PHYSICAL_OFFSET(DiskNumber=disk_number, Offset=offset)
+        logical = VOLUME_LOGICAL_OFFSET()
+        out_size = ctypes.c_ulong()
+        res = kernel32.DeviceIoControl(self._handle, IOCTL_VOLUME_PHYSICAL_TO_LOGICAL,
+                                       ctypes.byref(phys), ctypes.sizeof(phys),
+                                       ctypes.byref(logical), ctypes.sizeof(logical),
+                                       ctypes.byref(out_size), None)
+        if res == 0:
+            raise ctypes.WinError()
+        return logical.LogicalOffset
+
+    def close(self):
+        if self._handle is not None:
+            win_volume.kernel32.CloseHandle(self._handle)
+            self._handle = None
+
+
+class DiskExtentIndex:
+    """Every extent of every volume, kept sorted by starting offset for each
+    physical disk, so that a (disk number, offset) pair is found by binary
+    search.
+
+    Built once per run by build(), which enumerates all volumes, including
+    ones with no drive letter and ones spanning several extents or disks.
+    """
+
+    def __init__(self):
+        self.volumes = []
+        self._starts = {}       # disk number -> sorted list of extent starting offsets
+        self._extents = {}      # disk number -> list of (start, end, volume), same order
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        for name in enumerate_volumes():
+            handle = win_volume.kernel32.CreateFileW(name.rstrip('\\'), 0, 0x3, None, 0x3, 0, None)
+            if handle == INVALID_HANDLE:
+                logger.info('Could not open %s, skipping it' % name)
+                continue
+            try:
+                extents = get_disk_extents(handle)
+            except OSError as e:
+                # CD drives, RAM disks etc. have no disk extents
+                logger.info('No disk extents for %s (%s), skipping it' % (name, e))
+                continue
+            finally:
+                win_volume.kernel32.CloseHandle(handle)
+            index.add(IndexedVolume(name, get_mount_points(name), extents))
+        return index
+
+    def add(self, volume):
+        self.volumes.append(volume)
+        for extent in volume.extents:
+            disk_number, start, length = extent
+            starts = self._starts.setdefault(disk_number, [])
+            extents = self._extents.setdefault(disk_number, [])
+            i = bisect.bisect(starts, start)
+            starts.insert(i, start)
+            extents.insert(i, (start, start + length, volume, extent))
+
+    def disks(self):
+        return sorted(self._starts)
+
+    def find(self, disk_number, offset):
+        """Returns (volume, extent) for the extent holding a disk byte offset,
+        or None if the offset isn't inside any volume."""
+        starts = self._starts.get(disk_number)
+        if not starts:
+            return None
+        i = bisect.bisect(starts, offset) - 1
+        if i < 0:
+            return None
+        start, end, volume, extent = self._extents[disk_number][i]
+        if offset >= end:
+            return None
+        return volume, extent
+
+    def next_start(self, disk_number, offset):
+        """Returns the starting offset of the first extent after a disk
+        offset, or None if there isn't one."""
+        starts = self._starts.get(disk_number, [])
+        i = bisect.bisect(starts, offset)
+        return starts[i] if i < len(starts) else None
+
+    def locate(self, disk_number, offset):
+        """Resolves a disk byte offset to (volume, LCN). Returns None if the
+        offset isn't part of any volume, and (volume, None) if the volume has
+        no filesystem Windows recognises."""
+        found = self.find(disk_number, offset)
+        if found is None:
+            return None
+        volume, extent = found
+        if not volume.cluster_size:
+            return volume, None
+        return volume, volume.volume_offset(disk_number, offset, extent) // volume.cluster_size
+
+    def close(self):
+        for volume in self.volumes:
+            volume.close()
+
+
+def enumerate_volumes():
+    r"""Yields the GUID path (\\?\Volume{...}\) of every volume on the system."""
+    kernel32 = win_volume.kernel32
+    buf = ctypes.create_unicode_buffer(1024)
+    find = kernel32.FindFirstVolumeW(buf, len(buf))
+    if find == INVALID_HANDLE or find is None:
+        raise ctypes.WinError()
+    try:
+        while True:
+            yield buf.value
+            if not kernel32.FindNextVolumeW(find, buf, len(buf)):
+                err = kernel32.GetLastError()
+                if err != 18:       # ERROR_NO_MORE_FILES
+                    raise ctypes.WinError(err)
+                break
+    finally:
+        kernel32.FindVolumeClose(find)
+
+
+def get_mount_points(name):
+    """Returns the drive letters and mounted folders of a volume."""
+    buf = ctypes.create_unicode_buffer(1024)
+    out_len = ctypes.c_ulong()
+    res = win_volume.kernel32.GetVolumePathNamesForVolumeNameW(name, buf, len(buf), ctypes.byref(out_len))
+    if res == 0:
+        return []
+    # A list of null-terminated strings, ending with an empty one
+    return [path for path in buf[:out_len.value].split('\0') if path]
+
+
+def get_sector_size(disk_number):
+    r"""Returns the logical sector size of \\.\PhysicalDriveN, or 512 if it
+    can't be queried."""
+    kernel32 = win_volume.kernel32
+    handle = kernel32.CreateFileW(r'\\.\PhysicalDrive%s' % disk_number, 0, 0x3, None, 0x3, 0, None)
+    if handle == INVALID_HANDLE:
+        logger.warning('Could not open PhysicalDrive%s to get its sector size; assuming 512 bytes' % disk_number)
+        return 512
+    geometry = DISK_GEOMETRY()
+    out_size = ctypes.c_ulong()
+    res = kernel32.DeviceIoControl(handle, IOCTL_DISK_GET_DRIVE_GEOMETRY, None, 0,
+                                   ctypes.byref(geometry), ctypes.sizeof(geometry),
+                                   ctypes.byref(out_size), None)
+    kernel32.CloseHandle(handle)
+    if res == 0 or not geometry.BytesPerSector:
+        logger.warning('Could not get the sector size of PhysicalDrive%s; assuming 512 bytes' % disk_number)
+        return 512
+    return geometry.BytesPerSector
@@ -0,0 +1,266 @@
+"""Index of every file's extents on a volume, so that clusters can be mapped
+to files without a FSCTL_LOOKUP_STREAM_FROM_CLUSTER call per lookup."""
+import array
+import bisect
+import ctypes
+import logging
+import struct
+
+import volume as win_volume
+from volume import get_retrieval_pointers
+from win_types import *
+
+logger = logging.getLogger(__name__)
+
+FILE_ATTRIBUTE_DIRECTORY = 0x10
+FRN_MASK = (1 << 48) - 1    # File reference number without its sequence number
+
+_MAGIC = b'QSFIDX2\0'
+# magic, volume serial, USN journal ID, next USN, cluster size, total clusters, extents, files, name bytes
+_HEADER = struct.Struct('<8sQQQQQQQQ')
+
+
+class FileIndex:
+    """Sorted arrays of (starting LCN, length, file, starting VCN), one entry
+    per extent of every file on the volume.
+
+    Built once with build() from the MFT (through FSCTL_ENUM_USN_DATA) and
+    FSCTL_GET_RETRIEVAL_POINTERS on each file, then saved with save() so
+    later runs can load() it instead. A lookup is a binary search, and also
+    gives the byte offset of the cluster within its file.
+
+    The index records the volume's serial number and where its change
+    journal was when the index was built. catch_up() reads the journal from
+    there, and the files changed since are then left out of lookups.
+
+    Only the unnamed $DATA stream of files is indexed. Clusters that aren't
+    found (directories, alternate data streams, NTFS metadata, or files
+    changed since the index was built) are looked up on the volume instead,
+    if one is attached.
+    """
+
+    def __init__(self, cluster_size, total_clusters, starts, lengths, file_ids, vcns, names,
+                 frns=None, serial=0, journal_id=0, next_usn=0):
+        self.cluster_size = cluster_size
+        self.total_clusters = total_clusters
+        self.starts = starts        # array('q') of starting LCNs, ascending
+        self.lengths = lengths      # array('q') of extent lengths in clusters
+        self.file_ids = file_ids    # array('q') of indexes into names
+        self.vcns = vcns            # array('q') of the VCN each extent starts at
+        self.names = names
+        # array('q') of each file's reference number (0 if not known), to match journal records with
+        self.frns = frns if frns is not None else array.array('q', bytes(8 * len(names)))
+        self.serial = serial
+        self.journal_id = journal_id
+        self.next_usn = next_usn
+        self.stale = set()          # Ids of files changed since the index was built
+        self.volume = None          # For lookups the index can't answer
+
+    @classmethod
+    def build(cls, volume, progress_interval=10000):
+        """Enumerates every file on an open Volume and gathers its extents."""
+        # Where the journal is before enumerating, so changes made meanwhile are caught up on later
+        journal = volume.query_usn_journal()
+        paths = FilePaths()
+        files = []
+        for frn, parent, attributes, name in enumerate_mft(volume.handle):
+            paths.add(frn, parent, name)
+            if not attributes & FILE_ATTRIBUTE_DIRECTORY:
+                files.append(frn)
+        print('Found %s files; reading their extents...' % len(files))
+
+        extents = []    # (LCN, length, file id, VCN)
+        names = []
+        frns = array.array('q')
+        for i, frn in enumerate(files):
+            if i and i % progress_interval == 0:
+                print(' %s of %s files, %s extents' % (i, len(files), len(extents)))
+            handle = open_file_by_id(volume.handle, frn)
+            if handle is None:
+                continue
+            try:
+                file_extents = list(get_retrieval_pointers(handle))
+            except OSError as e:
+                logger.debug('No extents for %s: %s' % (paths.path(frn), e))
+                file_extents = []
+            finally:
+                win_volume.kernel32.CloseHandle(handle)
+            if not file_extents:
+                continue
+            file_id = len(names)
+            names.append(paths.path(frn))
+            frns.append(ctypes.c_longlong(frn).value)
+            extents.extend((lcn, length, file_id, vcn) for vcn, lcn, length in file_extents)
+        extents.sort()
+
+        index = cls(volume.cluster_size, volume.total_clusters,
+                    array.array('q', (e[0] for e in extents)), array.array('q', (e[1] for e in extents)),
+                    array.array('q', (e[2] for e in extents)), array.array('q', (e[3] for e in extents)),
+                    names, frns, volume.get_serial_number(),
+                    journal.UsnJournalID if journal is not None else 0, journal.NextUsn if journal is not None else 0)
+        print('Indexed %s extents of %s files.' % (len(extents), len(names)))
+        return index
+
+    def save(self, path):
+        names = '\0'.join(self.names).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, self.serial, self.journal_id, self.next_usn, self.cluster_size,
+                                 self.total_clusters, len(self.starts), len(self.names), len(names)))
+            for values in (self.starts, self.lengths, self.file_ids, self.vcns, self.frns):
+                values.tofile(f)
+            f.write(names)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with save(). Raises ValueError if the file
+        isn't one (or is from an older version), and EOFError if it was cut
+        short."""
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise EOFError('%s is truncated' % path)
+            (magic, serial, journal_id, next_usn, cluster_size, total_clusters, count, file_count,
+             name_bytes) = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                raise ValueError('%s is not a file index' % path)
+            columns = []
+            for size in (count, count, count, count, file_count):
+                values = array.array('q')
+                values.fromfile(f, size)    # EOFError if short
+                columns.append(values)
+            names = f.read(name_bytes)
+            if len(names) < name_bytes:
+                raise EOFError('%s is truncated' % path)
+            names = names.decode('utf-8').split('\0') if name_bytes else []
+        if len(names) != file_count:
+            raise ValueError('%s is corrupt' % path)
+        return cls(cluster_size, total_clusters, *columns[:4], names, columns[4], serial, journal_id, next_usn)
+
+    def matches(self, volume):
+        """True if the index was built from this volume: the serial number
+        and geometry are the same. See catch_up() for whether it is current."""
+        return (self.serial == volume.get_serial_number() and self.cluster_size == volume.cluster_size
+                and self.total_clusters == volume.total_clusters)
+
+    def catch_up(self, volume):
+        """Reads the volume's change journal from where it was when the index
+        was built, and marks the files changed since as stale, so that their
+        clusters are looked up on the volume instead. Returns False if that
+        can't be done (the journal isn't active, was recreated or no longer
+        goes back that far), in which case the index should be rebuilt.
+        Images never change, so their indexes are always current."""
+        if not hasattr(volume, 'query_usn_journal'):
+            return True
+        journal = volume.query_usn_journal()
+        if journal is None or journal.UsnJournalID != self.journal_id:
+            return False
+        if journal.NextUsn == self.next_usn:
+            return True
+        changes = volume.read_usn_changes(self.journal_id, self.next_usn, journal.NextUsn)
+        if changes is None:
+            return False
+        changed = set(ctypes.c_longlong(frn).value for frn in changes)
+        self.stale = set(file_id for file_id, frn in enumerate(self.frns) if frn in changed)
+        return True
+
+    def find(self, cluster):
+        """Returns (file name, byte offset of the cluster within the file),
+        or None if no indexed file uses the cluster."""
+        i = bisect.bisect(self.starts, cluster) - 1
+        if i < 0 or cluster >= self.starts[i] + self.lengths[i] or self.file_ids[i] in self.stale:
+            return None
+        return self.names[self.file_ids[i]], (self.vcns[i] + cluster - self.starts[i]) * self.cluster_size
+
+    def lookup_cluster_files(self, clusters):
+        """Same as Volume.lookup_cluster_files(), answered from the index
+        where possible. Names include the byte offset within the file."""
+        results = {}
+        missing = []
+        for cluster in clusters:
+            found = self.find(cluster)
+            if found is None:
+                missing.append(cluster)
+                continue
+            name, offset = found
+            results[cluster] = [(0x01000000, '%s (byte offset %s)' % (name, offset))]    # $DATA stream
+        if missing and self.volume is not None:
+            results.update(self.volume.lookup_cluster_files(missing))
+        return results
+
+
+class FilePaths:
+    """Parent links from the MFT, turned into full paths on demand."""
+
+    def __init__(self):
+        self.entries = {}   # file reference number -> (parent reference number, name)
+        self.dirs = {}      # Paths already worked out for directories
+
+    def add(self, frn, parent, name):
+        self.entries[frn & FRN_MASK] = (parent & FRN_MASK, name)
+
+    def path(self, frn):
+        frn &= FRN_MASK
+        entry = self.entries.get(frn)
+        if entry is None:
+            return ''
+        parent, name = entry
+        if parent == frn:   # The root directory is its own parent
+            return ''
+        if parent not in self.dirs:
+            self.dirs[parent] = self.path(parent)
+        return self.dirs[parent] + '\\' + name
+
+
+def enumerate_mft(handle, buffer_size=64 * 1024):
+    """Yields (file reference number, parent reference number, attributes,
+    name) for every file and directory on an open volume."""
+    kernel32 = win_volume.kernel32
+    med = MFT_ENUM_DATA_V0(StartFileReferenceNumber=0, LowUsn=0, HighUsn=0x7fffffffffffffff)
+    buf = ctypes.create_string_buffer(buffer_size)
+    out_size = ctypes.c_ulong()
+    while True:
+        res = kernel32.DeviceIoControl(
+            handle,
+            FSCTL_ENUM_USN_DATA,
+            ctypes.byref(med),
+            ctypes.sizeof(med),
+            buf,
+            ctypes.sizeof(buf),
+            ctypes.byref(out_size),
+            None,
+        )
+        if res == 0:
+            err = kernel32.GetLastError()
+            if err == 38:       # ERROR_HANDLE_EOF - no more files
+                return
+            logger.fatal('Failed to enumerate the MFT')
+            raise ctypes.WinError(err)
+        # The output starts with the reference number to continue from
+        offs = 8
+        while offs < out_size.value:
+            record = USN_RECORD_V2.from_buffer(buf, offs)
+            name = ctypes.wstring_at(ctypes.addressof(buf) + offs + record.FileNameOffset,
+                                     record.FileNameLength // ctypes.sizeof(ctypes.c_wchar))
+            yield record.FileReferenceNumber, record.ParentFileReferenceNumber, record.FileAttributes, name
+            offs += record.RecordLength
+        med.StartFileReferenceNumber = ctypes.c_ulonglong.from_buffer(buf).value
+
+
+def open_file_by_id(volume_handle, frn):
+    """Opens a file on the volume by its file reference number, with just
+    enough access to query its extents. Returns None if it can't be opened
+    (for example because it was deleted since it was enumerated)."""
+    kernel32 = win_volume.kernel32
+    desc = FILE_ID_DESCRIPTOR(dwSize=ctypes.sizeof(FILE_ID_DESCRIPTOR), Type=0, FileId=frn)
+    handle = kernel32.OpenFileById(
+        volume_handle,
+        ctypes.byref(desc),
+        0x80,           # FILE_READ_ATTRIBUTES
+        0x7,            # FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE
+        None,
+        0x02000000,     # FILE_FLAG_BACKUP_SEMANTICS
+    )
+    if handle == INVALID_HANDLE or handle is None:
+        logger.debug('Could not open file %s: error %s' % (frn, kernel32.GetLastError()))
+        return None
+    return handle
@@ -0,0 +1,270 @@
+"""Scans many volumes at once, in parallel across physical disks but one at a
+time on each disk.
+
+Volumes are grouped by the disk numbers of their extents (volumes spanning
+several disks join those disks into one group), and each group is scanned
+by its own worker process, one volume after another, so two volumes on the
+same spindle never compete for the heads while separate disks all run at
+full speed. Image files stand in for disks: every NTFS volume in the same
+image is in the same group.
+
+    python fleet.py C D --disk 2 --disk 3 --free-only --report fleet.json
+    python fleet.py --image sda.img --mapfile sda.map --image sdb.img
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import time
+import traceback
+
+from bitmap import VolumeBitmap
+from changes import ChangeTracker
+from disk_index import DiskExtentIndex
+from ntfs_image import NtfsImage
+from probe import DEFAULT_SLOW_MS
+from query_sector import format_stream_flags, print_results, resolve_findings, runs_to_scan
+from scan import SurfaceScan
+from volume import Volume, VolumeError
+
+class ScanTarget:
+    """One volume to scan, and the disks it sits on. Either `volume_name`
+    (a mounted volume's GUID path) or `image` is set; an image with no
+    `partition` means every NTFS volume in it."""
+
+    def __init__(self, label, disks, volume_name=None, image=None, partition=None, mapfile=None):
+        self.label = label
+        self.disks = disks
+        self.volume_name = volume_name
+        self.image = image
+        self.partition = partition
+        self.mapfile = mapfile
+
+    def backend(self, partition=None):
+        if self.image is not None:
+            return NtfsImage(self.image, partition or self.partition, self.mapfile)
+        return Volume(self.volume_name, unbuffered=True)
+
+
+def find_targets(drive_letters=(), disk_numbers=(), images=()):
+    """Returns the ScanTargets for the given drive letters, every volume on
+    the given physical disks, and the given (image path, mapfile) pairs."""
+    targets = []
+    if drive_letters or disk_numbers:
+        index = DiskExtentIndex.build()
+        seen = set()
+        for letter in drive_letters:
+            mount_point = '%s:\\' % letter.rstrip(':\\').upper()
+            matches = [v for v in index.volumes if mount_point in v.mount_points]
+            if not matches:
+                raise VolumeError('No volume is mounted at %s' % mount_point)
+            for volume in matches:
+                if volume.name not in seen:
+                    seen.add(volume.name)
+                    targets.append(ScanTarget(str(volume), sorted(set('PhysicalDisk%s' % e[0] for e in volume.extents)),
+                                              volume_name=volume.name))
+        for disk_number in disk_numbers:
+            found = [v for v in index.volumes if any(e[0] == disk_number for e in v.extents)]
+            if not found:
+                raise VolumeError('No volumes found on disk %s' % disk_number)
+            for volume in found:
+                if volume.name not in seen:
+                    seen.add(volume.name)
+                    targets.append(ScanTarget(str(volume), sorted(set('PhysicalDisk%s' % e[0] for e in volume.extents)),
+                                              volume_name=volume.name))
+        index.close()
+    for path, mapfile in images:
+        targets.append(ScanTarget(path, [os.path.realpath(path)], image=path, mapfile=mapfile))
+    return targets
+
+
+def group_by_disk(targets):
+    """Splits targets into groups that share no disk, keeping their order."""
+    groups = []     # [(set of disks, [targets])]
+    for target in targets:
+        disks = set(target.disks)
+        joined = [group for group in groups if group[0] & disks]
+        merged = (disks.union(*(group[0] for group in joined)),
+                  [t for group in joined for t in group[1]] + [target])
+        groups = [group for group in groups if group not in joined] + [merged]
+    return [members for disks, members in groups]
+
+
+def scan_group(targets, options):
+    """Scans each target in turn; runs in a worker process. Returns a list
+    of result dicts for each target, one per volume scanned."""
+    results = []
+    for target in targets:
+        result, partitions = scan_target(target, options)
+        results.append([result])
+        if target.image is not None and target.partition is None and partitions and partitions > 1:
+            # A whole-disk image: go on to its other NTFS volumes
+            result['target'] = '%s partition 1' % target.label
+            for partition in range(2, partitions + 1):
+                results[-1].append(scan_target(target, options, partition)[0])
+    return results
+
+
+def scan_target(target, options, partition=None):
+    """Scans one volume. Returns (result dict, number of NTFS volumes in the
+    image, or None)."""
+    volume = target.backend(partition)
+    label = target.label if partition is None else '%s partition %s' % (target.label, partition)
+    result = {'target': label, 'disks': target.disks, 'error': None, 'rows': []}
+    output = io.StringIO()      # Workers' prints would interleave; keep them for errors only
+    started = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(output):
+            volume.open()
+            try:
+                tracker = ChangeTracker(volume).start()
+                bitmap, starts, lengths = runs_to_scan(volume, VolumeBitmap(volume), 0,
+                                                       volume.total_clusters - 1, options.free_only)
+                surface_scan = SurfaceScan(volume, options.chunk_size * 1024 * 1024, options.queue_depth,
+                                           options.slow_ms)
+                try:
+                    findings = surface_scan.scan_runs(starts, lengths)
+                finally:
+                    surface_scan.close()
+                tracker.refresh(bitmap)
+                result['rows'] = resolve_findings(volume, bitmap, findings, surface_scan.slow,
+                                                  slow_ms=options.slow_ms)
+            finally:
+                volume.close()
+    except (OSError, VolumeError) as e:
+        result['error'] = str(e)
+        result['log'] = output.getvalue()
+        return result, getattr(volume, 'partitions', None)
+    except Exception as e:
+        # A bug shouldn't take the rest of the group (or the fleet) down with it
+        result['error'] = 'unexpected %s: %s' % (type(e).__name__, e)
+        result['log'] = output.getvalue() + traceback.format_exc()
+        return result, getattr(volume, 'partitions', None)
+    seconds = time.monotonic() - started
+    result.update({
+        'cluster_size': volume.cluster_size,
+        'total_clusters': volume.total_clusters,
+        'clusters_scanned': int(sum(lengths)),
+        'reads': surface_scan.reads,
+        'bytes_read': surface_scan.bytes_read,
+        'seconds': seconds,
+        'unreadable': len(findings),
+        'slow': len(surface_scan.slow),
+    })
+    return result, getattr(volume, 'partitions', None)
+
+
+def run_fleet(targets, options, processes=None):
+    """Scans every target, one worker process per group of targets sharing a
+    disk. Returns the results of all the volumes, in the order given."""
+    groups = group_by_disk(targets)
+    print('Scanning %s target(s) on %s independent disk group(s)...' % (len(targets), len(groups)))
+    results = {}    # id(target) -> its results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(groups)) as executor:
+        futures = {executor.submit(scan_group, group, options): group for group in groups}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                group_results = future.result()
+            except Exception as e:
+                # The worker itself failed (or died), so none of its targets have results
+                group_results = [[{'target': target.label, 'disks': target.disks, 'rows': [],
+                                   'error': 'worker failed: %s: %s' % (type(e).__name__, e)}]
+                                 for target in futures[future]]
+            for target, target_results in zip(futures[future], group_results):
+                for result in target_results:
+                    print(' Finished %s' % summary(result))
+                results[id(target)] = target_results
+    return [result for target in targets for result in results[id(target)]]
+
+
+def summary(result):
+    if result['error']:
+        return '%s: failed: %s' % (result['target'], result['error'])
+    return ('%s: %s clusters in %.0f s (%.1f MB/s), %s unreadable, %s slow'
+            % (result['target'], result['clusters_scanned'], result['seconds'],
+               result['bytes_read'] / max(result['seconds'], 1e-6) / 1e6, result['unreadable'], result['slow']))
+
+
+def report_json(results):
+    """The merged results in a JSON-friendly form."""
+    volumes = []
+    for result in results:
+        entry = dict(result)
+        entry['rows'] = [{
+            'first_sector': first,
+            'last_sector': last,
+            'cluster': cluster,
+            'in_use': used,
+            'files': ['%s%s' % (format_stream_flags(flags), name) for flags, name in files],
+            'read': read_result,
+        } for first, last, cluster, used, files, read_result in result['rows']]
+        volumes.append(entry)
+    return {
+        'volumes': volumes,
+        'unreadable': sum(result.get('unreadable', 0) for result in results),
+        'slow': sum(result.get('slow', 0) for result in results),
+        'failed': sum(1 for result in results if result['error']),
+    }
+
+
+class ImageAction(argparse.Action):
+    """--image FILE, optionally followed by --mapfile FILE for that image."""
+
+    def __call__(self, parser, namespace, value, option_string=None):
+        images = getattr(namespace, 'images', None) or []
+        if option_string == '--image':
+            images.append([value, None])
+        elif not images or images[-1][1] is not None:
+            parser.error('--mapfile must follow the --image it belongs to')
+        else:
+            images[-1][1] = value
+        namespace.images = images
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan many volumes in parallel, one process per physical disk.')
+    parser.add_argument('drive_letters', metavar='driveletter', nargs='*')
+    parser.add_argument('--disk', metavar='N', type=int, action='append', default=[],
+                        help='scan every volume on physical disk N (may be repeated).')
+    parser.add_argument('--image', metavar='FILE', action=ImageAction, dest='images', default=[],
+                        help='scan the NTFS volumes in an image file, as if it were a disk (may be repeated).')
+    parser.add_argument('--mapfile', metavar='FILE', action=ImageAction, dest='images',
+                        help='ddrescue mapfile for the --image before it.')
+    parser.add_argument('--free-only', action='store_true', help='only read the free clusters.')
+    parser.add_argument('--chunk-size', metavar='MB', type=int, default=4,
+                        help='size of each read (default: %(default)s MB).')
+    parser.add_argument('--queue-depth', metavar='N', type=int, default=1,
+                        help='reads in flight on each disk (default: %(default)s).')
+    parser.add_argument('--slow-ms', metavar='MS', type=float, default=DEFAULT_SLOW_MS,
+                        help='report reads slower than MS milliseconds (default: %(default)s; 0 turns this off).')
+    parser.add_argument('--processes', metavar='N', type=int,
+                        help='most disk groups to scan at once (default: all of them).')
+    parser.add_argument('--report', metavar='FILE', help='write the merged results as JSON to FILE.')
+    args = parser.parse_args()
+
+    try:
+        targets = find_targets(args.drive_letters, args.disk, args.images)
+    except VolumeError as e:
+        print(e)
+        return
+    if not targets:
+        parser.error('give at least one drive letter, --disk or --image')
+
+    results = run_fleet(targets, args, args.processes)
+    print()
+    for result in results:
+        print(summary(result))
+        print_results(result['rows'])
+    report = report_json(results)
+    print('%s unreadable and %s slow cluster(s) on %s volume(s); %s failed.'
+          % (report['unreadable'], report['slow'], len(results), report['failed']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Wrote report to %s' % args.report)
+
+
+if __name__ == '__main__':
+    main()
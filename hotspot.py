@@ -0,0 +1,102 @@
+"""Adaptive scanning around known bad sectors.
+
+Damage on a platter usually covers an area rather than a single sector, so
+instead of reading the whole volume, the clusters either side of each known
+bad one are read outward from it. Reads start at one cluster and double in
+size while they keep succeeding, so clean surface is crossed quickly; a read
+that fails is narrowed down to its bad clusters as in a surface scan, and
+the reads after it start small again, so that where the damage is dense it
+is mapped cluster by cluster. Each direction stops once `margin` clean
+clusters in a row have been read past the last damage found.
+"""
+import logging
+
+from probe import DEFAULT_SLOW_MS
+from scan import SurfaceScan
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MARGIN = 256    # Clean clusters needed either side of the damage (1 MB with 4 KB clusters)
+
+
+class HotspotScan:
+    """Explores the damaged areas around seed clusters, keeping what it
+    finds in a SurfaceScan's `findings` and `slow` lists.
+
+    `areas` gets a tuple for each area explored of (first seed cluster,
+    last seed cluster, first cluster read, last cluster read, [damaged
+    clusters]), where the damaged clusters are those unreadable or slow.
+    """
+
+    def __init__(self, volume, margin=DEFAULT_MARGIN, chunk_size=4 * 1024 * 1024, slow_ms=DEFAULT_SLOW_MS):
+        self.volume = volume
+        self.margin = max(1, margin)
+        self.scan = SurfaceScan(volume, chunk_size, 1, slow_ms)
+        self.areas = []
+
+    @property
+    def findings(self):
+        return self.scan.findings
+
+    @property
+    def slow(self):
+        return self.scan.slow
+
+    def explore(self, seeds):
+        """Explores around each (first, last) range of seed clusters, in LCN
+        order. A seed inside an area already read adds nothing, and areas
+        don't read into the ones before them."""
+        floor = 0
+        for first, last in sorted(seeds):
+            if self.areas and last <= self.areas[-1][3]:
+                continue
+            first = max(first, floor)
+            damaged = self.read(first, last + 1 - first)
+            high = self.expand(last + 1, 1, self.volume.total_clusters - 1, damaged)
+            low = self.expand(first - 1, -1, floor, damaged)
+            self.areas.append((first, last, low, high, sorted(damaged)))
+            floor = high + 1
+        return self.areas
+
+    def expand(self, start, direction, limit, damaged):
+        """Reads outward from cluster `start` (upward with a direction of 1,
+        downward with -1, as far as `limit`) until `margin` clean clusters
+        in a row have been read. Adds the damaged clusters found to
+        `damaged` and returns the last cluster read."""
+        pos = start
+        size = 1
+        clean = 0
+        while clean < self.margin and (pos - limit) * direction <= 0:
+            count = min(size, self.scan.chunk_clusters, self.margin - clean, abs(limit - pos) + 1)
+            first = pos if direction > 0 else pos - count + 1
+            found = self.read(first, count)
+            if found:
+                damaged.update(found)
+                # Only the clean clusters beyond the last damage count towards the margin
+                clean = first + count - 1 - max(found) if direction > 0 else min(found) - first
+                size = 1
+            else:
+                clean += count
+                size *= 2
+            pos += direction * count
+        return pos - direction
+
+    def read(self, first, count):
+        """Reads clusters first..first+count-1, in chunks, narrowing any
+        failed or slow chunk down to its clusters. Returns the set of
+        clusters found unreadable or slow."""
+        scan = self.scan
+        found, slow = len(scan.findings), len(scan.slow)
+        end = first + count
+        for start in range(first, end, scan.chunk_clusters):
+            length = min(scan.chunk_clusters, end - start)
+            err, ms = scan.read_clusters(start, length)
+            if err:
+                scan.bisect(start, length, err)
+            elif scan.is_slow(length * self.volume.cluster_size, ms):
+                scan.bisect_slow(start, length)
+        return (set(cluster for cluster, err, sectors in scan.findings[found:])
+                | set(cluster for cluster, sectors in scan.slow[slow:]))
+
+    def close(self):
+        self.scan.close()
@@ -0,0 +1,203 @@
+"""Counters and latency histograms for the tool's disk I/O.
+
+Nothing is recorded unless enable() has been called; until then the only
+cost on each read or ioctl is a check that `recorder` is None. Once
+enabled, every raw read and every DeviceIoControl call is recorded by
+operation type (count, bytes, errors and a histogram of latencies in
+power-of-two microsecond buckets), and read latencies are also summed per
+fixed-size slice of the disk to give a heatmap of slow areas.
+"""
+import csv
+import json
+import logging
+import os
+import threading
+import time
+
+import volume as win_volume
+import win_types
+
+logger = logging.getLogger(__name__)
+
+recorder = None     # The IoStats everything records into, once enabled
+
+HISTOGRAM_BUCKETS = 32  # Bucket i counts latencies below 2**i microseconds; the last catches the rest
+
+# ioctl code -> name, for labelling DeviceIoControl calls
+IOCTL_NAMES = {getattr(win_types, name): name for name in dir(win_types)
+               if name.startswith(('FSCTL_', 'IOCTL_'))}
+
+
+class OpStats:
+    """Totals for one type of operation."""
+    __slots__ = ('count', 'bytes', 'errors', 'total_us', 'max_us', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+
+class IoStats:
+    """Per-operation totals and a read latency heatmap for one run.
+
+    `heatmap_bucket` is the size in bytes of each slice of the disk in the
+    heatmap; disk offsets are those of the read on the physical disk (or in
+    the image file). Volumes spanning several extents have no single disk
+    offset, so their reads are placed by their offset within the volume.
+    """
+
+    def __init__(self, heatmap_bucket=1 << 30):
+        self.heatmap_bucket = heatmap_bucket
+        self.ops = {}       # Operation name -> OpStats
+        self.heatmap = {}   # Slice number -> [reads, total microseconds, max microseconds]
+        self.started = time.time()
+        self.lock = threading.Lock()    # Reads come from several threads with a ThreadPoolReader
+        self.timer = None
+
+    def record(self, op, seconds, size=0, err=0, disk_offset=None):
+        """Records one operation that took `seconds`."""
+        us = int(seconds * 1e6)
+        with self.lock:
+            stats = self.ops.get(op)
+            if stats is None:
+                stats = self.ops[op] = OpStats()
+            stats.count += 1
+            stats.bytes += size
+            if err:
+                stats.errors += 1
+            stats.total_us += us
+            if us > stats.max_us:
+                stats.max_us = us
+            stats.histogram[min(us.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+            if disk_offset is not None:
+                cell = self.heatmap.get(disk_offset // self.heatmap_bucket)
+                if cell is None:
+                    cell = self.heatmap[disk_offset // self.heatmap_bucket] = [0, 0, 0]
+                cell[0] += 1
+                cell[1] += us
+                if us > cell[2]:
+                    cell[2] = us
+
+    def to_dict(self):
+        with self.lock:
+            ops = {op: {
+                'count': s.count,
+                'bytes': s.bytes,
+                'errors': s.errors,
+                'total_ms': s.total_us / 1000.0,
+                'max_ms': s.max_us / 1000.0,
+                # Trailing empty buckets left off
+                'histogram_us': histogram_dict(s.histogram),
+            } for op, s in sorted(self.ops.items())}
+            heatmap = [{
+                'disk_offset': bucket * self.heatmap_bucket,
+                'reads': reads,
+                'mean_ms': total_us / reads / 1000.0,
+                'max_ms': max_us / 1000.0,
+            } for bucket, (reads, total_us, max_us) in sorted(self.heatmap.items())]
+        return {
+            'elapsed_seconds': time.time() - self.started,
+            'operations': ops,
+            'heatmap_bucket_bytes': self.heatmap_bucket,
+            'heatmap': heatmap,
+        }
+
+    def write(self, path):
+        """Writes the stats to `path`: JSON, or CSV if it ends in .csv (with
+        the heatmap in a second file, <name>_heatmap.csv)."""
+        data = self.to_dict()
+        tmp_path = path + '.tmp'
+        if path.lower().endswith('.csv'):
+            write_csv(tmp_path, data)
+            heatmap_path = path[:-4] + '_heatmap.csv'
+            write_heatmap_csv(heatmap_path + '.tmp', data)
+            os.replace(heatmap_path + '.tmp', heatmap_path)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def start_timer(self, path, interval):
+        """Rewrites the stats file every `interval` seconds until stop_timer()."""
+        def tick():
+            try:
+                self.write(path)
+            except OSError as e:
+                logger.warning('Could not write I/O stats to %s: %s' % (path, e))
+            with self.lock:
+                if self.timer is None:      # Stopped during the write
+                    return
+                self.timer = threading.Timer(interval, tick)
+                self.timer.daemon = True
+                self.timer.start()
+        self.timer = threading.Timer(interval, tick)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop_timer(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+def histogram_dict(histogram):
+    """Returns {'<N': count} for each power-of-two bucket up to the last one used."""
+    used = max((i for i, n in enumerate(histogram) if n), default=-1) + 1
+    labels = ['<%d' % (1 << i) for i in range(HISTOGRAM_BUCKETS - 1)] + ['>=%d' % (1 << (HISTOGRAM_BUCKETS - 2))]
+    return dict(zip(labels[:used], histogram[:used]))
+
+
+def write_csv(path, data):
+    labels = ['<%dus' % (1 << i) for i in range(HISTOGRAM_BUCKETS)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['operation', 'count', 'bytes', 'errors', 'total_ms', 'max_ms'] + labels[:-1] + ['more'])
+        for op, s in data['operations'].items():
+            histogram = list(s['histogram_us'].values())
+            writer.writerow([op, s['count'], s['bytes'], s['errors'], '%.3f' % s['total_ms'], '%.3f' % s['max_ms']]
+                            + histogram + [0] * (HISTOGRAM_BUCKETS - len(histogram)))
+
+
+def write_heatmap_csv(path, data):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['disk_offset', 'reads', 'mean_ms', 'max_ms'])
+        for cell in data['heatmap']:
+            writer.writerow([cell['disk_offset'], cell['reads'], '%.3f' % cell['mean_ms'], '%.3f' % cell['max_ms']])
+
+
+class InstrumentedKernel32:
+    """Stands in for kernel32, timing every DeviceIoControl call and passing
+    everything else straight through."""
+
+    def __init__(self, kernel32, stats):
+        self._kernel32 = kernel32
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._kernel32, name)
+
+    def DeviceIoControl(self, handle, code, in_buf, in_size, out_buf, out_size, returned, overlapped):
+        started = time.perf_counter()
+        res = self._kernel32.DeviceIoControl(handle, code, in_buf, in_size, out_buf, out_size, returned, overlapped)
+        elapsed = time.perf_counter() - started
+        err = 0 if res else self._kernel32.GetLastError()
+        if err == 234:      # ERROR_MORE_DATA - the buffer was filled
+            err = 0
+        size = returned._obj.value if hasattr(returned, '_obj') else 0
+        self._stats.record(IOCTL_NAMES.get(code, hex(code)), elapsed, size, err)
+        return res
+
+
+def enable(heatmap_bucket=1 << 30):
+    """Starts recording, and returns the IoStats everything is recorded into."""
+    global recorder
+    recorder = IoStats(heatmap_bucket)
+    if win_volume.kernel32 is not None:
+        win_volume.kernel32 = InstrumentedKernel32(win_volume.kernel32, recorder)
+    return recorder
@@ -0,0 +1,489 @@
+"""Read-only access to an NTFS volume inside a disk or partition image (for
+example one taken with ddrescue), without Windows.
+
+The image is memory-mapped and only the parts that are needed are touched:
+opening it reads the partition table, the boot sector and two MFT records,
+bitmap windows are slices of the mapping, and the MFT is only scanned as
+far as it takes to find the files using the clusters asked about.
+"""
+import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+
+import iostats
+from file_index import FileIndex
+from volume import VolumeBackend, VolumeError
+
+logger = logging.getLogger(__name__)
+
+ATTR_ATTRIBUTE_LIST = 0x20
+ATTR_FILE_NAME = 0x30
+ATTR_DATA = 0x80
+ATTR_INDEX_ALLOCATION = 0xa0
+ATTR_END = 0xffffffff
+
+RECORD_MFT = 0
+RECORD_BITMAP = 6
+RECORD_ROOT = 5
+FIRST_USER_RECORD = 24      # Records below this are NTFS metadata
+FRN_MASK = (1 << 48) - 1
+
+# Flags as FSCTL_LOOKUP_STREAM_FROM_CLUSTER reports them, so results print the same
+FLAG_FS_SYSTEM = 0x4
+STREAM_DATA = 0x01000000
+STREAM_INDEX = 0x02000000
+STREAM_OTHER = 0x03000000
+
+MEDIA_ERROR = 23    # ERROR_CRC, for areas a ddrescue mapfile says weren't recovered
+
+
+class NtfsImage(VolumeBackend):
+    """An NTFS volume in an image file or block device.
+
+    `partition` picks which NTFS volume to use (1 for the first) when the
+    image holds a whole disk with several. A ddrescue `mapfile`, if given,
+    marks the areas that were never read successfully; reads that touch
+    them fail as they would on the original disk.
+    """
+
+    def __init__(self, path, partition=None, mapfile=None):
+        self.path = path
+        self.name = path
+        self.partition = partition
+        self.mapfile = mapfile
+        self.partitions = None      # How many NTFS volumes the image holds
+        self.mapping = None
+        self.view = None
+        self.extents = None
+        self.disk_number = 0
+        self.start = None
+        self.end = None
+        self.bytes_per_sector = None
+        self.cluster_size = None
+        self.total_clusters = None
+        self.record_size = None
+        self.serial = None
+        self.mft_runs = None        # [(VCN, LCN, length)] of $MFT's data
+        self.mft_records = None
+        self.bitmap_runs = None     # [(VCN, LCN, length)] of $Bitmap's data
+        self.bad_starts = []        # Sorted image offsets of unrecovered areas ...
+        self.bad_ends = []          # ... and where each one ends
+        self._scan_pos = 0          # Next MFT record lookup_cluster_files() would scan
+        self._seen = []             # (LCN, length, record, attribute type, attribute name, VCN) found so far
+        self._dir_paths = {}
+
+    def open(self):
+        print("Opening image %s..." % self.path)
+        fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)     # st_size is 0 for block devices
+            if size == 0:
+                raise VolumeError('%s is empty' % self.path)
+            self.mapping = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.view = memoryview(self.mapping)
+
+        volumes = find_ntfs_volumes(self.view)
+        if not volumes:
+            raise VolumeError('No NTFS volume found in %s' % self.path)
+        self.partitions = len(volumes)
+        if len(volumes) > 1 and self.partition is None:
+            print(" Image has %s NTFS volumes, at offsets %s; using the first"
+                  % (len(volumes), ', '.join(str(offset) for offset in volumes)))
+        index = (self.partition or 1) - 1
+        if not 0 <= index < len(volumes):
+            raise VolumeError('Image has no NTFS volume number %s' % self.partition)
+        self._read_boot_sector(volumes[index])
+        print(" Volume starts at image offset %s, %s bytes" % (self.start, self.end - self.start))
+        print("  %s bytes per sector, %s sectors per cluster (%s bytes per cluster)"
+              % (self.bytes_per_sector, self.cluster_size // self.bytes_per_sector, self.cluster_size))
+
+        self.mft_runs = self._mft_runs()
+        self.mft_records = sum(length for vcn, lcn, length in self.mft_runs) * self.cluster_size // self.record_size
+        self.bitmap_runs = self._data_runs(self.read_record(RECORD_BITMAP))
+        if self.mapfile:
+            self._read_mapfile(self.mapfile)
+        return self
+
+    def close(self):
+        self.view = None
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass    # Slices handed out (bitmap windows) keep it mapped until they are dropped
+        self.mapping = None
+
+    def get_serial_number(self):
+        # Windows reports the low half of the 64-bit serial in the boot sector
+        return self.serial & 0xffffffff
+
+    def _read_boot_sector(self, offset):
+        boot = self.view[offset:offset + 512]
+        self.bytes_per_sector, sectors_per_cluster = struct.unpack_from('<HB', boot, 11)
+        if sectors_per_cluster > 0x80:      # Stored as a negative power of two for large clusters
+            sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+        total_sectors, mft_lcn = struct.unpack_from('<QQ', boot, 0x28)
+        clusters_per_record = struct.unpack_from('<b', boot, 0x40)[0]
+        self.cluster_size = self.bytes_per_sector * sectors_per_cluster
+        self.record_size = (clusters_per_record * self.cluster_size if clusters_per_record > 0
+                            else 1 << -clusters_per_record)
+        self.total_clusters = total_sectors // sectors_per_cluster
+        self.mft_lcn = mft_lcn
+        self.serial = struct.unpack_from('<Q', boot, 0x48)[0]
+        self.start = offset
+        self.end = offset + self.total_clusters * self.cluster_size
+        self.extents = [(self.disk_number, self.start, self.end - self.start)]
+
+    def _mft_runs(self):
+        """Finds $MFT's own runs, starting from the record at the LCN in the
+        boot sector and following its attribute list if it has one."""
+        self.mft_runs = [(0, self.mft_lcn, -(-self.record_size // self.cluster_size))]
+        record = self.read_record(RECORD_MFT)
+        if record is None:
+            raise VolumeError('MFT record 0 at LCN %s is damaged' % self.mft_lcn)
+        runs = self._data_runs(record)
+        self.mft_runs = runs
+        extensions = set()
+        for attr_type, offs in iter_attributes(record):
+            if attr_type != ATTR_ATTRIBUTE_LIST:
+                continue
+            for entry_type, ref in iter_attribute_list(self._attribute_value(record, offs)):
+                if entry_type == ATTR_DATA and ref & FRN_MASK not in extensions | {RECORD_MFT}:
+                    extensions.add(ref & FRN_MASK)
+                    # Later pieces of the runlist are found with the earlier ones
+                    runs = sorted(runs + self._data_runs(self.read_record(ref & FRN_MASK) or b''))
+                    self.mft_runs = runs
+        return runs
+
+    def _data_runs(self, record):
+        """Runs of a record's unnamed $DATA attribute(s)."""
+        if not record:
+            return []
+        runs = []
+        for attr_type, offs in iter_attributes(record):
+            if attr_type == ATTR_DATA and record[offs + 8] and not record[offs + 9]:
+                runs.extend(decode_runlist(record, offs))
+        return sorted(runs)
+
+    def _attribute_value(self, record, offs):
+        """The value of a resident attribute, or the data of a non-resident one."""
+        if not record[offs + 8]:
+            length, value_offs = struct.unpack_from('<IH', record, offs + 16)
+            return bytes(record[offs + value_offs:offs + value_offs + length])
+        size = struct.unpack_from('<Q', record, offs + 48)[0]
+        return bytes(read_runs(self.view, self.start, self.cluster_size, decode_runlist(record, offs), 0, size))
+
+    def read_record(self, number):
+        """Returns MFT record `number` with its update sequence fixups
+        applied, or None if it isn't a valid record."""
+        record = bytearray(read_runs(self.view, self.start, self.cluster_size, self.mft_runs,
+                                     number * self.record_size, self.record_size))
+        if record[:4] != b'FILE' or not apply_fixups(record):
+            return None
+        return record
+
+    def _read_mapfile(self, path):
+        """Loads the areas a ddrescue mapfile doesn't mark as rescued ('+')."""
+        with open(path) as f:
+            lines = [line.split() for line in f if line.strip() and not line.startswith('#')]
+        # The first line is the current position and status; the rest are blocks
+        for fields in lines[1:]:
+            if len(fields) >= 3 and fields[2] != '+':
+                pos, size = int(fields[0], 0), int(fields[1], 0)
+                if self.bad_starts and self.bad_ends[-1] == pos:
+                    self.bad_ends[-1] = pos + size
+                else:
+                    self.bad_starts.append(pos)
+                    self.bad_ends.append(pos + size)
+        print(" %s unrecovered area(s) in mapfile" % len(self.bad_starts))
+
+    def read_at(self, offset, buf, size):
+        stats = iostats.recorder
+        if stats is not None:
+            started = time.perf_counter()
+        offset += self.start
+        i = bisect.bisect(self.bad_starts, offset + size - 1) - 1
+        if i >= 0 and self.bad_ends[i] > offset:
+            err, size = MEDIA_ERROR, 0
+        else:
+            err, size = 0, max(0, min(size, len(self.view) - offset))
+            memoryview(buf).cast('B')[:size] = self.view[offset:offset + size]
+        if stats is not None:
+            stats.record('read', time.perf_counter() - started, size, err, offset)
+        return err, size
+
+    def read_bitmap(self, start_lcn, size):
+        start_lcn &= ~7
+        bitmap_bytes = (self.total_clusters + 7) // 8
+        size = max(0, min(size, bitmap_bytes - start_lcn // 8))
+        return start_lcn, read_runs(self.view, self.start, self.cluster_size, self.bitmap_runs,
+                                    start_lcn // 8, size)
+
+    def load_bitmap(self):
+        bitmap_bytes = (self.total_clusters + 7) // 8
+        print("Loading volume bitmap (%s bytes)..." % bitmap_bytes)
+        bm_buf = bytearray(struct.pack('<QQ', 0, self.total_clusters))
+        bm_buf += read_runs(self.view, self.start, self.cluster_size, self.bitmap_runs, 0, bitmap_bytes)
+        return bm_buf
+
+    def iter_extents(self, first=0, last=None):
+        """Yields (LCN, length, record, attribute type, attribute name, VCN)
+        for every allocated run of every attribute in MFT records first..last.
+        Extension records are reported under their base record."""
+        if last is None:
+            last = self.mft_records - 1
+        for number in range(first, last + 1):
+            record = self.read_record(number)
+            if record is None or not record[0x16] & 1:      # Not in use
+                continue
+            base = struct.unpack_from('<Q', record, 0x20)[0] & FRN_MASK or number
+            for attr_type, offs in iter_attributes(record):
+                if not record[offs + 8]:
+                    continue
+                name = attribute_name(record, offs)
+                for vcn, lcn, length in decode_runlist(record, offs):
+                    yield lcn, length, base, attr_type, name, vcn
+
+    def iter_tree_files(self, root):
+        """`root` is a path within the volume, such as \\Users\\me (or
+        /Users/me). The whole MFT is scanned for the files under it."""
+        root = '\\' + root.replace('/', '\\').strip('\\').lower()
+        prefix = root.rstrip('\\') + '\\'
+        files = {}      # Base record -> [size, extents]
+        for number in range(self.mft_records):
+            record = self.read_record(number)
+            if record is None or not record[0x16] & 1:      # Not in use
+                continue
+            base = struct.unpack_from('<Q', record, 0x20)[0] & FRN_MASK or number
+            for attr_type, offs in iter_attributes(record):
+                if attr_type != ATTR_DATA or attribute_name(record, offs):
+                    continue
+                entry = files.setdefault(base, [0, []])
+                if not record[offs + 8]:
+                    entry[0] = struct.unpack_from('<I', record, offs + 16)[0]
+                    continue
+                if struct.unpack_from('<Q', record, offs + 16)[0] == 0:    # Sizes are in the first piece
+                    entry[0] = struct.unpack_from('<Q', record, offs + 48)[0]
+                entry[1].extend(decode_runlist(record, offs))
+        for number, (size, extents) in sorted(files.items()):
+            if number < FIRST_USER_RECORD:
+                continue
+            path = self.record_path(number)
+            if path.lower() == root or path.lower().startswith(prefix):
+                yield path, size, sorted(extents)
+
+    def lookup_cluster_files(self, clusters):
+        """Finds the streams using each cluster by scanning the MFT, only as
+        far as needed: extents are remembered, so later lookups start from
+        those and carry on from where the last scan stopped."""
+        pending = sorted(set(clusters))
+        found = {}
+        self._match(self._seen, pending, found)
+        while pending and self._scan_pos < self.mft_records:
+            last = min(self._scan_pos + 1023, self.mft_records - 1)
+            extents = list(self.iter_extents(self._scan_pos, last))
+            self._seen.extend(extents)
+            self._scan_pos = last + 1
+            self._match(extents, pending, found)
+        return dict((cluster, [self._describe(*extent, cluster)]) for cluster, extent in found.items())
+
+    @staticmethod
+    def _match(extents, pending, found):
+        """Moves the clusters in sorted list `pending` that fall in any of
+        `extents` to `found` (cluster -> extent)."""
+        for extent in extents:
+            lcn, length = extent[:2]
+            i = bisect.bisect_left(pending, lcn)
+            j = bisect.bisect_left(pending, lcn + length)
+            for cluster in pending[i:j]:
+                found[cluster] = extent
+            del pending[i:j]
+
+    def _describe(self, lcn, length, record, attr_type, name, vcn, cluster):
+        flags = {ATTR_DATA: STREAM_DATA, ATTR_INDEX_ALLOCATION: STREAM_INDEX}.get(attr_type, STREAM_OTHER)
+        if record < FIRST_USER_RECORD:
+            flags |= FLAG_FS_SYSTEM
+        offset = (vcn + cluster - lcn) * self.cluster_size
+        return flags, '%s (byte offset %s)' % (self.stream_path(record, attr_type, name), offset)
+
+    def stream_path(self, record, attr_type, name):
+        path = self.record_path(record) or '\\'
+        if attr_type == ATTR_DATA:
+            return '%s:%s' % (path, name) if name else path
+        if attr_type == ATTR_INDEX_ALLOCATION:
+            return '%s:%s:$INDEX_ALLOCATION' % (path, name)
+        return '%s:%s:0x%x' % (path, name, attr_type)
+
+    def record_path(self, number, depth=0):
+        """Full path of the file in an MFT record, from its $FILE_NAME links."""
+        if number == RECORD_ROOT:
+            return ''
+        if number in self._dir_paths:
+            return self._dir_paths[number]
+        record = self.read_record(number) if depth < 256 else None     # Loops mean a damaged MFT
+        best = None
+        for attr_type, offs in iter_attributes(record) if record is not None else ():
+            if attr_type != ATTR_FILE_NAME or record[offs + 8]:
+                continue
+            value_offs = offs + struct.unpack_from('<H', record, offs + 20)[0]
+            parent = struct.unpack_from('<Q', record, value_offs)[0] & FRN_MASK
+            name_length, namespace = record[value_offs + 64], record[value_offs + 65]
+            name = bytes(record[value_offs + 66:value_offs + 66 + 2 * name_length]).decode('utf-16-le', 'replace')
+            if best is None or namespace != 2:      # Prefer the long name to the DOS 8.3 one
+                best = parent, name
+        if best is None:
+            return '\\<MFT record %s>' % number
+        parent, name = best
+        path = '%s\\%s' % (self.record_path(parent, depth + 1) if parent != number else '', name)
+        if record[0x16] & 2:    # Directory
+            self._dir_paths[number] = path
+        return path
+
+    def build_file_index(self):
+        """Scans the whole MFT into a FileIndex of every allocated stream."""
+        print('Scanning %s MFT records...' % self.mft_records)
+        extents = sorted(self.iter_extents())
+        streams = {}    # (record, attribute type, name) -> file id
+        names = []
+        file_ids = array.array('q')
+        for lcn, length, record, attr_type, name, vcn in extents:
+            key = (record, attr_type, name)
+            if key not in streams:
+                streams[key] = len(names)
+                names.append(self.stream_path(*key))
+            file_ids.append(streams[key])
+        print('Indexed %s extents of %s streams.' % (len(extents), len(names)))
+        return FileIndex(self.cluster_size, self.total_clusters,
+                         array.array('q', (e[0] for e in extents)), array.array('q', (e[1] for e in extents)),
+                         file_ids, array.array('q', (e[5] for e in extents)), names,
+                         serial=self.get_serial_number())
+
+
+def find_ntfs_volumes(view):
+    """Returns the byte offsets of the NTFS volumes in an image: just 0 for
+    an image of a single volume, otherwise those of the MBR or GPT
+    partitions that hold NTFS (logical drives in extended partitions aren't
+    looked at)."""
+    if is_ntfs_boot_sector(view, 0):
+        return [0]
+    offsets = []
+    if bytes(view[510:512]) == b'\x55\xaa':
+        for i in range(4):
+            entry = 446 + 16 * i
+            part_type = view[entry + 4]
+            first_lba = struct.unpack_from('<I', view, entry + 8)[0]
+            if part_type == 0xee:       # Protective MBR
+                offsets.extend(gpt_partitions(view))
+            elif part_type not in (0, 0x05, 0x0f, 0x85):
+                offsets.append(first_lba * 512)
+    return [offset for offset in offsets if is_ntfs_boot_sector(view, offset)]
+
+
+def gpt_partitions(view):
+    """Byte offsets of the partitions in a GPT, for 512 or 4096 byte sectors."""
+    for sector_size in (512, 4096):
+        if bytes(view[sector_size:sector_size + 8]) != b'EFI PART':
+            continue
+        entries_lba, count, entry_size = struct.unpack_from('<QII', view, sector_size + 72)
+        offsets = []
+        for i in range(count):
+            entry = entries_lba * sector_size + i * entry_size
+            if entry + 40 > len(view):
+                break
+            if any(view[entry:entry + 16]):     # Zero type GUID means unused
+                offsets.append(struct.unpack_from('<Q', view, entry + 32)[0] * sector_size)
+        return offsets
+    return []
+
+
+def is_ntfs_boot_sector(view, offset):
+    return (offset + 512 <= len(view) and bytes(view[offset + 3:offset + 11]) == b'NTFS    '
+            and bytes(view[offset + 510:offset + 512]) == b'\x55\xaa')
+
+
+def read_runs(view, volume_start, cluster_size, runs, offset, size):
+    """Returns `size` bytes from byte `offset` of an attribute stored in
+    `runs`. Reads within one run are a slice of the image mapping; only
+    reads spanning runs are copied. Sparse parts read as zeros."""
+    vcn = offset // cluster_size
+    i = bisect.bisect(runs, (vcn, float('inf'))) - 1
+    if i >= 0:
+        run_vcn, lcn, length = runs[i]
+        run_end = (run_vcn + length) * cluster_size
+        if vcn < run_vcn + length and offset + size <= run_end:
+            start = volume_start + lcn * cluster_size + offset - run_vcn * cluster_size
+            return view[start:start + size]
+    data = bytearray(size)
+    for run_vcn, lcn, length in runs:
+        run_start, run_end = run_vcn * cluster_size, (run_vcn + length) * cluster_size
+        lo, hi = max(offset, run_start), min(offset + size, run_end)
+        if lo < hi:
+            start = volume_start + lcn * cluster_size + lo - run_start
+            data[lo - offset:hi - offset] = view[start:start + hi - lo]
+    return data
+
+
+def apply_fixups(record):
+    """Restores the last two bytes of each 512-byte stride of an MFT record
+    from its update sequence array. Returns False for a torn record."""
+    usa_offset, usa_count = struct.unpack_from('<HH', record, 4)
+    check = record[usa_offset:usa_offset + 2]
+    for i in range(1, usa_count):
+        end = i * 512
+        if end > len(record) or record[end - 2:end] != check:
+            return False
+        record[end - 2:end] = record[usa_offset + 2 * i:usa_offset + 2 * i + 2]
+    return True
+
+
+def iter_attributes(record):
+    """Yields (attribute type, offset) for each attribute in an MFT record."""
+    offs = struct.unpack_from('<H', record, 0x14)[0]
+    while offs + 16 <= len(record):
+        attr_type, length = struct.unpack_from('<II', record, offs)
+        if attr_type == ATTR_END or length == 0:
+            break
+        yield attr_type, offs
+        offs += length
+
+
+def attribute_name(record, offs):
+    name_length, name_offs = struct.unpack_from('<BH', record, offs + 9)
+    if not name_length:
+        return ''
+    return bytes(record[offs + name_offs:offs + name_offs + 2 * name_length]).decode('utf-16-le', 'replace')
+
+
+def decode_runlist(record, offs):
+    """Returns [(VCN, LCN, length)] for the allocated runs of the
+    non-resident attribute at `offs`; sparse runs are left out."""
+    start_vcn = struct.unpack_from('<Q', record, offs + 16)[0]
+    pos = offs + struct.unpack_from('<H', record, offs + 32)[0]
+    end = offs + struct.unpack_from('<I', record, offs + 4)[0]
+    runs = []
+    vcn, lcn = start_vcn, 0
+    while pos < end and record[pos]:
+        len_size, offs_size = record[pos] & 0xf, record[pos] >> 4
+        length = int.from_bytes(record[pos + 1:pos + 1 + len_size], 'little')
+        if offs_size:
+            lcn += int.from_bytes(record[pos + 1 + len_size:pos + 1 + len_size + offs_size], 'little', signed=True)
+            runs.append((vcn, lcn, length))
+        vcn += length
+        pos += 1 + len_size + offs_size
+    return runs
+
+
+def iter_attribute_list(value):
+    """Yields (attribute type, MFT reference) for each $ATTRIBUTE_LIST entry."""
+    pos = 0
+    while pos + 26 <= len(value):
+        attr_type, length = struct.unpack_from('<IH', value, pos)
+        if length == 0:
+            break
+        yield attr_type, struct.unpack_from('<Q', value, pos + 16)[0]
+        pos += length
@@ -0,0 +1,78 @@
+"""Timed test reads, to find weak sectors as well as unreadable ones.
+
+A sector the drive can only read after many internal retries still reads
+successfully, but takes hundreds of milliseconds instead of a few; it is
+usually the next one to fail. Any read that takes longer than a threshold
+is repeated one sector at a time to find the slow sectors.
+
+Re-reads may be answered from the drive's own cache, so a slow read that
+can't be repeated isn't proof of a weak sector either way.
+"""
+import time
+
+from volume import aligned_buffer
+
+DEFAULT_SLOW_MS = 200
+
+
+def timed_read(volume, offset, buf, size):
+    """Volume.read_at(), timed. Returns (error code, bytes read, milliseconds)."""
+    start = time.perf_counter()
+    err, out_size = volume.read_at(offset, buf, size)
+    return err, out_size, (time.perf_counter() - start) * 1000.0
+
+
+def sector_timings(volume, cluster, buf=None):
+    """Reads a cluster one sector at a time. Returns a list of (physical disk
+    sector, error code, milliseconds)."""
+    bps = volume.bytes_per_sector
+    if buf is None:
+        buf = aligned_buffer(bps)
+    first_sector = volume.cluster_to_sector(cluster)
+    timings = []
+    for i in range(volume.cluster_size // bps):
+        err, _, ms = timed_read(volume, cluster * volume.cluster_size + i * bps, buf, bps)
+        timings.append((first_sector + i, err, ms))
+    return timings
+
+
+class ClusterProbe:
+    """Timed test reads of one cluster at a time, all into the same
+    sector-aligned buffer, so that probing many clusters allocates no
+    buffers per cluster. After probe(), `data` is a memoryview of what was
+    read, valid until the next probe."""
+
+    def __init__(self, volume, slow_ms=DEFAULT_SLOW_MS):
+        self.volume = volume
+        self.slow_ms = slow_ms
+        self.buf = aligned_buffer(volume.cluster_size)
+        self.sector_buf = aligned_buffer(volume.bytes_per_sector)
+        self.view = memoryview(self.buf).cast('B')
+        self.data = self.view[:0]
+
+    def probe(self, cluster):
+        """Test-reads one cluster. Returns (error code, bytes read,
+        milliseconds, slow sectors), where slow sectors is a list of
+        (sector, milliseconds) that took longer than `slow_ms` when the
+        cluster is re-read a sector at a time. The cluster is only re-read
+        if the whole read was that slow, so slow sectors is empty for a
+        fast read, or if `slow_ms` is zero."""
+        volume = self.volume
+        err, out_size, ms = timed_read(volume, cluster * volume.cluster_size, self.buf, volume.cluster_size)
+        slow = []
+        if self.slow_ms and not err and ms > self.slow_ms:
+            slow = [(sector, sector_ms) for sector, sector_err, sector_ms
+                    in sector_timings(volume, cluster, self.sector_buf)
+                    if not sector_err and sector_ms > self.slow_ms]
+        self.data = self.view[:out_size]
+        return err, out_size, ms, slow
+
+
+def probe_cluster(volume, cluster, slow_ms=DEFAULT_SLOW_MS):
+    """ClusterProbe.probe() for a one-off read."""
+    return ClusterProbe(volume, slow_ms).probe(cluster)
+
+
+def format_slow_sectors(slow):
+    """Returns a short description of the (sector, milliseconds) list from ClusterProbe.probe()."""
+    return ', '.join('%s (%.0f ms)' % (sector, ms) for sector, ms in slow)
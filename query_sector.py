@@ -1,13 +1,29 @@
+import argparse
+import collections
 import ctypes
+import json
 import logging
 import os
 import tempfile
 import time
 
+from bitmap import FullBitmap, VolumeBitmap, clip_runs
+from changes import ChangeTracker
+from checkpoint import ScanCheckpoint, checkpoint_path
+from disk_index import DiskExtentIndex, get_sector_size
+from file_index import FileIndex
+from hotspot import DEFAULT_MARGIN, HotspotScan
+import iostats
+from ntfs_image import NtfsImage
+from probe import DEFAULT_SLOW_MS, ClusterProbe, format_slow_sectors, probe_cluster
+from rewrite import print_rewrite_results, rewrite_clusters
+from scan import SurfaceScan, print_progress
+from snapshot import default_cache_dir, open_snapshot
+from verify import print_verify_results, verify_tree
+from volume import Volume, VolumeError, kernel32
 from win_types import *
 
 logger = logging.getLogger(__name__)
-kernel32 = ctypes.windll.kernel32
 
 def print_error_string_old(code):
     msg_ptr = ctypes.c_wchar_p()
@@ -25,252 +41,634 @@ def print_error_string_old(code):
     if res:
         logger.error('LocalFree returned nonzero (%s) for ptr %s' % (hex(res), hex(msg_ptr)))
 
-def get_error_string(code):
-    msg_buf = ctypes.create_unicode_buffer(256)
-    msg_len = kernel32.FormatMessageW(
-        0x1000,     # flags = _FROM_SYSTEM
-        None,       # lpSource - ignored for these flags
-        code,       # dwMessageId
-        0,          # Language ID
-        msg_buf,
-        len(msg_buf),   # buffer size / minimum size to allocate
-        None,       # arg list
-    )
-    return msg_buf.value
-
-def try_read_cluster(volume, cluster, cluster_size):
-    """Tries to read from the given cluster of the volume, and returns the result code."""
+def try_read_cluster(volume, cluster, slow_ms=DEFAULT_SLOW_MS):
+    """Tries to read from the given cluster of the volume, and returns 1 if
+    it read cleanly or 0 if it failed or was slow."""
     print('Testing cluster read... ', end='')
     os.sys.stdout.flush()
-    res = kernel32.SetFilePointerEx(
-        volume,
-        ctypes.c_longlong(cluster * cluster_size),
-        None,       # lpNewFilePointer
-        0,          # FILE_BEGIN   (_CURRENT = 1, _END = 2)
-    )
-    if res == 0:
-        logger.fatal('Failed to seek to cluster location')
-        raise ctypes.WinError()
-    buf = ctypes.create_string_buffer(cluster_size)
-    out_size = ctypes.c_ulong()
-    res = kernel32.ReadFile(
-        volume,
-        buf,
-        ctypes.sizeof(buf),
-        ctypes.byref(out_size),
-        None,
-    )
-    if res == 0:
-        err = kernel32.GetLastError()
+    err, out_size, ms, slow = probe_cluster(volume, cluster, slow_ms)
+    if err:
         if err == 23:
             print('failed with CRC error (err 23).')
         else:
             raise ctypes.WinError(err)
+        return 0
+    if out_size != volume.cluster_size:
+        print('-WARNING - partial read (%s of %s)' % (out_size, volume.cluster_size))
+    elif slow_ms and ms > slow_ms:
+        print('success, but slow (%.0f ms).' % ms)
+        if slow:
+            print('Slow sectors: %s' % format_slow_sectors(slow))
+        else:
+            print('No sector was slow when read again one at a time.')
+        return 0    # Worth rewriting, so it gets reallocated before it fails
+    else:
+        print('success (%.1f ms).' % ms)
+    return 1
+
+
+def describe_read(probe, cluster):
+    """Reads a cluster with a ClusterProbe and returns a short description
+    of the result."""
+    err, out_size, ms, slow = probe.probe(cluster)
+    if err == 23:
+        return 'CRC error'
+    if err:
+        return 'error %s' % err
+    if out_size != probe.volume.cluster_size:
+        return 'partial read (%s of %s)' % (out_size, probe.volume.cluster_size)
+    if probe.slow_ms and ms > probe.slow_ms:
+        return 'slow (%.0f ms%s)' % (ms, '; sectors ' + format_slow_sectors(slow) if slow else '')
+    return 'ok'
+
+
+def format_stream_flags(flags):
+    """Returns the markers main() prints in front of a stream lookup result."""
+    tags = ''
+    if flags & 1: tags += '*PF '     # In pagefile
+    if flags & 2: tags += '*DD '     # Defrag denied
+    if flags & 12: tags += '*SYS '   # FS system or TxF system
+    attrs = (flags >> 24) & 3
+    if attrs == 1: pass             # $DATA stream
+    if attrs == 2: tags += '*IDX '   # $INDEX_ALLOCATION attribute
+    if attrs == 3: tags += '*ADS '   # Some other attribute
+    return tags
+
+
+def parse_sector_list(lines):
+    """Parses sector numbers from a list of lines.
+
+    Accepts one or more sector numbers or inclusive `first-last` ranges per
+    line, which covers plain lists and `badblocks` output. smartctl's '# 1'
+    style self-test log entries contribute their last field if it is a
+    number, which is where smartctl puts LBA_of_first_error. Other lines
+    starting with '#' are comments, and other lines with text in them (such
+    as the headers of a smartctl log) are skipped.
+
+    Yields (first, last) sector ranges.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') and not line.lstrip('# ').split(' ')[0].isdigit():
+            continue
+        ranges = []
+        for token in line.replace(',', ' ').split():
+            first, _, last = token.partition('-')
+            if first.isdigit() and (not last or last.isdigit()):
+                ranges.append((int(first), int(last or first)))
+            else:
+                ranges = None
+                break
+        if ranges is None:
+            last_field = line.split()[-1]
+            if not line.startswith('#') or not last_field.isdigit():
+                logger.debug('No sector number found in line: %s' % line)
+                continue
+            ranges = [(int(last_field), int(last_field))]
+        for first, last in ranges:
+            if last < first:
+                first, last = last, first
+            yield first, last
+
+
+def query_sectors(volume, bitmap, ranges, lookup=None, slow_ms=DEFAULT_SLOW_MS):
+    """Resolves many sector ranges against one open volume.
+
+    Returns a list of (first sector, last sector, cluster, in use, files,
+    read result) with one row per cluster touched; files is a list of
+    (flags, name) and is empty for free clusters. Sectors outside the
+    volume come back with a cluster of None. `lookup` is what to find
+    files with (a FileIndex, or by default the volume itself), and reads
+    slower than `slow_ms` are reported as slow.
+    """
+    sectors_per_cluster = volume.cluster_size // volume.bytes_per_sector
+    first_sector = volume.start // volume.bytes_per_sector
+    end_sector = volume.end // volume.bytes_per_sector
+    rows = {}
+    outside = []
+    for first, last in ranges:
+        if first < first_sector:
+            outside.append((first, min(last, first_sector - 1)))
+        if last >= end_sector:
+            outside.append((max(first, end_sector), last))
+        sector = max(first, first_sector)
+        while sector <= min(last, end_sector - 1):
+            cluster = volume.sector_to_cluster(sector)
+            # Last sector of this cluster that the range covers
+            upto = min(last, first_sector + (cluster + 1) * sectors_per_cluster - 1)
+            add_row(rows, cluster, sector, upto)
+            sector = upto + 1
+    return query_clusters(volume, bitmap, rows, outside, lookup, slow_ms)
+
+
+def add_row(rows, cluster, first, last):
+    """Records that sectors first..last map to a cluster, merging with any
+    sectors already recorded for it."""
+    if cluster in rows:
+        rows[cluster] = (min(rows[cluster][0], first), max(rows[cluster][1], last))
+    else:
+        rows[cluster] = (first, last)
+
+
+def query_clusters(volume, bitmap, rows, outside=(), lookup=None, slow_ms=DEFAULT_SLOW_MS):
+    """Looks up and test-reads the clusters in `rows` (cluster -> (first
+    sector, last sector)), with one batched file lookup for all the clusters
+    in use. Returns rows in the form described in query_sectors(), starting
+    with one for each (first, last) sector range in `outside`."""
+    in_use = set(c for c in rows if bitmap.is_set(c))
+    files = (lookup or volume).lookup_cluster_files(in_use) if in_use else {}
+    results = [(first, last, None, False, [], '') for first, last in outside]
+    probe = ClusterProbe(volume, slow_ms)
+    for cluster in sorted(rows):
+        first, last = rows[cluster]
+        results.append((first, last, cluster, cluster in in_use,
+                        files.get(cluster, []), describe_read(probe, cluster)))
+    return results
+
+
+def print_results(rows):
+    """Prints the rows returned by query_sectors()."""
+    for first, last, cluster, used, files, read_result in rows:
+        sectors = str(first) if first == last else '%s-%s' % (first, last)
+        if cluster is None:
+            print('%s: not part of this volume' % sectors)
+            continue
+        print('%s: cluster %s, %s, read %s' % (sectors, cluster, 'in use' if used else 'free', read_result))
+        for flags, name in files:
+            print('    %s%s' % (format_stream_flags(flags), name))
+
+
+def run_batch(volume, bitmap, ranges, lookup=None, slow_ms=DEFAULT_SLOW_MS):
+    print('Resolving %s sector range(s)...' % len(ranges))
+    rows = query_sectors(volume, bitmap, ranges, lookup, slow_ms)
+    print_results(rows)
+    return rows
+
+
+def run_disk_query(index, disk_number, ranges, slow_ms=DEFAULT_SLOW_MS):
+    """Resolves sector ranges on a physical disk, whichever volumes they
+    fall in, with one query_clusters() call per volume."""
+    sector_size = get_sector_size(disk_number)
+    by_volume = collections.OrderedDict()   # IndexedVolume -> {cluster: (first, last)}
+    outside = []
+    no_filesystem = collections.OrderedDict()   # IndexedVolume -> [(first, last)]
+    for first, last in ranges:
+        sector = first
+        while sector <= last:
+            offset = sector * sector_size
+            found = index.find(disk_number, offset)
+            if found is None:
+                # Skip straight to the next volume on the disk
+                next_start = index.next_start(disk_number, offset)
+                upto = last if next_start is None else min(last, -(-next_start // sector_size) - 1)
+                outside.append((sector, upto))
+                sector = upto + 1
+                continue
+            entry, extent = found
+            extent_last = (extent[1] + extent[2]) // sector_size - 1
+            if not entry.cluster_size:
+                upto = min(last, extent_last)
+                no_filesystem.setdefault(entry, []).append((sector, upto))
+                sector = upto + 1
+                continue
+            volume_offset = entry.volume_offset(disk_number, offset, extent)
+            cluster = volume_offset // entry.cluster_size
+            # Last sector of this cluster that the range covers
+            upto = min(last, extent_last,
+                       sector + (entry.cluster_size - volume_offset % entry.cluster_size) // sector_size - 1)
+            add_row(by_volume.setdefault(entry, {}), cluster, sector, upto)
+            sector = upto + 1
+
+    for first, last in outside:
+        print('%s: not part of any volume on disk %s' % (first if first == last else '%s-%s' % (first, last),
+                                                         disk_number))
+    for entry, sectors in no_filesystem.items():
+        for first, last in sectors:
+            print('%s: on volume %s, which has no filesystem Windows recognises'
+                  % (first if first == last else '%s-%s' % (first, last), entry))
+    for entry, rows in by_volume.items():
+        print('Volume %s:' % entry)
+        volume = Volume(entry.name)
+        try:
+            volume.open()
+        except VolumeError as e:
+            print(e)
+            continue
+        print_results(query_clusters(volume, VolumeBitmap(volume), rows, slow_ms=slow_ms))
+        volume.close()
+
+
+def load_file_index(volume, path):
+    """Loads the file index saved at `path`, or builds and saves one if
+    there isn't one there yet, it's from a different volume, or the volume
+    has changed in ways the change journal can no longer account for."""
+    file_index = None
+    if os.path.exists(path):
+        try:
+            file_index = FileIndex.load(path)
+        except (OSError, ValueError, EOFError) as e:
+            print('Could not load file index %s (%s); rebuilding it.' % (path, e))
+        else:
+            if not file_index.matches(volume):
+                print('File index %s is for a different volume; rebuilding it.' % path)
+                file_index = None
+            elif not file_index.catch_up(volume):
+                print("File index %s is out of date and the change journal can't tell what changed; "
+                      "rebuilding it." % path)
+                file_index = None
+    if file_index is None:
+        print('Building file index...')
+        file_index = volume.build_file_index()
+        file_index.save(path)
+    else:
+        print('Loaded file index with %s extents of %s files (%s changed since; looked up on the volume).'
+              % (len(file_index.starts), len(file_index.names), len(file_index.stale)))
+    file_index.volume = volume
+    return file_index
+
+
+def parse_cluster_range(text, total_clusters):
+    """Parses a 'first-last' LCN range for --scan; 'all' is the whole volume."""
+    if text == 'all':
+        return 0, total_clusters - 1
+    first, _, last = text.partition('-')
+    first = int(first)
+    last = min(int(last), total_clusters - 1) if last else total_clusters - 1
+    return first, last
+
+
+def run_report(volume, bitmap, path, regions):
+    """Writes bitmap_report() for the whole volume as JSON to a file ('-' for stdout)."""
+    if not isinstance(bitmap, FullBitmap):
+        bitmap = FullBitmap(volume.load_bitmap())
+    report = bitmap.report(regions)
+    report['cluster_size'] = volume.cluster_size
+    report['disk_number'] = volume.disk_number
+    report['disk_offset'] = volume.start
+    if path == '-':
+        json.dump(report, os.sys.stdout, indent=1)
+        print()
     else:
-        if out_size.value != cluster_size:
-            print('-WARNING - partial read (%s of %s)' % (out_size.value, cluster_size))
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Wrote bitmap report to %s' % path)
+
+
+def run_scan(volume, bitmap, first, last, chunk_size, queue_depth=1, free_only=False, lookup=None,
+             slow_ms=DEFAULT_SLOW_MS, checkpoint=None, tracker=None):
+    """Scans clusters first..last for read errors, then looks up what's
+    stored in each unreadable cluster. With free_only, only the free
+    clusters are read, since those are the ones that can be rewritten.
+    Clusters that read more slowly than `slow_ms` are reported with them.
+    With a ScanCheckpoint, clusters it shows were already read are skipped,
+    what was found in them is reported as well, and the checkpoint is kept
+    up to date until the scan finishes. With a ChangeTracker, the bitmap is
+    brought up to date before the clusters are looked up, since a long scan
+    may have outlasted it. Returns the rows for those clusters, as
+    query_sectors() does."""
+    surface_scan = SurfaceScan(volume, chunk_size, queue_depth, slow_ms)
+    bitmap, starts, lengths = runs_to_scan(volume, bitmap, first, last, free_only)
+    total = int(sum(lengths))
+    if free_only:
+        print('%s free clusters in %s runs (%.1f%% of the range).'
+              % (total, len(starts), 100.0 * total / (last + 1 - first)))
+    if checkpoint is not None:
+        checkpoint.open(volume)
+        starts, lengths = checkpoint.remaining(starts, lengths)
+        remaining = int(sum(lengths))
+        if remaining < total:
+            print('Resuming from checkpoint %s: %s of %s clusters already scanned, %s unreadable and %s slow so far.'
+                  % (checkpoint.path, total - remaining, total, len(checkpoint.findings), len(checkpoint.slow)))
+        total = remaining
+        surface_scan.findings = list(checkpoint.findings)
+        surface_scan.slow = list(checkpoint.slow)
+    print('Scanning clusters %s-%s in %s KB reads...'
+          % (first, last, surface_scan.chunk_clusters * volume.cluster_size // 1024))
+    try:
+        surface_scan.scan_runs(starts, lengths, print_progress(total), checkpoint)
+    except KeyboardInterrupt:
+        if checkpoint is None:
+            raise
+        print('\nInterrupted; run the same scan again to resume from the checkpoint.')
+        raise SystemExit(1)
+    finally:
+        surface_scan.close()
+        if checkpoint is not None:
+            checkpoint.close(surface_scan)
+    # Only this range, once each (a cluster found in a chunk that was
+    # interrupted is found again when the chunk is re-read)
+    findings = list({cluster: (cluster, err, sectors) for cluster, err, sectors in surface_scan.findings
+                     if first <= cluster <= last}.values())
+    slow = [(cluster, sectors) for cluster, sectors in surface_scan.slow if first <= cluster <= last]
+    print('%s unreadable and %s slow cluster(s) found in %s reads.'
+          % (len(findings), len(slow), surface_scan.reads))
+    if tracker is not None:
+        tracker.refresh(bitmap)
+    rows = resolve_findings(volume, bitmap, findings, slow, lookup, slow_ms)
+    if checkpoint is not None:
+        checkpoint.remove()
+    if rows:
+        print_results(rows)
+    return rows
+
+
+def run_hotspots(volume, bitmap, ranges, margin=DEFAULT_MARGIN, chunk_size=4 * 1024 * 1024, lookup=None,
+                 slow_ms=DEFAULT_SLOW_MS, tracker=None):
+    """Explores the damaged area around each range of known bad sectors
+    with a HotspotScan, then looks up the unreadable and slow clusters it
+    found as run_scan() does, and returns their rows."""
+    seeds = []
+    for first, last in ranges:
+        first_cluster = volume.sector_to_cluster(max(first, volume.start // volume.bytes_per_sector))
+        last_cluster = volume.sector_to_cluster(min(last, volume.end // volume.bytes_per_sector - 1))
+        if first_cluster is None or last_cluster is None or last_cluster < first_cluster:
+            print('%s: not part of this volume' % (first if first == last else '%s-%s' % (first, last)))
         else:
-            print('success.')
-    return res
-    
-    
-    
+            seeds.append((first_cluster, last_cluster))
+    if not seeds:
+        return []
+    hotspots = HotspotScan(volume, margin, chunk_size, slow_ms)
+    print('Exploring around %s range(s) of clusters until %s clean clusters are found either side...'
+          % (len(seeds), hotspots.margin))
+    try:
+        for seed_first, seed_last, low, high, damaged in hotspots.explore(seeds):
+            seed = str(seed_first) if seed_first == seed_last else '%s-%s' % (seed_first, seed_last)
+            if damaged:
+                print(' Around cluster %s: %s damaged cluster(s) in %s-%s (read %s-%s)'
+                      % (seed, len(damaged), damaged[0], damaged[-1], low, high))
+            else:
+                print(' Around cluster %s: no damage found (read %s-%s)' % (seed, low, high))
+    finally:
+        hotspots.close()
+    findings = list({cluster: (cluster, err, sectors) for cluster, err, sectors in hotspots.findings}.values())
+    print('%s unreadable and %s slow cluster(s) found in %s reads.'
+          % (len(findings), len(hotspots.slow), hotspots.scan.reads))
+    if tracker is not None:
+        tracker.refresh(bitmap)
+    rows = resolve_findings(volume, bitmap, findings, hotspots.slow, lookup, slow_ms)
+    if rows:
+        print_results(rows)
+    return rows
+
+
+def runs_to_scan(volume, bitmap, first, last, free_only=False):
+    """Returns (bitmap, starts, lengths) of the runs of clusters a scan of
+    first..last reads: all of them, or with free_only just the free ones
+    (for which the whole bitmap is loaded, and returned, if it wasn't)."""
+    if not free_only:
+        return bitmap, [first], [last + 1 - first]
+    if not isinstance(bitmap, FullBitmap):
+        bitmap = FullBitmap(volume.load_bitmap())
+    starts, lengths = clip_runs(*bitmap.free_runs(), first, last)
+    return bitmap, starts, lengths
+
+
+def resolve_findings(volume, bitmap, findings, slow, lookup=None, slow_ms=DEFAULT_SLOW_MS):
+    """Looks up the unreadable and slow clusters from a SurfaceScan (its
+    findings and slow lists) with query_clusters(), and returns the rows.
+
+    The clusters are looked up as they are, rather than mapped to sectors
+    and back, so this works on volumes with several extents too; there the
+    sectors are on whichever disk holds each cluster."""
+    slow = dict(slow)
+    if not findings and not slow:
+        return []
+    rows = {}
+    for cluster, err, sectors in findings:
+        if not sectors:     # Only failed as a whole
+            sectors = [volume.cluster_to_sector(cluster)]
+        add_row(rows, cluster, min(sectors), max(sectors))
+    for cluster, sectors in slow.items():
+        add_row(rows, cluster, min(sector for sector, ms in sectors), max(sector for sector, ms in sectors))
+    rows = query_clusters(volume, bitmap, rows, (), lookup, slow_ms)
+    for i, (first, last, cluster, used, files, read_result) in enumerate(rows):
+        if read_result == 'ok' and cluster in slow:
+            # Fast when read again (perhaps from the drive's cache), but it wasn't during the scan
+            rows[i] = (first, last, cluster, used, files,
+                       'slow during scan (sectors %s)' % format_slow_sectors(slow[cluster]))
+    return rows
+
+
+def offer_rewrite(volume, rows, force=False):
+    """Asks once whether to rewrite all the free clusters in `rows` that
+    couldn't be read or were slow (or all the free ones, with force), and
+    does so."""
+    clusters = sorted(set(cluster for first, last, cluster, used, files, read_result in rows
+                          if cluster is not None and not used and (force or read_result != 'ok')))
+    if not clusters:
+        print('No free unreadable or slow clusters to rewrite.')
+        return
+    if not volume.can_rewrite:
+        print("Can't rewrite clusters of an image.")
+        return
+    try:
+        res = input('Try to rewrite %s free cluster(s) with dummy data (y/n)? ' % len(clusters))
+    except EOFError:    # Sector list was piped in
+        res = ''
+    if not res.upper().startswith('Y'):
+        return
+    print_rewrite_results(rewrite_clusters(volume, clusters))
+
+
 def main():
-    force_write = False
-    if len(os.sys.argv) == 3:
-        if os.sys.argv[2] == '--force':
-            force_write = True
-            del os.sys.argv[2]
-    
-    if len(os.sys.argv) != 2:
-        print("\nUsage: %s <driveletter> [--force]" % os.sys.argv[0])
-        print(
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
 """
   Takes a physical disk sector number (in decimal) and tries to map it
   to the NTFS cluster using that sector and determine what's located
   there. If it's unused, attempt to read from that cluster; if the
   read fails, offer to write dummy data there (to allow a SMART disk
-  drive to reallocate the sector).
-        
-   --force: always offer to overwrite an empty cluster,
-            even if it was read successfully.""")
-        return
-    drive_letter = os.sys.argv[1].upper()
-    if len(drive_letter) not in (1, 2):
-        print("Drive letter should be in the form 'C' or 'C:'")
+  drive to reallocate the sector).""")
+    parser.add_argument('drive_letter', metavar='driveletter', nargs='?')
+    parser.add_argument('--disk', metavar='N', type=int,
+                        help='take sector numbers on physical disk N and look them up in whichever volume '
+                             'holds them, instead of giving a drive letter.')
+    parser.add_argument('--image', metavar='FILE',
+                        help='work on the NTFS volume in a disk or partition image (or block device) '
+                             'instead of a mounted volume; this also works off Windows.')
+    parser.add_argument('--partition', metavar='N', type=int,
+                        help='with --image, use the Nth NTFS volume in the image (default: the first).')
+    parser.add_argument('--mapfile', metavar='FILE',
+                        help='with --image, a ddrescue mapfile; reads of areas it marks as not '
+                             'rescued fail like the original disk did.')
+    parser.add_argument('--force', action='store_true',
+                        help='always offer to overwrite an empty cluster, even if it was read successfully.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="resolve every sector or range listed in FILE ('-' for stdin) "
+                             "instead of prompting for one.")
+    parser.add_argument('--scan', metavar='FIRST-LAST', nargs='?', const='all',
+                        help='read every cluster in an LCN range (default: the whole volume) and '
+                             'report the unreadable ones.')
+    parser.add_argument('--hotspots', action='store_true',
+                        help='treat the sectors given (with --batch, or the one entered) as known bad, and read '
+                             'outward from each until the whole damaged area around it is found.')
+    parser.add_argument('--margin', metavar='N', type=int, default=DEFAULT_MARGIN,
+                        help='with --hotspots, stop once N clean clusters in a row are read either side of '
+                             'the damage (default: %(default)s).')
+    parser.add_argument('--verify', metavar='DIR',
+                        help='read every file under DIR (a path within the image, with --image) in one '
+                             'pass in disk order, and report the byte ranges of each that can\'t be read.')
+    parser.add_argument('--chunk-size', metavar='MB', type=int, default=4,
+                        help='size of each read when scanning or verifying (default: %(default)s MB).')
+    parser.add_argument('--free-only', action='store_true',
+                        help='only scan clusters that the volume bitmap shows as free.')
+    parser.add_argument('--queue-depth', metavar='N', type=int, default=1,
+                        help='number of scan reads to keep in flight (default: %(default)s).')
+    parser.add_argument('--report', metavar='FILE',
+                        help="write free space and fragmentation statistics for the volume as JSON "
+                             "to FILE ('-' for stdout).")
+    parser.add_argument('--regions', metavar='N', type=int, default=100,
+                        help='number of slices of the volume in the --report occupancy map (default: %(default)s).')
+    parser.add_argument('--full-bitmap', action='store_true',
+                        help='load the whole volume bitmap up front instead of reading it on demand.')
+    parser.add_argument('--cache', metavar='DIR', nargs='?', const=default_cache_dir(),
+                        help='keep a snapshot of the volume geometry and bitmap in DIR (default: %s), '
+                             'and reuse it while nothing on the volume has changed.' % default_cache_dir())
+    parser.add_argument('--file-index', metavar='FILE',
+                        help='find files from an index of every file\'s extents, saved in FILE; it is '
+                             'built there (which takes a while) if FILE does not exist.')
+    parser.add_argument('--slow-ms', metavar='MS', type=float, default=DEFAULT_SLOW_MS,
+                        help='report reads taking longer than MS milliseconds as slow, and find the slow '
+                             'sectors in them (default: %(default)s; 0 turns this off).')
+    parser.add_argument('--rewrite', action='store_true',
+                        help='with --batch, --scan or --hotspots, offer to rewrite every free cluster that could not '
+                             'be read (every free cluster, with --force) in one go.')
+    parser.add_argument('--checkpoint', metavar='DIR', nargs='?', const=default_cache_dir(),
+                        help='with --scan, keep a journal of the scan\'s progress in DIR (default: %s), so '
+                             'that an interrupted scan resumes where it stopped.' % default_cache_dir())
+    parser.add_argument('--stats', metavar='FILE',
+                        help='record the count, size, errors and latency of every read and ioctl, and a '
+                             'heatmap of read latency across the disk, and write them to FILE at the end '
+                             '(as CSV if FILE ends in .csv, otherwise JSON).')
+    parser.add_argument('--stats-interval', metavar='SECONDS', type=float,
+                        help='also rewrite the --stats file every SECONDS during the run.')
+    args = parser.parse_args()
+    if args.disk is None and args.image is None and args.drive_letter is None:
+        parser.error('a drive letter, --disk or --image is needed')
+
+    stats = iostats.enable() if args.stats else None
+    if stats is not None and args.stats_interval:
+        stats.start_timer(args.stats, args.stats_interval)
+    try:
+        run(args)
+    finally:
+        if stats is not None:
+            stats.stop_timer()
+            stats.write(args.stats)
+            print('Wrote I/O stats to %s' % args.stats)
+
+
+def run(args):
+    force_write = args.force
+
+    if args.disk is not None:
+        index = DiskExtentIndex.build()
+        if args.disk not in index.disks():
+            print('No volumes found on disk %s.' % args.disk)
+            return
+        if args.batch == '-':
+            ranges = list(parse_sector_list(os.sys.stdin))
+        elif args.batch:
+            with open(args.batch) as f:
+                ranges = list(parse_sector_list(f))
+        else:
+            ranges = list(parse_sector_list([input('Enter disk sector to query: ')]))
+            if not ranges:
+                print("Not a valid integer.")
+                return
+        run_disk_query(index, args.disk, ranges, args.slow_ms)
+        index.close()
+        print('Done.')
         return
-    if drive_letter[-1] == ':':
-        drive_letter = drive_letter[:-1]
-    if drive_letter < 'A' or drive_letter > 'Z':
-        print('Drive letter should be in A...Z.')
+    if args.image:
+        volume = NtfsImage(args.image, args.partition, args.mapfile)
+    else:
+        drive_letter = args.drive_letter.upper()
+        if len(drive_letter) not in (1, 2):
+            print("Drive letter should be in the form 'C' or 'C:'")
+            return
+        if drive_letter[-1] == ':':
+            drive_letter = drive_letter[:-1]
+        if drive_letter < 'A' or drive_letter > 'Z':
+            print('Drive letter should be in A...Z.')
+            return
+        # Unbuffered, so that read timings come from the disk rather than the cache
+        volume = Volume(drive_letter, unbuffered=True)
+
+    try:
+        if args.cache and isinstance(volume, Volume):
+            # The tracker starts from the journal position before the bitmap
+            # is loaded (or the snapshot checked), so nothing in between is missed
+            volume.open_handle()
+            tracker = ChangeTracker(volume).start()
+            bitmap = open_snapshot(volume, args.cache)
+        else:
+            volume.open()
+            # Changes made while the bitmap loads are then picked up too
+            tracker = ChangeTracker(volume).start()
+            bitmap = FullBitmap(volume.load_bitmap()) if args.full_bitmap else VolumeBitmap(volume)
+    except VolumeError as e:
+        print(e)
         return
-    vol_name = r'\\.\%s:' % drive_letter
-    vol_path = '%s:\\' % drive_letter
-
-    print("Opening %s..." % vol_name)
-
-    volume = kernel32.CreateFileW(
-        vol_name,
-        2 << 30,    # GENERIC_READ 
-        0x3,        # FILE_SHARE_READ | FILE_SHARE_WRITE
-        None,       # securitydescriptor
-        0x3,        # OPEN_EXISTING
-        #0x80000000, # WRITE_THROUGH
-        0,
-        None,       # hTemplateFile
-    )
-    if volume == INVALID_HANDLE:
-        logger.fatal('Failed to open a handle to the volume. Do you have admin privileges?')
-        raise ctypes.WinError()
-    logger.info("Volume handle: %s" % volume)
-
-    # 0x00090028  FSCTL_IS_VOLUME_MOUNTED
-    out_size = ctypes.c_ulong()
-    res = kernel32.DeviceIoControl(
-        volume,
-        FSCTL_IS_VOLUME_MOUNTED,
-        None,
-        0,
-        None,
-        0,
-        ctypes.byref(out_size),        # lpBytesReturned - don't care (is 0)
-        None,           # lpOverlapped
-    )
-    err = kernel32.GetLastError()
-    if err != 0:
-        print(" Error %s checking volume mount status: %s" % (err, get_error_string(err)))
+
+    if len(volume.extents) > 1 and not (args.report or args.scan or args.verify):
+        # Sector numbers alone are ambiguous across several extents
+        print('Volume spans more than one disk extent; use --disk N to look up sectors on it.')
+        volume.close()
         return
-    print(" Volume is%s mounted" % ('' if res else ' not'))
-
-    # Get physical info
-    vde = VOLUME_DISK_EXTENTS()
-    res = kernel32.DeviceIoControl(
-        volume,
-        IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS,
-        None,                   # lpInputBuffer
-        0,
-        ctypes.byref(vde),
-        ctypes.sizeof(vde),     # out buffer size
-        ctypes.byref(out_size), # lpBytesReturned
-        None,                   # lpOverlapped
-    )
-    if res == 0:
-        err = kernel32.GetLastError()
-        if err == 234:  # ERR_MORE_DATA
-            print(" Multiple extents: Windows reports %s extents for this volume." % vde.NumberOfDiskExtents)
-            print(" We don't support more than one extent yet!")
+    lookup = load_file_index(volume, args.file_index) if args.file_index else volume
+
+    if args.batch:
+        if args.batch == '-':
+            ranges = list(parse_sector_list(os.sys.stdin))
         else:
-            logger.fatal("Failed to get volume's on-disk location")
-            raise ctypes.WinError(err)
-        return
-    assert vde.NumberOfDiskExtents == 1, "Did not get exactly one extent back, despite error check?"
-    print(" Volume is located on \\\\.\\PhysicalDisk%s" % vde.Extents[0].DiskNumber)
-    print("  %s bytes starting at disk offset %s" % (vde.Extents[0].ExtentLength, vde.Extents[0].StartingOffset))
-    vol_start = vde.Extents[0].StartingOffset
-    vol_end = vol_start + vde.Extents[0].ExtentLength       # This is the first byte offset AFTER the end of the volume
-
-    # Find cluster size
-    spc = ctypes.c_ulong()
-    bps = ctypes.c_ulong()
-    cfree = ctypes.c_ulong()
-    ctotal = ctypes.c_ulong()
-    res = kernel32.GetDiskFreeSpaceW(
-        vol_path,
-        ctypes.byref(spc),      # Sectors per Cluster
-        ctypes.byref(bps),      # Bytes / sector
-        ctypes.byref(cfree),    # free clusters
-        ctypes.byref(ctotal),   # Total clusters
-    )
-    if res == 0:
-        err = kernel32.GetLastError()
-        print(" Error %s: %s" % (err, get_error_string(err)))
+            with open(args.batch) as f:
+                ranges = list(parse_sector_list(f))
+        if args.hotspots:
+            rows = run_hotspots(volume, bitmap, ranges, args.margin, args.chunk_size * 1024 * 1024, lookup,
+                                args.slow_ms, tracker)
+        else:
+            rows = run_batch(volume, bitmap, ranges, lookup, args.slow_ms)
+        if args.rewrite:
+            offer_rewrite(volume, rows, force_write)
+        volume.close()
+        print('Done.')
         return
-    bps = bps.value     # We'll use this later
-    cluster_size = bps * spc.value
-    print("  %s bytes per sector, %s sectors per cluster (%s bytes per cluster)"
-          % (bps, spc.value, cluster_size))
-
-    # Verify that it's NTFS
-    fs_flags = ctypes.c_uint()
-    buf = ctypes.create_unicode_buffer(32)    # FS type name buffer
-    res = kernel32.GetVolumeInformationW(
-        vol_path,
-        None,       # lpVolNameBuffer
-        0,          # nVolNameSize
-        None,       # lpVolSerial
-        ctypes.byref(out_size),     # max path component length, but we don't care
-        ctypes.byref(fs_flags),
-        buf,
-        ctypes.sizeof(buf),
-    )
-    if res == 0:
-        logger.fatal('Error calling GetVolumeInformation')
-        raise ctypes.WinError()
-    if fs_flags.value & 0x80000:
-        logger.warning('Volume is read-only')
-    if buf.value != 'NTFS':
-        logger.fatal('Only tested on NTFS -- FS type is "%s"' % buf.value)
+
+    if args.report:
+        run_report(volume, bitmap, args.report, args.regions)
+        volume.close()
         return
 
-    # Verify starting cluster offset
-    buf = ctypes.c_ulonglong()
-    res = kernel32.DeviceIoControl(
-        volume,
-        FSCTL_GET_RETRIEVAL_POINTER_BASE,
-        None,
-        0,
-        ctypes.byref(buf),
-        ctypes.sizeof(buf),
-        ctypes.byref(out_size),     # lpBytesReturned
-        None,                       # lpOverlapped
-    )
-    if res == 0:
-        logger.fatal('Failure when requesting FS starting cluster')
-        raise ctypes.WinError()
-    if buf.value != 0:
-        raise RuntimeError('First cluster offset in volume is not zero (got %s instead)' % buf.value)
-
-    # Try to get volume bitmap size
-    buf = ctypes.create_string_buffer(32)       # Doesn't seem to like having just a 16-byte buffer, even though in theory that's enough for header
-    res = kernel32.DeviceIoControl(
-        volume,
-        FSCTL_GET_VOLUME_BITMAP,
-        ctypes.byref(ctypes.c_ulonglong(0)),        # lpInputBuffer - struct of one LARGE_INTEGER for starting LCN
-        8,
-        buf,
-        ctypes.sizeof(buf),         # out buffer size
-        ctypes.byref(out_size),     # lpBytesReturned
-        None,                       # lpOverlapped
-    )
-    if res != 0:
-        print("Unexpected success from GET_VOLUME_BITMAP with no output buffer! Aborting.")
+    if args.verify:
+        try:
+            files = verify_tree(volume, args.verify, args.chunk_size * 1024 * 1024, args.queue_depth, args.slow_ms)
+        except (OSError, VolumeError) as e:
+            print(e)
+            volume.close()
+            return
+        print_verify_results(files)
+        volume.close()
+        print('Done.')
         return
-    err = kernel32.GetLastError()
-    if err == 122:      #  ERROR_INSUFFICIENT_BUFFER
-        print(" GET_VOLUME_BITMAP reported buffer is too small, required size not known. Aborting.")
+
+    if args.scan:
+        try:
+            first, last = parse_cluster_range(args.scan, volume.total_clusters)
+        except ValueError:
+            print('Scan range should be in the form FIRST-LAST.')
+            return
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = ScanCheckpoint(checkpoint_path(args.checkpoint, volume.get_serial_number()))
+        rows = run_scan(volume, bitmap, first, last, args.chunk_size * 1024 * 1024, args.queue_depth,
+                        args.free_only, lookup, args.slow_ms, checkpoint, tracker)
+        if args.rewrite:
+            offer_rewrite(volume, rows, force_write)
+        volume.close()
+        print('Done.')
         return
-    if err != 234:      # ERROR_MORE_DATA_AVAILABLE is expected
-        logger.fatal('Failed to get size of volume bitmap')
-        raise ctypes.WinError(err)
-    header = VOLUME_BITMAP_BUFFER.from_buffer(buf)
-    if header.BitmapSize == 0:
-        print(" Error: GET_VOLUME_BITMAP result shows bitmap size is zero? Aborting.")
-
-    bm_buf = ctypes.create_string_buffer(33 + header.BitmapSize // 8)
-    print("Loading volume bitmap (%s bytes)..." % ctypes.sizeof(bm_buf))
-    res = kernel32.DeviceIoControl(
-        volume,
-        FSCTL_GET_VOLUME_BITMAP,
-        ctypes.byref(ctypes.c_ulonglong(0)),    # lpInputBuffer
-        8,
-        bm_buf,
-        ctypes.sizeof(bm_buf),  # out buffer size
-        ctypes.byref(out_size), # lpBytesReturned
-        None,                   # lpOverlapped
-    )
-    if res == 0:
-        raise ctypes.WinError()
-    print('Successfully loaded bitmap.\n')
 
     query = input('Enter disk sector to query: ')
     try:
@@ -279,141 +677,50 @@ def main():
         print("Not a valid integer.")
         return
 
-    offset = query * bps
-    if offset < vol_start or offset >= vol_end:
+    cluster = volume.sector_to_cluster(query)
+    if cluster is None:
         print('Sector is not part of this volume.')
         return
-    cluster = (offset - vol_start) // cluster_size
+    if args.hotspots:
+        rows = run_hotspots(volume, bitmap, [(query, query)], args.margin, args.chunk_size * 1024 * 1024, lookup,
+                            args.slow_ms, tracker)
+        if rows and args.rewrite:
+            offer_rewrite(volume, rows, force_write)
+        volume.close()
+        print('Done.')
+        return
     print('Sector is in cluster %s of volume.' % cluster)
-    bm_byte = bm_buf[16 + cluster // 8]
     # If set in bitmap...
-    if ord(bm_byte) & 2**(cluster % 8):
+    if bitmap.is_set(cluster):
         print('Cluster is in use. Querying for file...')
-        lookup_in = LOOKUP_STREAM_FROM_CLUSTER_INPUT()
-        lookup_in.NumberOfClusters = 1
-        lookup_in.Cluster[0] = cluster
-        buf = ctypes.create_string_buffer(70000)        # File name may be up to 64k bytes
-        res = kernel32.DeviceIoControl(
-            volume,
-            FSCTL_LOOKUP_STREAM_FROM_CLUSTER,
-            ctypes.byref(lookup_in),
-            ctypes.sizeof(lookup_in),
-            buf,
-            ctypes.sizeof(buf),
-            ctypes.byref(out_size),
-            None,
-        )
-        if res == 0:
-            err = kernel32.GetLastError()
-            if err == 234:
-                logger.warning('Got more file matches than will fit in buffer! Some results will not be shown')
-            else:
-                raise ctypes.WinError(err)
-        lookup_output = LOOKUP_STREAM_FROM_CLUSTER_OUTPUT.from_buffer(buf)
-        if lookup_output.NumberOfMatches == 0:
+        matches = lookup.lookup_cluster_files([cluster]).get(cluster, [])
+        if len(matches) == 0:
             print("Didn't find any files using that cluster - probably a bug in the volume bitmap handling?")
             return
-        elif lookup_output.NumberOfMatches > 1:
+        elif len(matches) > 1:
             print("Unexpectedly got more than one result for files using this cluster!")
         print("File results for this cluster:")
-        offs = lookup_output.Offset
-        while True:
-            stream_entry = LOOKUP_STREAM_FROM_CLUSTER_ENTRY.from_buffer(buf, offs)
-            print('    ', end='')
-            if stream_entry.Flags & 1: print('*PF ', end='')    # In pagefile
-            if stream_entry.Flags & 2: print('*DD ', end='')    # Defrag denied
-            if stream_entry.Flags & 12: print('*SYS ', end='')  # FS system or TxF system
-            attrs = (stream_entry.Flags >> 24) & 3
-            if attrs == 1: pass     # $DATA stream
-            if attrs == 2: print('*IDX ', end='')   # $INDEX_ALLOCATION attribute
-            if attrs == 3: print('*ADS ', end='')   # Some other attribute
-            print(ctypes.wstring_at(ctypes.byref(stream_entry, 24)))
-            if stream_entry.OffsetToNext == 0: break
-            offs += stream_entry.OffsetToNext
-        _ = try_read_cluster(volume, cluster, cluster_size)
+        for flags, name in matches:
+            print('    %s%s' % (format_stream_flags(flags), name))
+        _ = try_read_cluster(volume, cluster, args.slow_ms)
         return
 
     # Not set in bitmap
     print('Cluster is not in use.')
-    res = try_read_cluster(volume, cluster, cluster_size)
+    res = try_read_cluster(volume, cluster, args.slow_ms)
     if res != 0 and not force_write:
         print('Done.')
         return
+    if not volume.can_rewrite:
+        print("Can't rewrite clusters of an image. Done.")
+        return
 
     res = input('Try to rewrite that cluster with dummy data (y/n)? ')
     if not res.upper().startswith('Y'):
         return
 
-    tmp_file_name = vol_path + '__dummy_.tmp'
-    handle = kernel32.CreateFileW(
-        tmp_file_name,
-        3 << 30,        # GENERIC_READ | GENERIC_WRITE
-        0,              # Don't share
-        None,
-        2,              # CREATE_ALWAYS
-        0x84000000,     # FILE_FLAG_WRITE_THROUGH | _DELETE_ON_CLOSE
-        None,           # hTemplate
-    )
-    if handle == INVALID_HANDLE:
-        logger.fatal('Error creating temp file')
-        raise ctypes.WinError()
-    res = kernel32.WriteFile(
-        handle,
-        b'.' * cluster_size,
-        cluster_size,
-        ctypes.byref(out_size),
-        None,
-    )
-    if res == 0:
-        logger.fatal('Error writing to temp file')
-        raise ctypes.WinError()
-
-    rpb = RETRIEVAL_POINTERS_BUFFER()
-    res = kernel32.DeviceIoControl(
-        handle,
-        FSCTL_GET_RETRIEVAL_POINTERS,
-        ctypes.byref(ctypes.c_ulonglong(0)),
-        8,
-        ctypes.byref(rpb),
-        ctypes.sizeof(rpb),
-        ctypes.byref(out_size),
-        None,
-    )
-    if res == 0:
-        logger.fatal('Could not retrieve temp file allocation data')
-        raise ctypes.WinError()
-    logger.debug('Retrieval pointers: %s extent(s) starting at VCN %s:' % (rpb.ExtentCount, rpb.StartingVcn))
-    logger.debug(' 1- %s VCs at %s' % (rpb.NextVcn - rpb.StartingVcn, rpb.Lcn))
-    assert rpb.ExtentCount == 1 and rpb.NextVcn - rpb.StartingVcn == 1, 'Dummy file too big?'
-    if rpb.Lcn != cluster:
-        mfd = MOVE_FILE_DATA(
-            FileHandle=handle,
-            StartingVcn=0,
-            StartingLcn=cluster,
-            ClusterCount=1,
-        )
-        res = kernel32.DeviceIoControl(
-            volume,
-            FSCTL_MOVE_FILE,
-            ctypes.byref(mfd),
-            ctypes.sizeof(mfd),
-            None,
-            0,
-            ctypes.byref(out_size),
-            None,
-        )
-        if res == 0:
-            logger.fatal('Failed to move temp file to target cluster')
-            raise ctypes.WinError()
-
-    res = kernel32.CloseHandle(handle)
-    if res == 0:
-        logger.fatal('Error closing temp file')
-        raise ctypes.WinError()
-    res = kernel32.CloseHandle(volume)
-    if res == 0:
-        logger.fatal('Error closing volume handle')
-        raise ctypes.WinError()
+    print_rewrite_results(rewrite_clusters(volume, [cluster]))
+    volume.close()
 
     print("Done!\n")
 
@@ -0,0 +1,246 @@
+"""Read pipelines that keep several reads in flight at once.
+
+Every pipeline takes an iterable of (offset, size) requests and yields
+(offset, size, error code, bytes read, data) for each of them, in the order
+they were requested, while up to `queue_depth` later requests are already
+being serviced. The data is a memoryview into one of the pipeline's own
+reusable buffers, and is only valid until the next completion is requested.
+After each completion, the pipeline's `wait_ms` is how long was spent
+waiting for it to finish, which is how long that read held the scan up.
+"""
+import collections
+import concurrent.futures
+import ctypes
+import errno
+import logging
+import os
+import time
+
+import iostats
+import volume as win_volume
+from volume import aligned_buffer
+from win_types import *
+
+logger = logging.getLogger(__name__)
+
+
+class ReadPipeline:
+    """Base class: subclasses implement _start(slot, offset, size) and
+    _finish(slot) -> (error code, bytes read) for one buffer slot."""
+
+    def __init__(self, queue_depth=8, buffer_size=4 * 1024 * 1024):
+        self.queue_depth = queue_depth
+        self.buffer_size = buffer_size
+        self.buffers = [aligned_buffer(buffer_size) for _ in range(queue_depth)]
+        self.wait_ms = 0.0
+
+    def read(self, requests):
+        requests = iter(requests)
+        free = list(range(self.queue_depth))
+        pending = collections.deque()   # (slot, offset, size), oldest first
+        try:
+            while True:
+                while free:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    offset, size = request
+                    if size > self.buffer_size:
+                        raise ValueError('Read of %s bytes exceeds buffer size %s' % (size, self.buffer_size))
+                    slot = free.pop()
+                    self._start(slot, offset, size)
+                    pending.append((slot, offset, size))
+                if not pending:
+                    return
+                slot, offset, size = pending.popleft()
+                started = time.perf_counter()
+                err, out_size = self._finish(slot)
+                self.wait_ms = (time.perf_counter() - started) * 1000.0
+                yield offset, size, err, out_size, memoryview(self.buffers[slot])[:out_size]
+                free.append(slot)
+        finally:
+            # Don't leave reads running into buffers we no longer own
+            for slot, offset, size in pending:
+                self._cancel(slot)
+
+    def _cancel(self, slot):
+        self._finish(slot)
+
+    def close(self):
+        pass
+
+
+class SyncReader(ReadPipeline):
+    """One read at a time through Volume.read_at(); the baseline the other
+    pipelines are measured against."""
+
+    def __init__(self, volume, buffer_size=4 * 1024 * 1024):
+        super().__init__(1, buffer_size)
+        self.volume = volume
+        self.request = None
+
+    def _start(self, slot, offset, size):
+        self.request = offset, size
+
+    def _finish(self, slot):
+        offset, size = self.request
+        return self.volume.read_at(offset, self.buffers[slot], size)
+
+    def _cancel(self, slot):
+        pass
+
+
+class ThreadPoolReader(ReadPipeline):
+    """Services reads on a pool of `queue_depth` threads.
+
+    `read_into(offset, buffer, size)` must be a positioned read that is safe
+    to call from several threads at once, returning (error code, bytes read).
+    """
+
+    def __init__(self, read_into, queue_depth=8, buffer_size=4 * 1024 * 1024):
+        super().__init__(queue_depth, buffer_size)
+        self.read_into = read_into
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=queue_depth)
+        self.futures = [None] * queue_depth
+
+    def _start(self, slot, offset, size):
+        self.futures[slot] = self.executor.submit(self.read_into, offset, self.buffers[slot], size)
+
+    def _finish(self, slot):
+        return self.futures[slot].result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ImageFileReader(ThreadPoolReader):
+    """Positioned reads from a disk or volume image file (or a block device)
+    with os.preadv(), for running and benchmarking scans off Windows.
+
+    I/O errors are reported as ERROR_IO_DEVICE so they look like the read
+    failures the Windows code paths see.
+    """
+
+    def __init__(self, path, queue_depth=8, buffer_size=4 * 1024 * 1024):
+        super().__init__(self._pread, queue_depth, buffer_size)
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    def _pread(self, offset, buf, size):
+        started = time.perf_counter()
+        try:
+            result = 0, os.preadv(self.fd, [memoryview(buf)[:size]], offset)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            result = 1117, 0    # ERROR_IO_DEVICE
+        if iostats.recorder is not None:
+            iostats.recorder.record('read', time.perf_counter() - started, result[1], result[0], offset)
+        return result
+
+    def close(self):
+        super().close()
+        os.close(self.fd)
+
+
+class OverlappedReader(ReadPipeline):
+    """Overlapped ReadFile calls on a second, FILE_FLAG_OVERLAPPED handle to
+    the volume, with one OVERLAPPED structure and event per buffer slot.
+
+    Completions are collected in order with GetOverlappedResult(), which
+    only blocks when the oldest read hasn't finished yet.
+    """
+
+    def __init__(self, volume, queue_depth=8, buffer_size=4 * 1024 * 1024):
+        super().__init__(queue_depth, buffer_size)
+        kernel32 = win_volume.kernel32
+        self.handle = kernel32.CreateFileW(
+            volume.name,
+            2 << 30,        # GENERIC_READ
+            0x3,            # FILE_SHARE_READ | FILE_SHARE_WRITE
+            None,
+            0x3,            # OPEN_EXISTING
+            0x60000000,     # FILE_FLAG_NO_BUFFERING | FILE_FLAG_OVERLAPPED
+            None,
+        )
+        if self.handle == INVALID_HANDLE:
+            logger.fatal('Failed to open an overlapped handle to the volume')
+            raise ctypes.WinError()
+        self.overlapped = [OVERLAPPED() for _ in range(queue_depth)]
+        for ov in self.overlapped:
+            ov.hEvent = kernel32.CreateEventW(None, True, False, None)
+            if not ov.hEvent:
+                raise ctypes.WinError()
+        self.errors = [0] * queue_depth     # Errors from ReadFile calls that never started
+        self.requests = [(0, 0, 0.0)] * queue_depth     # (offset, size, time started) for iostats
+        self.volume_start = volume.start or 0     # None with several extents; see IoStats
+        self._out_size = ctypes.c_ulong()
+
+    def _start(self, slot, offset, size):
+        kernel32 = win_volume.kernel32
+        ov = self.overlapped[slot]
+        ov.Offset = offset & 0xffffffff
+        ov.OffsetHigh = offset >> 32
+        if iostats.recorder is not None:
+            self.requests[slot] = offset, size, time.perf_counter()
+        res = kernel32.ReadFile(self.handle, self.buffers[slot], size, None, ctypes.byref(ov))
+        self.errors[slot] = 0
+        if res == 0:
+            err = kernel32.GetLastError()
+            if err != 997:      # ERROR_IO_PENDING
+                self.errors[slot] = err
+
+    def _finish(self, slot):
+        kernel32 = win_volume.kernel32
+        if self.errors[slot]:
+            err, out_size = self.errors[slot], 0
+        else:
+            res = kernel32.GetOverlappedResult(self.handle, ctypes.byref(self.overlapped[slot]),
+                                               ctypes.byref(self._out_size), True)
+            err, out_size = (0, self._out_size.value) if res else (kernel32.GetLastError(), 0)
+        stats = iostats.recorder
+        if stats is not None:
+            offset, size, started = self.requests[slot]
+            stats.record('read', time.perf_counter() - started, out_size, err, self.volume_start + offset)
+        return err, out_size
+
+    def _cancel(self, slot):
+        if not self.errors[slot]:
+            win_volume.kernel32.CancelIoEx(self.handle, ctypes.byref(self.overlapped[slot]))
+        self._finish(slot)
+
+    def close(self):
+        kernel32 = win_volume.kernel32
+        for ov in self.overlapped:
+            kernel32.CloseHandle(ov.hEvent)
+        kernel32.CloseHandle(self.handle)
+
+
+def measure(pipeline, offset, length, read_size):
+    """Reads `length` bytes from `offset` through a pipeline; returns MB/s."""
+    requests = ((pos, min(read_size, offset + length - pos))
+                for pos in range(offset, offset + length, read_size))
+    start = time.perf_counter()
+    total = 0
+    for _, _, err, out_size, _ in pipeline.read(requests):
+        total += out_size
+    return total / (time.perf_counter() - start) / 1e6
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure read throughput of an image file or device against queue depth.')
+    parser.add_argument('path')
+    parser.add_argument('--size', type=int, default=1024, help='MB to read (default: %(default)s).')
+    parser.add_argument('--read-size', type=int, default=1024, help='KB per read (default: %(default)s).')
+    parser.add_argument('--depths', default='1,2,4,8,16,32')
+    args = parser.parse_args()
+    for depth in [int(d) for d in args.depths.split(',')]:
+        reader = ImageFileReader(args.path, depth, args.read_size * 1024)
+        rate = measure(reader, 0, args.size * 1024 * 1024, args.read_size * 1024)
+        reader.close()
+        print('queue depth %3s: %8.1f MB/s' % (depth, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Rewriting free clusters with dummy data, so that the drive reallocates
+any bad sectors in them."""
+import ctypes
+import logging
+
+import volume as win_volume
+from volume import aligned_buffer, get_error_string, get_retrieval_pointers
+from win_types import *
+
+logger = logging.getLogger(__name__)
+
+DUMMY_FILE_NAME = '__dummy_.tmp'
+IN_USE = -2     # Move error code for a target found in use just before the rewrite
+
+
+def contiguous_runs(clusters):
+    """Returns [(first LCN, count)] for a sorted list of distinct clusters."""
+    runs = []
+    for cluster in clusters:
+        if runs and runs[-1][0] + runs[-1][1] == cluster:
+            runs[-1][1] += 1
+        else:
+            runs.append([cluster, 1])
+    return [tuple(run) for run in runs]
+
+
+def clusters_in_use(volume, clusters, max_read=64 * 1024):
+    """Returns the set of `clusters` that the volume bitmap shows in use
+    right now, read straight from the volume rather than any cached copy."""
+    clusters = sorted(set(clusters))
+    in_use = set()
+    i = 0
+    while i < len(clusters):
+        first = clusters[i] - clusters[i] % 8
+        # Every target within one bitmap read of the first
+        j = i
+        while j + 1 < len(clusters) and clusters[j + 1] - first < max_read * 8:
+            j += 1
+        start_lcn, data = volume.read_bitmap(first, (clusters[j] - first) // 8 + 1)
+        for cluster in clusters[i:j + 1]:
+            offs = cluster - start_lcn
+            if data[offs // 8] & (1 << (offs % 8)):
+                in_use.add(cluster)
+        i = j + 1
+    return in_use
+
+
+def rewrite_clusters(volume, clusters, max_write=1024 * 1024):
+    """Rewrites many free clusters at once.
+
+    One write-through dummy file is created with a cluster for each target
+    and written out, then moved onto the targets with one FSCTL_MOVE_FILE per
+    contiguous run of them (runs that fail are retried a cluster at a time).
+    Every target is then read back through the volume handle, one read per
+    run, before the file is closed and deleted.
+
+    The bitmap bits of the targets are checked again first, and any that
+    have been allocated since the caller's copy of the bitmap was read are
+    left alone, with a move error code of IN_USE.
+
+    Returns a list of (cluster, move error code, read error code), with
+    error code zero meaning success, in LCN order.
+    """
+    kernel32 = win_volume.kernel32
+    clusters = sorted(set(clusters))
+    in_use = clusters_in_use(volume, clusters)
+    if in_use:
+        print('Skipping %s cluster(s) allocated since the bitmap was read.' % len(in_use))
+        clusters = [cluster for cluster in clusters if cluster not in in_use]
+    skipped = [(cluster, IN_USE, 0) for cluster in sorted(in_use)]
+    if not clusters:
+        return skipped
+    runs = contiguous_runs(clusters)
+    cluster_size = volume.cluster_size
+    out_size = ctypes.c_ulong()
+
+    handle = kernel32.CreateFileW(
+        volume.path + DUMMY_FILE_NAME,
+        3 << 30,        # GENERIC_READ | GENERIC_WRITE
+        0,              # Don't share
+        None,
+        2,              # CREATE_ALWAYS
+        0x84000000,     # FILE_FLAG_WRITE_THROUGH | _DELETE_ON_CLOSE
+        None,           # hTemplate
+    )
+    if handle == INVALID_HANDLE:
+        logger.fatal('Error creating temp file')
+        raise ctypes.WinError()
+    try:
+        remaining = len(clusters) * cluster_size
+        data = b'.' * min(remaining, max_write)
+        while remaining:
+            size = min(remaining, len(data))
+            res = kernel32.WriteFile(handle, data, size, ctypes.byref(out_size), None)
+            if res == 0:
+                logger.fatal('Error writing to temp file')
+                raise ctypes.WinError()
+            remaining -= size
+
+        placed = file_lcns(handle)
+        move_errors = {}
+        vcn = 0
+        for lcn, count in runs:
+            if all(placed.get(vcn + i) == lcn + i for i in range(count)):
+                pass    # Already allocated there
+            else:
+                err = move_clusters(volume, handle, vcn, lcn, count)
+                if err and count > 1:
+                    # One unusable target fails the whole run; move the rest one by one
+                    for i in range(count):
+                        move_errors[lcn + i] = move_clusters(volume, handle, vcn + i, lcn + i, 1)
+                else:
+                    move_errors.update((lcn + i, err) for i in range(count))
+            vcn += count
+
+        placed = file_lcns(handle)
+        vcn = 0
+        results = []
+        for lcn, count in runs:
+            read_errors = read_back(volume, lcn, count)
+            for i in range(count):
+                cluster = lcn + i
+                err = move_errors.get(cluster, 0)
+                if not err and placed.get(vcn + i) != cluster:
+                    err = -1    # Move reported success, but the file isn't there
+                results.append((cluster, err, read_errors[i]))
+            vcn += count
+    finally:
+        res = kernel32.CloseHandle(handle)
+        if res == 0:
+            logger.fatal('Error closing temp file')
+            raise ctypes.WinError()
+    return sorted(results + skipped)
+
+
+def file_lcns(handle):
+    """Returns a dict of VCN -> LCN for every allocated cluster of a file."""
+    lcns = {}
+    for vcn, lcn, count in get_retrieval_pointers(handle):
+        for i in range(count):
+            lcns[vcn + i] = lcn + i
+    return lcns
+
+
+def move_clusters(volume, handle, vcn, lcn, count):
+    """Moves `count` clusters of a file from `vcn` onto the volume at `lcn`.
+    Returns the error code, zero on success."""
+    mfd = MOVE_FILE_DATA(
+        FileHandle=handle,
+        StartingVcn=vcn,
+        StartingLcn=lcn,
+        ClusterCount=count,
+    )
+    res = win_volume.kernel32.DeviceIoControl(
+        volume.handle,
+        FSCTL_MOVE_FILE,
+        ctypes.byref(mfd),
+        ctypes.sizeof(mfd),
+        None,
+        0,
+        ctypes.byref(ctypes.c_ulong()),
+        None,
+    )
+    if res == 0:
+        err = win_volume.kernel32.GetLastError()
+        logger.info('Moving %s cluster(s) to LCN %s failed with error %s' % (count, lcn, err))
+        return err
+    return 0
+
+
+def read_back(volume, lcn, count):
+    """Reads a run of clusters in one go, or one at a time if that fails.
+    Returns a list of error codes, one per cluster."""
+    buf = aligned_buffer(count * volume.cluster_size)
+    err, out_size = volume.read_at(lcn * volume.cluster_size, buf, count * volume.cluster_size)
+    if not err or count == 1:
+        return [err] * count
+    return [volume.read_cluster(lcn + i)[0] for i in range(count)]
+
+
+def print_rewrite_results(results):
+    """Prints the table of results from rewrite_clusters()."""
+    print('%-14s %-30s %s' % ('Cluster', 'Move', 'Read back'))
+    for cluster, move_err, read_err in results:
+        if move_err == -1:
+            moved = 'not moved'
+        elif move_err == IN_USE:
+            moved = 'in use, skipped'
+        elif move_err:
+            moved = 'error %s: %s' % (move_err, get_error_string(move_err).strip())
+        else:
+            moved = 'ok'
+        if move_err == IN_USE:
+            read = '-'
+        else:
+            read = 'ok' if not read_err else 'CRC error' if read_err == 23 else 'error %s' % read_err
+        print('%-14s %-30s %s' % (cluster, moved[:30], read))
+    failed = sum(1 for cluster, move_err, read_err in results if move_err or read_err)
+    print('%s of %s cluster(s) rewritten and read back successfully.' % (len(results) - failed, len(results)))
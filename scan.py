@@ -0,0 +1,204 @@
+"""Surface scanning: find unreadable clusters by reading the volume directly."""
+import ctypes
+import logging
+import time
+
+from probe import DEFAULT_SLOW_MS, sector_timings, timed_read
+from readers import OverlappedReader, SyncReader, ThreadPoolReader
+from volume import Volume, aligned_buffer
+
+logger = logging.getLogger(__name__)
+
+# Read errors that mean the medium itself is bad, rather than that we asked
+# for something wrong
+MEDIA_ERRORS = (
+    23,     # ERROR_CRC
+    483,    # ERROR_DEVICE_HARDWARE_ERROR
+    1117,   # ERROR_IO_DEVICE
+)
+
+
+class SurfaceScan:
+    """Reads a range of clusters in large chunks, and narrows any failed
+    chunk down to the clusters and sectors that can't be read.
+
+    A chunk that reads cleanly costs one ReadFile call, so a healthy disk is
+    scanned at close to its sequential bandwidth; a chunk that fails is
+    bisected until each failing cluster is found, and those clusters are
+    then read one sector at a time.
+
+    With a queue depth above one, chunk reads go through an OverlappedReader
+    (or, for volumes other than a mounted Volume, a ThreadPoolReader) so
+    that several are in flight at once.
+
+    Each finding is a tuple of (cluster, error code, list of unreadable
+    physical disk sectors).
+
+    Reads are also timed. A chunk that takes more than `slow_ms` longer than
+    the scan's usual transfer time for its size is bisected the same way,
+    re-reading each half, and each cluster that is still slow is read one
+    sector at a time. Each slow finding is a tuple of (cluster, list of
+    (physical disk sector, milliseconds) for the sectors slower than
+    `slow_ms`). A `slow_ms` of zero turns this off.
+    """
+
+    def __init__(self, volume, chunk_size=4 * 1024 * 1024, queue_depth=1, slow_ms=DEFAULT_SLOW_MS):
+        self.volume = volume
+        self.slow_ms = slow_ms
+        self.chunk_clusters = max(1, chunk_size // volume.cluster_size)
+        self.buf = aligned_buffer(self.chunk_clusters * volume.cluster_size)
+        chunk_bytes = self.chunk_clusters * volume.cluster_size
+        if queue_depth > 1 and isinstance(volume, Volume):
+            self.reader = OverlappedReader(volume, queue_depth, chunk_bytes)
+        elif queue_depth > 1:
+            self.reader = ThreadPoolReader(volume.read_at, queue_depth, chunk_bytes)
+        else:
+            self.reader = SyncReader(volume, chunk_bytes)
+        self.findings = []
+        self.slow = []
+        self.bytes_read = 0
+        self.reads = 0
+        self.fast_ms = 0.0      # Time taken by the reads that weren't slow...
+        self.fast_bytes = 0     # ...and how much they read, for the usual transfer rate
+
+    def read_clusters(self, first, count):
+        """Reads `count` clusters starting at `first`; returns (error code,
+        milliseconds taken), with the error code zero on success."""
+        size = count * self.volume.cluster_size
+        err, out_size, ms = timed_read(self.volume, first * self.volume.cluster_size, self.buf, size)
+        return self.check_read(first, size, err, out_size), ms
+
+    def is_slow(self, size, ms):
+        """True if a read of `size` bytes taking `ms` milliseconds was slow."""
+        if not self.slow_ms:
+            return False
+        usual_ms = size * self.fast_ms / self.fast_bytes if self.fast_bytes else 0.0
+        if ms > usual_ms + self.slow_ms:
+            return True
+        self.fast_ms += ms
+        self.fast_bytes += size
+        return False
+
+    def check_read(self, first, size, err, out_size):
+        """Accounts for one read; raises for errors that aren't media errors."""
+        self.reads += 1
+        if err == 0:
+            self.bytes_read += out_size
+            if out_size != size:
+                logger.warning('Partial read at cluster %s (%s of %s bytes)' % (first, out_size, size))
+        elif err not in MEDIA_ERRORS:
+            raise ctypes.WinError(err)
+        return err
+
+    def scan(self, first=0, last=None, progress=None):
+        """Scans clusters first..last (inclusive; defaults to the whole volume).
+
+        `progress`, if given, is called as progress(clusters done, scan) after
+        every chunk. Returns the list of findings for this range.
+        """
+        if last is None:
+            last = self.volume.total_clusters - 1
+        return self.scan_runs([first], [last + 1 - first], progress)
+
+    def scan_runs(self, starts, lengths, progress=None, checkpoint=None):
+        """Scans only the given runs of clusters (for example the free runs
+        from bitmap.free_runs()), splitting each run into chunks.
+
+        `checkpoint`, if given, is a ScanCheckpoint told about each chunk
+        once it has been read and anything found in it recorded."""
+        found = len(self.findings)
+        cluster_size = self.volume.cluster_size
+        done = 0
+        for offset, size, err, out_size, data in self.reader.read(self._requests(starts, lengths)):
+            cluster = offset // cluster_size
+            if self.check_read(cluster, size, err, out_size):
+                self.bisect(cluster, size // cluster_size, err)
+            elif self.is_slow(size, self.reader.wait_ms):
+                self.bisect_slow(cluster, size // cluster_size)
+            done += size // cluster_size
+            if checkpoint is not None:
+                checkpoint.chunk_done(cluster, size // cluster_size, self)
+            if progress is not None:
+                progress(done, self)
+        return self.findings[found:]
+
+    def _requests(self, starts, lengths):
+        cluster_size = self.volume.cluster_size
+        for start, length in zip(starts, lengths):
+            start, end = int(start), int(start + length)
+            for cluster in range(start, end, self.chunk_clusters):
+                yield cluster * cluster_size, min(self.chunk_clusters, end - cluster) * cluster_size
+
+    def close(self):
+        self.reader.close()
+
+    def bisect(self, first, count, err):
+        """Narrows a failed read of `count` clusters down to the failing clusters."""
+        if count == 1:
+            self.findings.append((first, err, self.bad_sectors(first)))
+            return
+        half = count // 2
+        for start, length in ((first, half), (first + half, count - half)):
+            err, ms = self.read_clusters(start, length)
+            if err:
+                self.bisect(start, length, err)
+            elif self.is_slow(length * self.volume.cluster_size, ms):
+                self.bisect_slow(start, length)
+
+    def bisect_slow(self, first, count):
+        """Narrows a slow read of `count` clusters down to the slow clusters,
+        and those to the slow sectors."""
+        if count == 1:
+            timings = sector_timings(self.volume, first, self.buf)
+            self.reads += len(timings)
+            bad = self.check_sectors(timings)
+            if bad:
+                self.findings.append((first, next(err for sector, err, ms in timings if err), bad))
+            slow = [(sector, ms) for sector, err, ms in timings if not err and ms > self.slow_ms]
+            if slow:
+                self.slow.append((first, slow))
+            return
+        half = count // 2
+        for start, length in ((first, half), (first + half, count - half)):
+            err, ms = self.read_clusters(start, length)
+            if err:
+                self.bisect(start, length, err)
+            elif self.is_slow(length * self.volume.cluster_size, ms):
+                self.bisect_slow(start, length)
+
+    def bad_sectors(self, cluster):
+        """Reads a cluster one sector at a time; returns the disk sectors that fail."""
+        timings = sector_timings(self.volume, cluster, self.buf)
+        self.reads += len(timings)
+        return self.check_sectors(timings)
+
+    def check_sectors(self, timings):
+        """Returns the sectors from sector_timings() that couldn't be read;
+        raises for errors that aren't media errors."""
+        bad = []
+        for sector, err, ms in timings:
+            if err in MEDIA_ERRORS:
+                bad.append(sector)
+            elif err:
+                raise ctypes.WinError(err)
+        return bad
+
+
+def print_progress(total_clusters, interval=2.0):
+    """Returns a progress callback for SurfaceScan.scan() that prints how
+    far the scan has got and the read rate every `interval` seconds."""
+    start_time = time.monotonic()
+    state = {'next_print': start_time + interval}
+
+    def progress(done, scan):
+        now = time.monotonic()
+        if now < state['next_print'] and done < total_clusters:
+            return
+        state['next_print'] = now + interval
+        rate = scan.bytes_read / max(now - start_time, 1e-6) / 1e6
+        print('\r %s of %s clusters (%.1f%%), %.1f MB/s, %s bad and %s slow cluster(s) found '
+              % (done, total_clusters, 100.0 * done / total_clusters, rate, len(scan.findings), len(scan.slow)),
+              end='')
+        if done >= total_clusters:
+            print()
+    return progress
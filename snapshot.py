@@ -0,0 +1,114 @@
+"""A cache of each volume's geometry and bitmap, so that repeated runs
+against an unchanged volume can skip the setup queries and the bitmap
+download."""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from bitmap import FullBitmap
+from win_types import VOLUME_BITMAP_BUFFER
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'QSSNAP1\0'
+# magic, serial number, USN journal ID, next USN, bytes per sector, cluster
+# size, total clusters, number of extents, bitmap offset, bitmap size
+_HEADER = struct.Struct('<8sIQqIIQIQQ')
+_EXTENT = struct.Struct('<IQQ')     # disk number, starting offset, length
+_ALIGNMENT = 4096
+
+
+def default_cache_dir():
+    base = os.environ.get('LOCALAPPDATA') or tempfile.gettempdir()
+    return os.path.join(base, 'query_sector')
+
+
+def snapshot_path(cache_dir, serial):
+    return os.path.join(cache_dir, '%08X.snapshot' % serial)
+
+
+def open_snapshot(volume, cache_dir):
+    """Opens a Volume using the snapshot cached in `cache_dir` if it is
+    still current, and returns its whole bitmap as a FullBitmap.
+
+    A snapshot is current if it was taken at the volume's present USN
+    journal ID and next USN, i.e. nothing has been written to the volume
+    since. Its bitmap is then mapped straight from the cache file. If it
+    isn't, the volume is opened and its bitmap loaded as usual, and a new
+    snapshot written. Volumes without an active change journal can't be
+    checked cheaply, so they are never cached. The volume's handle may
+    already be open (so that a ChangeTracker can be started first).
+    """
+    if volume.handle is None:
+        volume.open_handle()
+    serial = volume.get_serial_number()
+    journal = volume.query_usn_journal()
+    path = snapshot_path(cache_dir, serial)
+    if journal is None:
+        print(' Volume has no active change journal; not using the snapshot cache')
+    else:
+        bitmap = load_snapshot(volume, path, serial, journal)
+        if bitmap is not None:
+            print(' Using cached volume snapshot %s (USN %s)' % (path, journal.NextUsn))
+            return bitmap
+
+    volume.inspect()
+    bm_buf = volume.load_bitmap()
+    if journal is not None:
+        try:
+            save_snapshot(volume, path, serial, journal, bm_buf)
+        except OSError as e:
+            logger.warning('Could not save volume snapshot to %s: %s' % (path, e))
+    return FullBitmap(bm_buf)
+
+
+def load_snapshot(volume, path, serial, journal):
+    """Restores the volume's geometry from a snapshot file and maps its
+    bitmap, or returns None if there is no current snapshot."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        (magic, snap_serial, journal_id, next_usn, bytes_per_sector, cluster_size, total_clusters,
+         extent_count, bitmap_offset, bitmap_size) = _HEADER.unpack(header)
+        if magic != _MAGIC or snap_serial != serial:
+            return None
+        if journal_id != journal.UsnJournalID or next_usn != journal.NextUsn:
+            logger.info('Volume snapshot %s is stale (USN %s, volume is at %s)' % (path, next_usn, journal.NextUsn))
+            return None
+        extent_data = f.read(extent_count * _EXTENT.size)
+        if len(extent_data) < extent_count * _EXTENT.size:
+            return None
+        extents = list(_EXTENT.iter_unpack(extent_data))
+        # Copy-on-write, so the bitmap buffer is writable as ctypes needs
+        # but nothing is read until it is used
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(mapped) < bitmap_offset + bitmap_size:
+        return None
+    volume.restore_geometry(extents, bytes_per_sector, cluster_size, total_clusters)
+    return FullBitmap(memoryview(mapped)[bitmap_offset:bitmap_offset + bitmap_size])
+
+
+def save_snapshot(volume, path, serial, journal, bm_buf):
+    """Writes the volume's geometry and raw bitmap buffer to a snapshot file."""
+    header = VOLUME_BITMAP_BUFFER.from_buffer(bm_buf)
+    bitmap_size = 16 + (header.BitmapSize + 7) // 8
+    extents_size = len(volume.extents) * _EXTENT.size
+    bitmap_offset = -(-(_HEADER.size + extents_size) // _ALIGNMENT) * _ALIGNMENT
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, serial, journal.UsnJournalID, journal.NextUsn,
+                             volume.bytes_per_sector, volume.cluster_size, volume.total_clusters,
+                             len(volume.extents), bitmap_offset, bitmap_size))
+        for extent in volume.extents:
+            f.write(_EXTENT.pack(*extent))
+        f.write(b'\0' * (bitmap_offset - _HEADER.size - extents_size))
+        f.write(memoryview(bm_buf)[:bitmap_size])
+    os.replace(tmp_path, path)
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+import volume as win_volume
+from fake_kernel32 import FakeDisk, FakeKernel32
+from ntfs_builder import build_image
+from ntfs_image import NtfsImage
+from volume import Volume
+
+
+@pytest.fixture
+def fake_disk():
+    """A 4 MB volume (1024 clusters of 4 KB) on disk 0 at offset 1 MB."""
+    return FakeDisk(total_clusters=1024)
+
+
+@pytest.fixture
+def fake_kernel32(monkeypatch):
+    """Installs a FakeKernel32 for a FakeDisk: call it with the disk."""
+    def install(disk):
+        kernel32 = FakeKernel32(disk)
+        monkeypatch.setattr(win_volume, 'kernel32', kernel32)
+        return kernel32
+    return install
+
+
+@pytest.fixture
+def open_volume(fake_kernel32, capsys):
+    """Opens a Volume on a FakeDisk: call it with the disk."""
+    volumes = []
+
+    def open_volume(disk, unbuffered=False):
+        fake_kernel32(disk)
+        volume = Volume('X', unbuffered=unbuffered).open()
+        volumes.append(volume)
+        capsys.readouterr()     # Drop what opening it printed
+        return volume
+    yield open_volume
+    for volume in volumes:
+        if volume.handle is not None:
+            volume.close()
+
+
+@pytest.fixture(scope='session')
+def image_path(tmp_path_factory):
+    """An image from ntfs_builder of a disk with one MBR partition."""
+    path = str(tmp_path_factory.mktemp('images') / 'ntfs.img')
+    build_image(path)
+    return path
+
+
+@pytest.fixture
+def mapfile(image_path, tmp_path):
+    """Writes a ddrescue mapfile for the image fixture: call it with the
+    image byte offsets of the 512-byte sectors that weren't recovered."""
+    def write(bad_offsets):
+        size = os.path.getsize(image_path)
+        lines = ['# Mapfile', '0x0 ?']
+        pos = 0
+        for offset in sorted(bad_offsets):
+            if offset > pos:
+                lines.append('0x%x 0x%x +' % (pos, offset - pos))
+            lines.append('0x%x 0x200 -' % offset)
+            pos = offset + 512
+        lines.append('0x%x 0x%x +' % (pos, size - pos))
+        path = tmp_path / 'ntfs.map'
+        path.write_text('\n'.join(lines) + '\n')
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def image_volume(image_path, capsys):
+    image = NtfsImage(image_path).open()
+    capsys.readouterr()
+    yield image
+    image.close()
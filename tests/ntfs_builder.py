@@ -0,0 +1,190 @@
+"""Builds small synthetic NTFS images for the tests: just enough of a boot
+sector, MFT and $Bitmap for ntfs_image.py to read, with a few files laid
+out at known clusters.
+
+    Cluster(s)  Use
+    0           boot sector
+    16-31       $MFT (16-23 and 3000-3007 with mft_split)
+    40          $Bitmap
+    50          root directory index
+    60          \\docs directory index
+    100-103     \\docs\\report.txt, VCNs 0-3
+    200-201     \\docs\\report.txt, VCNs 4-5
+    300-301     \\frag.bin, VCNs 0-1
+    400-402     \\frag.bin:ads
+    500-504     \\frag.bin, VCNs 2-6 (in an extension record)
+    600         \\deleted.txt (record not in use; cluster free)
+    700, 710    \\sparse.bin, VCNs 0 and 11
+    1000        $BadClus:$Bad (a bad cluster; free in the bitmap)
+    2000-2002   \\last.txt
+
+Every used data cluster starts with its own LCN as 8 little-endian bytes.
+"""
+import struct
+
+CLUSTER_SIZE = 4096
+SECTOR_SIZE = 512
+RECORD_SIZE = 1024
+MFT_RECORDS = 64
+MFT_LCN = 16
+BITMAP_LCN = 40
+
+
+def encode_runlist(runs):
+    """Encodes [(LCN or None for sparse, length)] as an NTFS mapping pairs array."""
+    out = b''
+    prev = 0
+    for lcn, length in runs:
+        length_bytes = length.to_bytes(8, 'little').rstrip(b'\0') or b'\0'
+        if lcn is None:
+            out += bytes([len(length_bytes)]) + length_bytes
+            continue
+        delta = lcn - prev
+        prev = lcn
+        n = 1
+        while not -(1 << (8 * n - 1)) <= delta < 1 << (8 * n - 1):
+            n += 1
+        out += bytes([len(length_bytes) | n << 4]) + length_bytes + delta.to_bytes(n, 'little', signed=True)
+    return out + b'\0'
+
+
+def nonresident_attribute(attr_type, runs, name='', start_vcn=0, size=None):
+    runlist = encode_runlist(runs)
+    name_bytes = name.encode('utf-16-le')
+    name_offset = 64
+    runlist_offset = (name_offset + len(name_bytes) + 7) & ~7
+    length = (runlist_offset + len(runlist) + 7) & ~7
+    clusters = sum(count for lcn, count in runs)
+    if size is None:
+        size = clusters * CLUSTER_SIZE
+    attr = bytearray(length)
+    struct.pack_into('<IIBBHHH', attr, 0, attr_type, length, 1, len(name), name_offset, 0, 0)
+    struct.pack_into('<QQHH4xQQQ', attr, 16, start_vcn, start_vcn + clusters - 1, runlist_offset, 0,
+                     clusters * CLUSTER_SIZE, size, size)
+    attr[name_offset:name_offset + len(name_bytes)] = name_bytes
+    attr[runlist_offset:runlist_offset + len(runlist)] = runlist
+    return bytes(attr)
+
+
+def resident_attribute(attr_type, value):
+    offset = 24
+    length = (offset + len(value) + 7) & ~7
+    attr = bytearray(length)
+    struct.pack_into('<IIBBHHHIH', attr, 0, attr_type, length, 0, 0, 0, 0, 0, len(value), offset)
+    attr[offset:offset + len(value)] = value
+    return bytes(attr)
+
+
+def file_name_attribute(parent, name, namespace=1):
+    name_bytes = name.encode('utf-16-le')
+    value = bytearray(66 + len(name_bytes))
+    struct.pack_into('<Q', value, 0, parent | 1 << 48)
+    value[64] = len(name)
+    value[65] = namespace
+    value[66:] = name_bytes
+    return resident_attribute(0x30, bytes(value))
+
+
+def mft_record(attributes, flags=1, base=0):
+    """A FILE record holding `attributes`, with its update sequence fixups applied."""
+    record = bytearray(RECORD_SIZE)
+    record[0:4] = b'FILE'
+    usa_offset = 0x30
+    usa_count = RECORD_SIZE // SECTOR_SIZE + 1
+    struct.pack_into('<HH', record, 4, usa_offset, usa_count)
+    struct.pack_into('<H', record, 0x10, 1)
+    first = (usa_offset + 2 * usa_count + 7) & ~7
+    struct.pack_into('<HH', record, 0x14, first, flags)
+    struct.pack_into('<Q', record, 0x20, base)
+    pos = first
+    for attr in attributes:
+        record[pos:pos + len(attr)] = attr
+        pos += len(attr)
+    struct.pack_into('<I', record, pos, 0xffffffff)
+    check = b'\x07\x00'
+    record[usa_offset:usa_offset + 2] = check
+    for i in range(1, usa_count):
+        end = i * SECTOR_SIZE
+        record[usa_offset + 2 * i:usa_offset + 2 * i + 2] = record[end - 2:end]
+        record[end - 2:end] = check
+    return bytes(record)
+
+
+def build_image(path, partition_offset=1024 * 1024, total_clusters=4096, gpt=False, mft_split=False):
+    """Writes an image to `path`: a bare volume with a partition_offset of
+    0, otherwise a disk with one MBR (or GPT) partition holding it. Returns
+    the volume bitmap."""
+    bitmap = bytearray((total_clusters + 7) // 8)
+
+    def use(lcn, count):
+        for cluster in range(lcn, lcn + count):
+            bitmap[cluster // 8] |= 1 << (cluster % 8)
+
+    mft_clusters = MFT_RECORDS * RECORD_SIZE // CLUSTER_SIZE
+    mft_runs = [(MFT_LCN, 8), (3000, 8)] if mft_split else [(MFT_LCN, mft_clusters)]
+    for lcn, count in mft_runs:
+        use(lcn, count)
+    bitmap_clusters = -(-len(bitmap) // CLUSTER_SIZE)
+    use(BITMAP_LCN, bitmap_clusters)
+    use(0, 1)
+
+    records = {
+        0: mft_record([file_name_attribute(5, '$MFT'), nonresident_attribute(0x80, mft_runs)]),
+        5: mft_record([file_name_attribute(5, '.'), nonresident_attribute(0xa0, [(50, 1)], '$I30')], flags=3),
+        6: mft_record([file_name_attribute(5, '$Bitmap'),
+                       nonresident_attribute(0x80, [(BITMAP_LCN, bitmap_clusters)], size=len(bitmap))]),
+        8: mft_record([file_name_attribute(5, '$BadClus'),
+                       nonresident_attribute(0x80, [(None, 1000), (1000, 1), (None, total_clusters - 1001)],
+                                             '$Bad')]),
+        30: mft_record([file_name_attribute(5, 'docs'), file_name_attribute(5, 'DOCS', 2),
+                        nonresident_attribute(0xa0, [(60, 1)], '$I30')], flags=3),
+        31: mft_record([file_name_attribute(30, 'REPORT~1.TXT', 2), file_name_attribute(30, 'report.txt'),
+                        nonresident_attribute(0x80, [(100, 4), (200, 2)])]),
+        32: mft_record([file_name_attribute(5, 'frag.bin'), nonresident_attribute(0x80, [(300, 2)]),
+                        nonresident_attribute(0x80, [(400, 3)], 'ads')]),
+        33: mft_record([nonresident_attribute(0x80, [(500, 5)], start_vcn=2)], base=32 | 1 << 48),
+        34: mft_record([file_name_attribute(5, 'deleted.txt'), nonresident_attribute(0x80, [(600, 1)])], flags=0),
+        35: mft_record([file_name_attribute(5, 'sparse.bin'),
+                        nonresident_attribute(0x80, [(700, 1), (None, 10), (710, 1)])]),
+        63: mft_record([file_name_attribute(5, 'last.txt'), nonresident_attribute(0x80, [(2000, 3)])]),
+    }
+    for lcn, count in ((50, 1), (60, 1), (100, 4), (200, 2), (300, 2), (400, 3), (500, 5), (700, 1), (710, 1),
+                       (2000, 3)):
+        use(lcn, count)
+    mft = bytearray(MFT_RECORDS * RECORD_SIZE)
+    for number, record in records.items():
+        mft[number * RECORD_SIZE:(number + 1) * RECORD_SIZE] = record
+
+    image = bytearray(partition_offset + total_clusters * CLUSTER_SIZE + SECTOR_SIZE)
+    volume = memoryview(image)[partition_offset:]
+    for cluster in range(total_clusters):
+        if bitmap[cluster // 8] & (1 << (cluster % 8)):
+            volume[cluster * CLUSTER_SIZE:cluster * CLUSTER_SIZE + 8] = struct.pack('<Q', cluster)
+    boot = bytearray(SECTOR_SIZE)
+    boot[3:11] = b'NTFS    '
+    struct.pack_into('<HB', boot, 11, SECTOR_SIZE, CLUSTER_SIZE // SECTOR_SIZE)
+    struct.pack_into('<QQQ', boot, 0x28, total_clusters * CLUSTER_SIZE // SECTOR_SIZE, MFT_LCN, 2)
+    struct.pack_into('<b', boot, 0x40, -10)     # 2 ** 10 byte MFT records
+    boot[510:512] = b'\x55\xaa'
+    volume[0:SECTOR_SIZE] = boot
+    pos = 0
+    for lcn, count in mft_runs:
+        volume[lcn * CLUSTER_SIZE:(lcn + count) * CLUSTER_SIZE] = mft[pos:pos + count * CLUSTER_SIZE]
+        pos += count * CLUSTER_SIZE
+    volume[BITMAP_LCN * CLUSTER_SIZE:BITMAP_LCN * CLUSTER_SIZE + len(bitmap)] = bitmap
+
+    if partition_offset:
+        if gpt:
+            image[446 + 4] = 0xee       # Protective MBR
+            struct.pack_into('<I', image, 446 + 8, 1)
+            image[512:520] = b'EFI PART'
+            struct.pack_into('<QII', image, 512 + 72, 2, 128, 128)
+            image[1024:1040] = b'\x01' * 16
+            struct.pack_into('<Q', image, 1024 + 32, partition_offset // SECTOR_SIZE)
+        else:
+            image[446 + 4] = 0x07       # NTFS
+            struct.pack_into('<I', image, 446 + 8, partition_offset // SECTOR_SIZE)
+        image[510:512] = b'\x55\xaa'
+    with open(path, 'wb') as f:
+        f.write(image)
+    return bitmap
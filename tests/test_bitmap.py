@@ -0,0 +1,225 @@
+import random
+
+import pytest
+
+import bitmap
+from bitmap import clip_runs, free_runs
+from fake_kernel32 import FakeDisk
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def implementation(request, monkeypatch):
+    """Runs a test with NumPy, then again with the pure Python fallbacks."""
+    if request.param == 'python':
+        monkeypatch.setattr(bitmap, 'numpy', None)
+    return request.param
+
+
+def reference_runs(data, total_clusters):
+    """Free runs found one bit at a time, as [(start, length)]."""
+    runs = []
+    for cluster in range(total_clusters):
+        if data[cluster // 8] & (1 << (cluster % 8)):
+            continue
+        if runs and runs[-1][0] + runs[-1][1] == cluster:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((cluster, 1))
+    return runs
+
+
+def as_list(runs):
+    starts, lengths = runs
+    return [(int(start), int(length)) for start, length in zip(starts, lengths)]
+
+
+def random_bitmap(rng, nbytes, sparse):
+    """Random bitmap bytes: bit by bit, or (if `sparse`) mostly whole free
+    and used bytes with the odd mixed byte at the edges of each run."""
+    if not sparse:
+        return bytes(rng.getrandbits(8) for i in range(nbytes))
+    data = bytearray()
+    while len(data) < nbytes:
+        data += bytes([rng.choice([0x00, 0xff])]) * rng.randint(1, 40)
+        if rng.random() < 0.3:
+            data.append(rng.getrandbits(8))
+    return bytes(data[:nbytes])
+
+
+PATTERNS = [
+    b'',
+    b'\x00' * 5,                    # One run across every chunk
+    b'\xff' * 5,
+    b'\x00\x00\xff\x00\x00',        # Starts free
+    b'\xff\xff\x00\x00\xff',        # Starts used
+    b'\x0f\x00\x00\xf0\x01',        # Runs starting and ending mid-byte, crossing chunks
+    b'\x80\x00\x01\x7f\xfe',
+    b'\x55\xaa\x55\xaa\x00',
+    b'\xff\x00\x00\x00\x00',        # Ends free, out to the padding
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 1024])
+@pytest.mark.parametrize('data', PATTERNS)
+def test_free_runs_of_patterns(implementation, data, chunk_size):
+    for total_clusters in (len(data) * 8, max(0, len(data) * 8 - 3)):
+        assert as_list(free_runs(data, total_clusters, chunk_size)) == reference_runs(data, total_clusters)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64])
+def test_free_runs_match_reference(implementation, sparse, chunk_size):
+    rng = random.Random(chunk_size * 2 + sparse)
+    for trial in range(20):
+        data = random_bitmap(rng, rng.randint(1, 300), sparse)
+        total_clusters = len(data) * 8 - rng.randint(0, 7)     # Often a partial last byte
+        assert as_list(free_runs(data, total_clusters, chunk_size)) == reference_runs(data, total_clusters)
+
+
+def test_padding_bits_are_not_free(implementation):
+    # The last byte's high bits are past the last cluster, whatever their value
+    assert as_list(free_runs(b'\xff\x01', 12, chunk_size=1)) == [(9, 3)]
+    assert as_list(free_runs(b'\xff\xf1', 12, chunk_size=1)) == [(9, 3)]
+    assert as_list(free_runs(b'\xff\x0f', 12, chunk_size=1)) == []
+
+
+def test_full_bitmap_free_runs(implementation, fake_disk, open_volume):
+    fake_disk.bitmap[:4] = b'\xff\x0f\x00\xf0'
+    fake_disk.bitmap[4:] = b'\xff' * (len(fake_disk.bitmap) - 4)
+    full = bitmap.FullBitmap(open_volume(fake_disk).load_bitmap())
+    assert as_list(full.free_runs()) == [(12, 16)]
+
+
+RUNS = ([0, 20, 40], [10, 10, 5])   # Clusters 0-9, 20-29 and 40-44
+
+
+@pytest.mark.parametrize('first, last, expected', [
+    (0, 44, [(0, 10), (20, 10), (40, 5)]),
+    (5, 42, [(5, 5), (20, 10), (40, 3)]),       # Cuts the first and last runs
+    (10, 39, [(20, 10)]),                       # Both ends in gaps
+    (9, 20, [(9, 1), (20, 1)]),                 # One cluster of each run
+    (12, 18, []),
+    (25, 25, [(25, 1)]),
+    (45, 100, []),
+])
+def test_clip_runs(implementation, first, last, expected):
+    assert as_list(clip_runs(*RUNS, first, last)) == expected
+
+
+def reference_report(data, total_clusters, regions):
+    """bitmap_report()'s counts worked out one bit at a time."""
+    runs = reference_runs(data, total_clusters)
+    used = [bool(data[cluster // 8] & (1 << (cluster % 8))) for cluster in range(total_clusters)]
+    region_clusters = max(1, -(-len(data) // regions)) * 8
+    histogram = {}
+    for start, length in runs:
+        bucket = length.bit_length() - 1
+        runs_in, clusters = histogram.get(bucket, (0, 0))
+        histogram[bucket] = (runs_in + 1, clusters + length)
+    largest = max(runs, key=lambda run: run[1], default=(0, 0))     # The first of equal runs
+    return {
+        'total_clusters': total_clusters,
+        'used_clusters': sum(used),
+        'free_clusters': total_clusters - sum(used),
+        'free_runs': len(runs),
+        'largest_free_extent': {'start': largest[0], 'clusters': largest[1]},
+        'free_run_histogram': [
+            {'min_clusters': 2**bucket, 'max_clusters': 2**(bucket + 1) - 1, 'runs': runs_in, 'clusters': clusters}
+            for bucket, (runs_in, clusters) in sorted(histogram.items())
+        ],
+        'regions': {
+            'clusters_per_region': region_clusters,
+            'occupancy': [round(sum(used[i:i + region_clusters]) / len(used[i:i + region_clusters]), 4)
+                          for i in range(0, total_clusters, region_clusters)],
+        },
+    }
+
+
+def test_bitmap_report(implementation):
+    # Free: 4-7 (4), 16-23 (8), 28-35 (8), 48-49 (2); 8 clusters of padding in the last byte
+    data = b'\x0f\xff\x00\x0f\xf0\xff\xfc'
+    report = bitmap.bitmap_report(data, 50, regions=2, chunk_size=3)
+    assert report == reference_report(data, 50, regions=2)
+    assert (report['used_clusters'], report['free_clusters'], report['free_runs']) == (28, 22, 4)
+    assert report['largest_free_extent'] == {'start': 16, 'clusters': 8}       # Not the equal run at 28
+    assert [(bucket['min_clusters'], bucket['runs'], bucket['clusters'])
+            for bucket in report['free_run_histogram']] == [(2, 1, 2), (4, 1, 4), (8, 2, 16)]
+    assert report['regions'] == {'clusters_per_region': 32, 'occupancy': [0.5, 0.6667]}
+
+
+def test_bitmap_report_of_empty_and_full_bitmaps(implementation):
+    free = bitmap.bitmap_report(b'\x00' * 4, 30, regions=4, chunk_size=1)
+    assert free['used_clusters'] == 0 and free['largest_free_extent'] == {'start': 0, 'clusters': 30}
+    assert free['regions']['occupancy'] == [0.0] * 4
+    used = bitmap.bitmap_report(b'\xff' * 4, 30, regions=4, chunk_size=1)
+    assert used['used_clusters'] == 30 and used['free_runs'] == 0 and used['free_run_histogram'] == []
+    assert used['largest_free_extent'] == {'start': 0, 'clusters': 0}
+    assert used['regions']['occupancy'] == [1.0] * 4
+
+
+@pytest.mark.parametrize('regions, chunk_size', [(1, 4), (7, 3), (10, 5), (16, 1), (100, 64)])
+def test_bitmap_report_matches_reference(implementation, regions, chunk_size):
+    rng = random.Random(regions * 100 + chunk_size)
+    for trial in range(10):
+        data = random_bitmap(rng, rng.randint(1, 200), sparse=trial % 2)
+        total_clusters = len(data) * 8 - rng.randint(1, 7)     # Always a partial last byte
+        assert bitmap.bitmap_report(data, total_clusters, regions, chunk_size) == \
+            reference_report(data, total_clusters, regions)
+
+
+@pytest.fixture
+def windowed(open_volume):
+    """A VolumeBitmap over a 1000-cluster volume in 128-cluster windows
+    (the last one 104 clusters), caching at most 3 windows. Every 10th
+    cluster is in use. Also returns the LCN of each window it reads."""
+    disk = FakeDisk(total_clusters=1000)
+    for cluster in range(0, 1000, 10):
+        disk.add_stream(cluster, 1, '\\f')
+    volume = open_volume(disk)
+    reads = []
+    read_bitmap = volume.read_bitmap
+
+    def counted(start_lcn, size):
+        reads.append(start_lcn)
+        return read_bitmap(start_lcn, size)
+    volume.read_bitmap = counted
+    return bitmap.VolumeBitmap(volume, window_bytes=16, cache_bytes=48), reads
+
+
+def test_volume_bitmap_hits_and_misses(windowed):
+    bits, reads = windowed
+    assert [bits.is_set(cluster) for cluster in (0, 1, 10, 127, 130)] == [True, False, True, False, True]
+    assert reads == [0, 128]
+    assert (bits.hits, bits.misses) == (3, 2)
+
+
+def test_volume_bitmap_evicts_least_recently_used(windowed):
+    bits, reads = windowed
+    for cluster in (0, 128, 256, 0, 384):      # Window 1 is the oldest when window 3 comes in
+        bits.is_set(cluster)
+    assert list(bits.windows) == [2, 0, 3]
+    bits.is_set(0)
+    bits.is_set(128)
+    assert reads == [0, 128, 256, 384, 128]
+    assert (bits.hits, bits.misses) == (2, 5)
+    assert len(bits.windows) == bits.max_windows == 3
+
+
+def test_volume_bitmap_invalidate(windowed):
+    bits, reads = windowed
+    for cluster in (0, 128, 256):
+        bits.is_set(cluster)
+    bits.invalidate(120, 130)       # Across the edge of windows 0 and 1
+    assert list(bits.windows) == [2]
+    bits.invalidate()
+    assert not bits.windows
+
+
+def test_volume_bitmap_last_window(windowed):
+    bits, reads = windowed
+    assert bits.is_set(990) and not bits.is_set(999)
+    start, data = bits.window(999)
+    assert (start, len(data)) == (896, 13)
+    for cluster in (1000, 1023, 1024, 5000):    # In the last window, then past it
+        with pytest.raises(IndexError):
+            bits.is_set(cluster)
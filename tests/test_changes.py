@@ -0,0 +1,146 @@
+import types
+
+import pytest
+
+import changes
+from bitmap import FullBitmap, VolumeBitmap
+from changes import USN_REASON_DATA_EXTEND, USN_REASON_FILE_CREATE, ChangeTracker
+
+USN_REASON_CLOSE = 0x80000000
+USN_REASON_BASIC_INFO_CHANGE = 0x00008000
+
+# File reference number -> (VCN, LCN, count) extents; file 33 has been deleted
+FILES = {11: [(0, 130, 2), (2, 700, 1)], 22: [(0, 300, 1)], 44: OSError}
+
+
+@pytest.fixture
+def volume(fake_disk, open_volume, monkeypatch):
+    """A volume whose change journal is at USN 1000 and whose files are
+    FILES, with the bitmap read in 128-cluster windows. Records the LCN of
+    every bitmap read in `volume.reads`."""
+    monkeypatch.setattr(changes, 'REFRESH_WINDOW_BYTES', 16)
+    volume = open_volume(fake_disk)
+    volume.journal = types.SimpleNamespace(UsnJournalID=7, NextUsn=1000)
+    volume.query_usn_journal = lambda: volume.journal
+    volume.changes = {}
+    volume.read_usn_changes = lambda journal_id, start_usn, stop_usn: volume.changes
+    volume.reads = []
+    read_bitmap = volume.read_bitmap
+
+    def counted(start_lcn, size):
+        volume.reads.append(start_lcn)
+        return read_bitmap(start_lcn, size)
+    volume.read_bitmap = counted
+
+    handles = {}
+
+    def open_file_by_id(volume_handle, frn):
+        if frn not in FILES:
+            return None
+        handle = volume.handle + 1000 + frn
+        handles[handle] = frn
+        return handle
+
+    def get_retrieval_pointers(handle):
+        extents = FILES[handles[handle]]
+        if extents is OSError:
+            raise OSError('no extents')
+        return iter(extents)
+    monkeypatch.setattr(changes, 'open_file_by_id', open_file_by_id)
+    monkeypatch.setattr(changes, 'get_retrieval_pointers', get_retrieval_pointers)
+    return volume
+
+
+def allocate(disk, *clusters):
+    for cluster in clusters:
+        disk.bitmap[cluster // 8] |= 1 << (cluster % 8)
+
+
+def write(volume, changes, next_usn=2000):
+    """Records `changes` ({file: reasons}) in the journal."""
+    volume.changes = changes
+    volume.journal.NextUsn = next_usn
+
+
+def test_allocations_refetch_their_windows_of_a_full_bitmap(volume, fake_disk):
+    bitmap = FullBitmap(volume.load_bitmap())
+    tracker = ChangeTracker(volume).start()
+    allocate(fake_disk, 130, 131, 700, 300)
+    write(volume, {11: USN_REASON_DATA_EXTEND | USN_REASON_CLOSE, 22: USN_REASON_BASIC_INFO_CHANGE,
+                   33: USN_REASON_FILE_CREATE})
+    tracker.refresh(bitmap)
+    assert volume.reads == [128, 640]        # The windows holding file 11's extents
+    assert bitmap.is_set(130) and bitmap.is_set(131) and bitmap.is_set(700)
+    assert not bitmap.is_set(300)           # File 22's change can't have allocated anything
+    assert (tracker.files_checked, tracker.windows_fetched, tracker.full_refreshes) == (1, 2, 0)
+    assert tracker.next_usn == 2000
+
+
+def test_allocations_invalidate_their_windows_of_a_volume_bitmap(volume):
+    bitmap = VolumeBitmap(volume, window_bytes=16)
+    for cluster in range(0, 1024, 128):
+        bitmap.is_set(cluster)
+    tracker = ChangeTracker(volume).start()
+    write(volume, {11: USN_REASON_DATA_EXTEND, 22: USN_REASON_CLOSE})
+    del volume.reads[:]
+    tracker.refresh(bitmap)
+    assert volume.reads == []
+    assert sorted(bitmap.windows) == [0, 2, 3, 4, 6, 7]
+
+
+def test_changes_without_allocations_are_ignored(volume):
+    bitmap = FullBitmap(volume.load_bitmap())
+    tracker = ChangeTracker(volume).start()
+    write(volume, {11: USN_REASON_BASIC_INFO_CHANGE | USN_REASON_CLOSE, 22: USN_REASON_CLOSE})
+    tracker.refresh(bitmap)
+    assert volume.reads == [] and tracker.files_checked == 0
+    assert tracker.next_usn == 2000
+
+
+def test_files_without_extents_are_skipped(volume):
+    bitmap = FullBitmap(volume.load_bitmap())
+    tracker = ChangeTracker(volume).start()
+    write(volume, {33: USN_REASON_DATA_EXTEND, 44: USN_REASON_DATA_EXTEND})
+    tracker.refresh(bitmap)
+    assert volume.reads == []
+    assert tracker.files_checked == 1       # 33 is gone, so only 44 was opened
+
+
+@pytest.mark.parametrize('journal, changes', [
+    (types.SimpleNamespace(UsnJournalID=8, NextUsn=2000), {}),      # A new journal
+    (types.SimpleNamespace(UsnJournalID=7, NextUsn=2000), None),    # Records lost
+    (None, {}),                                                     # Journal deleted
+])
+def test_full_refresh_when_the_journal_cannot_tell(volume, fake_disk, journal, changes):
+    bitmap = FullBitmap(volume.load_bitmap())
+    tracker = ChangeTracker(volume).start()
+    allocate(fake_disk, 300, 1000)
+    volume.journal = journal
+    volume.changes = changes
+    tracker.refresh(bitmap)
+    assert volume.reads == list(range(0, 1024, 128))
+    assert bitmap.is_set(300) and bitmap.is_set(1000)
+    assert tracker.full_refreshes == 1
+    if journal is not None:
+        assert (tracker.journal_id, tracker.next_usn) == (journal.UsnJournalID, 2000)
+
+
+def test_no_io_when_nothing_changed(volume):
+    bitmap = FullBitmap(volume.load_bitmap())
+    tracker = ChangeTracker(volume).start()
+
+    def read_usn_changes(*args):
+        raise AssertionError('The journal should not have been read')
+    volume.read_usn_changes = read_usn_changes
+    tracker.refresh(bitmap)
+    tracker.refresh(VolumeBitmap(volume))
+    assert volume.reads == []
+    assert (tracker.files_checked, tracker.windows_fetched, tracker.full_refreshes) == (0, 0, 0)
+
+
+def test_images_are_never_refreshed(image_volume):
+    bitmap = FullBitmap(image_volume.load_bitmap())
+    tracker = ChangeTracker(image_volume).start()
+    assert tracker.static
+    tracker.refresh(bitmap)
+    assert tracker.full_refreshes == 0
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from checkpoint import ScanCheckpoint
+from ntfs_image import NtfsImage
+from scan import SurfaceScan
+
+CLUSTER = 4096
+
+
+def checkpoint_with_done(tmp_path, done):
+    checkpoint = ScanCheckpoint(str(tmp_path / 'scan.checkpoint'))
+    checkpoint.done = list(done)
+    return checkpoint
+
+
+@pytest.mark.parametrize('done, expected', [
+    ([], ([0, 100], [50, 50])),
+    ([(0, 50), (100, 50)], ([], [])),
+    ([(10, 5)], ([0, 15, 100], [10, 35, 50])),
+    ([(40, 70)], ([0, 110], [40, 40])),                 # Straddles the gap between the runs
+    ([(20, 10), (5, 20), (120, 5)], ([0, 30, 100, 125], [5, 20, 20, 25])),     # Unsorted and overlapping
+    ([(0, 1000)], ([], [])),
+])
+def test_remaining(tmp_path, done, expected):
+    checkpoint = checkpoint_with_done(tmp_path, done)
+    assert checkpoint.remaining([0, 100], [50, 50]) == expected
+
+
+@pytest.fixture
+def bad_image(mapfile):
+    """A mapfile for the image fixture with unreadable sectors in volume
+    clusters 301 and 2001."""
+    return mapfile([0x22d400, 0x8d1000])
+
+
+def scan_image(image_path, mapfile, checkpoint=None, stop_after=None):
+    """Scans the image in 64-cluster chunks, resuming from `checkpoint` if
+    given, and stopping with KeyboardInterrupt after `stop_after` chunks."""
+    image = NtfsImage(image_path, mapfile=mapfile).open()
+    scan = SurfaceScan(image, 64 * CLUSTER, slow_ms=0)
+    starts, lengths = [0], [image.total_clusters]
+    if checkpoint is not None:
+        checkpoint.open(image)
+        scan.findings.extend(checkpoint.findings)
+        starts, lengths = checkpoint.remaining(starts, lengths)
+    chunks = []
+
+    def progress(done, scan):
+        chunks.append(done)
+        if stop_after is not None and len(chunks) == stop_after:
+            raise KeyboardInterrupt
+    try:
+        scan.scan_runs(starts, lengths, progress, checkpoint)
+    finally:
+        scan.close()
+        if checkpoint is not None:
+            checkpoint.close(scan)
+        image.close()
+    return scan, sum(lengths)
+
+
+def test_interrupted_scan_resumes(image_path, bad_image, tmp_path, capsys):
+    path = str(tmp_path / 'scan.checkpoint')
+    full, total = scan_image(image_path, bad_image)
+    assert [cluster for cluster, err, sectors in full.findings] == [301, 2001]
+
+    # Interrupted after cluster 301 was found but before 2001 was reached
+    with pytest.raises(KeyboardInterrupt):
+        scan_image(image_path, bad_image, ScanCheckpoint(path, interval=0), stop_after=20)
+    resumed, left = scan_image(image_path, bad_image, ScanCheckpoint(path, interval=0))
+    assert left == total - 20 * 64
+    assert sorted(resumed.findings) == sorted(full.findings)
+    assert resumed.findings[0] == full.findings[0]     # From the journal
+
+
+def test_torn_record_is_dropped(image_path, bad_image, tmp_path, capsys):
+    path = str(tmp_path / 'scan.checkpoint')
+    with pytest.raises(KeyboardInterrupt):
+        scan_image(image_path, bad_image, ScanCheckpoint(path, interval=0), stop_after=10)
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    checkpoint = ScanCheckpoint(path)
+    image = NtfsImage(image_path).open()
+    try:
+        checkpoint.open(image)
+        checkpoint.close()
+    finally:
+        image.close()
+    assert os.path.getsize(path) == size
+    assert checkpoint.remaining([0], [image.total_clusters]) == ([640], [image.total_clusters - 640])
+
+
+def test_journal_of_another_volume_is_replaced(image_path, tmp_path, capsys):
+    path = str(tmp_path / 'scan.checkpoint')
+    with open(path, 'wb') as f:
+        f.write(b'QSSCAN1\0' + b'\0' * 100)
+    image = NtfsImage(image_path).open()
+    try:
+        checkpoint = ScanCheckpoint(path).open(image)
+        checkpoint.close()
+    finally:
+        image.close()
+    assert checkpoint.done == []
+    assert os.path.getsize(path) < 100
@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import pytest
+
+from daemon import QueryServer, ServedVolume
+from fake_kernel32 import FakeDisk
+from ntfs_image import NtfsImage
+from volume import Volume
+
+FIRST_SECTOR = 2048     # The image's volume starts 1 MB in
+
+
+@pytest.fixture
+def served_image(image_path, capsys):
+    served = ServedVolume('img', NtfsImage(image_path).open(), slow_ms=0)
+    capsys.readouterr()
+    yield served
+    served.close()
+
+
+def exchange(server, lines):
+    """Sends `lines` to the server over a real TCP connection all at once,
+    and returns the responses, parsed, in the order they arrived."""
+    async def run():
+        listener = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b''.join(line if isinstance(line, bytes) else json.dumps(line).encode() + b'\n'
+                                  for line in lines))
+            await writer.drain()
+            writer.write_eof()
+            responses = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                responses.append(json.loads(line))
+            writer.close()
+            return responses
+    return asyncio.run(asyncio.wait_for(run(), 10))
+
+
+def by_id(responses):
+    return dict((response.pop('id'), response) for response in responses)
+
+
+def test_query_and_answer(served_image):
+    server = QueryServer({'img': served_image})
+    responses = by_id(exchange(server, [
+        {'id': 1, 'sector': FIRST_SECTOR + 101 * 8},
+        {'id': 2, 'volume': 'img', 'sector': FIRST_SECTOR + 600 * 8 + 7, 'read': False},
+        {'id': 3, 'sector': 5},
+    ]))
+    assert responses == {
+        1: {'volume': 'img', 'sector': FIRST_SECTOR + 808, 'cluster': 101, 'in_use': True,
+            'files': ['\\docs\\report.txt (byte offset 4096)'], 'read': 'ok'},
+        2: {'volume': 'img', 'sector': FIRST_SECTOR + 4807, 'cluster': 600, 'in_use': False, 'files': []},
+        3: {'volume': 'img', 'sector': 5, 'cluster': None},
+    }
+    assert server.queries == 3 and server.errors == 0
+
+
+def test_bad_queries_get_errors(served_image):
+    server = QueryServer({'img': served_image})
+    responses = exchange(server, [
+        b'not json\n',
+        b'[1, 2]\n',
+        b'\n',
+        {'id': 1, 'op': 'nonsense'},
+        {'id': 2},
+        {'id': 3, 'volume': 'Q', 'sector': 1},
+        {'id': 4, 'sector': 'abc'},
+    ])
+    assert len(responses) == 6
+    assert all('error' in response for response in responses)
+    assert sorted(response['id'] for response in responses if 'id' in response) == [1, 2, 3, 4]
+    assert server.errors == 6
+
+
+def test_sector_past_the_last_cluster(image_path, capsys):
+    # The volume's extent is a sector longer than its clusters
+    image = NtfsImage(image_path).open()
+    image.end += image.bytes_per_sector
+    served = ServedVolume('img', image, slow_ms=0)
+    capsys.readouterr()
+    try:
+        server = QueryServer({'img': served})
+        last = (image.end - 1) // image.bytes_per_sector
+        [response] = exchange(server, [{'id': 1, 'sector': last}])
+    finally:
+        served.close()
+    assert response == {'id': 1, 'error': 'sector or cluster out of range'}
+
+
+def test_volumes_and_stats(served_image):
+    server = QueryServer({'img': served_image})
+    responses = by_id(exchange(server, [{'id': 'v', 'op': 'volumes'},
+                                        {'id': 1, 'sector': FIRST_SECTOR + 2000 * 8, 'read': False}]))
+    [volume] = responses['v']['volumes']
+    assert (volume['volume'], volume['cluster_size'], volume['total_clusters']) == ('img', 4096, 4096)
+    [stats] = exchange(server, [{'op': 'stats'}])
+    assert stats['queries'] == 1 and stats['volumes']['img']['calls'] == 1
+
+
+def test_identical_lookups_are_coalesced(served_image):
+    server = QueryServer({'img': served_image})
+    responses = exchange(server, [{'id': i, 'sector': FIRST_SECTOR + 2001 * 8} for i in range(20)])
+    assert len(responses) == 20
+    assert all(response['files'] == ['\\last.txt (byte offset 4096)'] for response in responses)
+    assert served_image.calls + served_image.coalesced == 40
+    assert served_image.coalesced > 0
+
+
+def test_disk_query_on_spanned_volume(capsys, fake_kernel32):
+    half = 512 * 4096
+    disk = FakeDisk(total_clusters=1024, extents=[(1, 1 << 20, half), (2, 1 << 20, half)])
+    disk.add_stream(600, 1, '\\a.txt')
+    fake_kernel32(disk)
+    served = ServedVolume('X', Volume('X').open(), slow_ms=0)
+    capsys.readouterr()
+    try:
+        server = QueryServer({'X': served})
+        responses = by_id(exchange(server, [
+            {'id': 1, 'disk': 2, 'sector': FIRST_SECTOR + 88 * 8, 'read': False},
+            {'id': 2, 'disk': 3, 'sector': FIRST_SECTOR},
+            {'id': 3, 'sector': FIRST_SECTOR},
+        ]))
+    finally:
+        served.close()
+    assert responses[1] == {'volume': 'X', 'sector': FIRST_SECTOR + 704, 'cluster': 600, 'in_use': True,
+                            'files': ['\\a.txt']}
+    assert responses[2] == {'volume': None, 'sector': FIRST_SECTOR, 'cluster': None}
+    assert 'disk number is needed' in responses[3]['error']
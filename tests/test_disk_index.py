@@ -0,0 +1,105 @@
+import pytest
+
+import volume as win_volume
+from disk_index import DiskExtentIndex
+from fake_kernel32 import FakeDisk, FakeMachine
+from query_sector import run_disk_query
+
+MB = 1 << 20
+CLUSTER = 4096
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    """Four volumes on disks 1 and 2:
+
+        C:      disk 1, 1 MB - 5 MB
+        D:      disk 1, 8 MB - 10 MB (also mounted at C:\\mnt)
+        S:      disk 1, 12 MB - 14 MB, then disk 2, 1 MB - 3 MB
+        (none)  disk 2, 4 MB - 5 MB
+    """
+    c = FakeDisk(total_clusters=1024, disk_number=1, start=MB)
+    c.add_stream(5, 1, '\\c.txt')
+    c.add_bad_sector(5 * 8 + 2)
+    d = FakeDisk(total_clusters=512, disk_number=1, start=8 * MB)
+    s = FakeDisk(total_clusters=1024, extents=[(1, 12 * MB, 2 * MB), (2, MB, 2 * MB)])
+    s.add_stream(515, 1, '\\s.txt')
+    hidden = FakeDisk(total_clusters=256, disk_number=2, start=4 * MB)
+    machine = FakeMachine([('\\\\?\\Volume{c}\\', ['C:\\'], c), ('\\\\?\\Volume{d}\\', ['D:\\', 'C:\\mnt\\'], d),
+                           ('\\\\?\\Volume{s}\\', ['S:\\'], s), ('\\\\?\\Volume{hidden}\\', [], hidden)])
+    monkeypatch.setattr(win_volume, 'kernel32', machine)
+    return machine
+
+
+@pytest.fixture
+def index(machine):
+    index = DiskExtentIndex.build()
+    yield index
+    index.close()
+
+
+def names(index):
+    """The index's volumes by what is between the braces of their GUID paths."""
+    return dict((volume.name.split('{')[1].split('}')[0], volume) for volume in index.volumes)
+
+
+def test_build_finds_every_volume(index):
+    assert [str(volume) for volume in index.volumes] == [
+        '\\\\?\\Volume{c}\\ (C:\\)', '\\\\?\\Volume{d}\\ (D:\\, C:\\mnt\\)', '\\\\?\\Volume{s}\\ (S:\\)',
+        '\\\\?\\Volume{hidden}\\ (no drive letter)']
+    assert index.disks() == [1, 2]
+    assert names(index)['s'].extents == [(1, 12 * MB, 2 * MB), (2, MB, 2 * MB)]
+
+
+def test_find(index):
+    volumes = names(index)
+    assert index.find(1, 0) is None                     # Before the first extent
+    assert index.find(1, MB) == (volumes['c'], (1, MB, 4 * MB))
+    assert index.find(1, 5 * MB - 1)[0] is volumes['c']
+    assert index.find(1, 5 * MB) is None                # In the gap after it
+    assert index.find(1, 8 * MB)[0] is volumes['d']
+    assert index.find(1, 13 * MB) == (volumes['s'], (1, 12 * MB, 2 * MB))
+    assert index.find(1, 14 * MB) is None               # Past the last extent
+    assert index.find(2, MB) == (volumes['s'], (2, MB, 2 * MB))
+    assert index.find(2, 4 * MB)[0] is volumes['hidden']
+    assert index.find(3, MB) is None
+
+
+def test_next_start(index):
+    assert index.next_start(1, 0) == MB
+    assert index.next_start(1, MB) == 8 * MB            # From the start of an extent
+    assert index.next_start(1, 5 * MB) == 8 * MB
+    assert index.next_start(1, 13 * MB) is None
+    assert index.next_start(2, 3 * MB) == 4 * MB
+    assert index.next_start(3, 0) is None
+
+
+def test_locate(index):
+    volumes = names(index)
+    assert index.locate(1, MB + 5 * CLUSTER + 100) == (volumes['c'], 5)
+    assert index.locate(1, 6 * MB) is None
+    assert index.locate(1, 12 * MB + CLUSTER) == (volumes['s'], 1)
+    # Past the first extent of the spanned volume, through IOCTL_VOLUME_PHYSICAL_TO_LOGICAL
+    assert index.locate(2, MB + 3 * CLUSTER) == (volumes['s'], 515)
+    volumes['hidden']._cluster_size = 0     # As if it had no filesystem Windows recognises
+    assert index.locate(2, 4 * MB) == (volumes['hidden'], None)
+
+
+def test_run_disk_query(index, capsys):
+    first = MB // 512
+    run_disk_query(index, 1, [(first - 8, first + 2), (first + 40, first + 47)], slow_ms=0)
+    out = capsys.readouterr().out
+    assert '%s-%s: not part of any volume on disk 1\n' % (first - 8, first - 1) in out
+    assert '%s-%s: cluster 0, free, read ok\n' % (first, first + 2) in out
+    assert '%s-%s: cluster 5, in use, read CRC error\n    \\c.txt\n' % (first + 40, first + 47) in out
+
+
+def test_run_disk_query_on_spanned_volume(index, capsys):
+    names(index)['hidden']._cluster_size = 0
+    sector = MB // 512 + 3 * 8
+    run_disk_query(index, 2, [(sector, sector), (4 * MB // 512, 4 * MB // 512 + 1)], slow_ms=0)
+    out = capsys.readouterr().out
+    assert 'Volume \\\\?\\Volume{s}\\ (S:\\):\n' in out
+    assert '%s: cluster 515, in use, read ok\n    \\s.txt\n' % sector in out
+    assert '%s-%s: on volume \\\\?\\Volume{hidden}\\ (no drive letter), which has no filesystem' % (
+        4 * MB // 512, 4 * MB // 512 + 1) in out
@@ -0,0 +1,84 @@
+import array
+import types
+
+import pytest
+
+from file_index import FileIndex
+from query_sector import load_file_index
+
+
+def values(*items):
+    return array.array('q', items)
+
+
+def make_index(serial, journal_id=7, next_usn=1000):
+    """\\a at clusters 5-7 and \\b at 100-103, files 11 and 22 on the volume."""
+    return FileIndex(4096, 1024, values(5, 100), values(3, 4), values(0, 1), values(0, 0), ['\\a', '\\b'],
+                     values(11, 22), serial, journal_id, next_usn)
+
+
+@pytest.fixture
+def volume(fake_disk, open_volume):
+    fake_disk.add_stream(101, 1, '\\b')
+    volume = open_volume(fake_disk)
+    journal = types.SimpleNamespace(UsnJournalID=7, NextUsn=1000)
+    volume.query_usn_journal = lambda: journal
+    volume.read_usn_changes = lambda journal_id, start_usn, stop_usn: {}
+    return volume
+
+
+def test_save_and_load(tmp_path, volume):
+    path = str(tmp_path / 'index')
+    make_index(volume.get_serial_number()).save(path)
+    index = FileIndex.load(path)
+    assert (index.serial, index.journal_id, index.next_usn) == (volume.get_serial_number(), 7, 1000)
+    assert index.names == ['\\a', '\\b'] and list(index.frns) == [11, 22]
+    assert index.find(6) == ('\\a', 4096) and index.find(103) == ('\\b', 3 * 4096) and index.find(8) is None
+    assert index.matches(volume) and index.catch_up(volume)
+
+
+def test_other_volume_does_not_match(volume):
+    assert not make_index(volume.get_serial_number() + 1).matches(volume)
+
+
+def test_changed_files_are_looked_up_on_the_volume(volume):
+    index = make_index(volume.get_serial_number())
+    index.volume = volume
+    volume.query_usn_journal().NextUsn = 2000
+    volume.read_usn_changes = lambda journal_id, start_usn, stop_usn: {22: 0x100}
+    assert index.catch_up(volume)
+    assert index.stale == {1}
+    assert index.find(101) is None
+    files = index.lookup_cluster_files([6, 101])
+    assert files == {6: [(0x01000000, '\\a (byte offset 4096)')], 101: [(0x01000000, '\\b')]}
+
+
+@pytest.mark.parametrize('journal_id, changes', [(8, {}), (7, None)])
+def test_index_is_stale_when_the_journal_cannot_tell(volume, journal_id, changes):
+    volume.query_usn_journal().UsnJournalID = journal_id
+    volume.query_usn_journal().NextUsn = 2000
+    volume.read_usn_changes = lambda *args: changes
+    assert not make_index(volume.get_serial_number()).catch_up(volume)
+
+
+def test_truncated_index_is_rebuilt(tmp_path, volume, capsys):
+    path = str(tmp_path / 'index')
+    make_index(volume.get_serial_number()).save(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for size in (10, len(data) - 5):
+        with open(path, 'wb') as f:
+            f.write(data[:size])
+        with pytest.raises(EOFError):
+            FileIndex.load(path)
+    rebuilt = make_index(volume.get_serial_number(), next_usn=1000)
+    volume.build_file_index = lambda: rebuilt
+    assert load_file_index(volume, path) is rebuilt
+    assert 'rebuilding it' in capsys.readouterr().out
+    assert FileIndex.load(path).names == rebuilt.names
+
+
+def test_image_index_needs_no_journal(image_volume):
+    index = image_volume.build_file_index()
+    assert index.serial == image_volume.get_serial_number()
+    assert index.matches(image_volume) and index.catch_up(image_volume)
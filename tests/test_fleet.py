@@ -0,0 +1,118 @@
+import argparse
+import shutil
+
+import pytest
+
+import fleet
+import scan
+from bitmap import FullBitmap
+from fake_kernel32 import FakeDisk
+from fleet import ScanTarget, group_by_disk, run_fleet, scan_target
+from query_sector import resolve_findings
+from volume import VolumeError, get_disk_extents
+
+HALF = 512 * 4096   # Bytes in each extent of the spanned volume
+
+
+@pytest.fixture
+def spanned_disk():
+    """A 1024-cluster volume spanning two disks: clusters 0-511 at offset
+    1 MB on disk 1, 512-1023 at offset 1 MB on disk 2."""
+    return FakeDisk(total_clusters=1024, extents=[(1, 1 << 20, HALF), (2, 1 << 20, HALF)])
+
+
+def options(**kwargs):
+    values = dict(free_only=False, chunk_size=1, queue_depth=1, slow_ms=0)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def labels(groups):
+    return [[target.label for target in group] for group in groups]
+
+
+def test_group_by_disk():
+    targets = [ScanTarget('C', ['PhysicalDisk0']), ScanTarget('D', ['PhysicalDisk1']),
+               ScanTarget('E', ['PhysicalDisk0']), ScanTarget('F', ['PhysicalDisk2'])]
+    assert sorted(labels(group_by_disk(targets))) == [['C', 'E'], ['D'], ['F']]
+
+
+def test_spanned_volume_joins_its_disks_groups():
+    targets = [ScanTarget('C', ['PhysicalDisk0']), ScanTarget('D', ['PhysicalDisk1']),
+               ScanTarget('RAID', ['PhysicalDisk1', 'PhysicalDisk2']), ScanTarget('E', ['PhysicalDisk2']),
+               ScanTarget('F', ['PhysicalDisk3'])]
+    assert sorted(labels(group_by_disk(targets))) == [['C'], ['D', 'RAID', 'E'], ['F']]
+
+
+def test_disk_extents_make_room_for_all(fake_kernel32):
+    disk = FakeDisk(total_clusters=1536, extents=[(1, 1 << 20, HALF), (2, 1 << 20, HALF), (3, 0, HALF)])
+    fake_kernel32(disk)
+    assert get_disk_extents(1) == disk.extents
+
+
+def test_spanned_volume_mapping(spanned_disk, open_volume):
+    volume = open_volume(spanned_disk)
+    assert volume.start is None and len(volume.extents) == 2
+    first_sector = (1 << 20) // 512
+    assert volume.cluster_to_sector(10) == first_sector + 80        # On disk 1
+    assert volume.cluster_to_sector(600) == first_sector + 88 * 8   # On disk 2
+    assert volume.sector_to_cluster(first_sector + 80, 1) == 10
+    assert volume.sector_to_cluster(first_sector + 88 * 8, 2) == 600
+    assert volume.sector_to_cluster(first_sector + 80, 3) is None
+    assert volume.sector_to_cluster(5, 1) is None
+    with pytest.raises(VolumeError):
+        volume.sector_to_cluster(first_sector)
+
+
+def test_resolve_findings_on_spanned_volume(spanned_disk, open_volume):
+    spanned_disk.add_stream(600, 1, '\\a.txt')
+    spanned_disk.add_bad_sector(600 * 8 + 3)
+    volume = open_volume(spanned_disk)
+    bitmap = FullBitmap(volume.load_bitmap())
+    sector = volume.cluster_to_sector(600) + 3
+    rows = resolve_findings(volume, bitmap, [(600, 23, [sector]), (10, 23, [])], [], slow_ms=0)
+    assert rows == [
+        (volume.cluster_to_sector(10), volume.cluster_to_sector(10), 10, False, [], 'ok'),
+        (sector, sector, 600, True, [(0x01000000, '\\a.txt')], 'CRC error'),
+    ]
+
+
+def test_scan_target_on_spanned_volume(spanned_disk, fake_kernel32):
+    spanned_disk.add_bad_sector(600 * 8 + 3)
+    fake_kernel32(spanned_disk)
+    result, partitions = scan_target(ScanTarget('X', ['PhysicalDisk1', 'PhysicalDisk2'], volume_name='X'), options())
+    assert result['error'] is None
+    assert result['unreadable'] == 1
+    assert [row[2:4] for row in result['rows']] == [(600, False)]
+
+
+def test_scan_target_records_unexpected_errors(fake_disk, fake_kernel32, monkeypatch):
+    fake_kernel32(fake_disk)
+
+    def broken(*args):
+        raise TypeError('broken')
+    monkeypatch.setattr(scan.SurfaceScan, 'scan_runs', broken)
+    result, partitions = scan_target(ScanTarget('X', ['PhysicalDisk0'], volume_name='X'), options())
+    assert result['error'] == 'unexpected TypeError: broken'
+    assert 'Traceback' in result['log']
+    assert fleet.summary(result) == 'X: failed: unexpected TypeError: broken'
+
+
+def test_run_fleet_on_images(image_path, mapfile, tmp_path, capsys):
+    copy = str(tmp_path / 'copy.img')
+    shutil.copy(image_path, copy)
+    bad = mapfile([0x22d400])      # The third sector of volume cluster 301
+    missing = str(tmp_path / 'missing.img')
+    targets = [ScanTarget(path, [path], image=path, mapfile=map_path)
+               for path, map_path in ((image_path, None), (copy, bad), (missing, None))]
+    results = run_fleet(targets, options(chunk_size=1, queue_depth=2), processes=2)
+    assert [result['target'] for result in results] == [image_path, copy, missing]
+    clean, damaged, failed = results
+    assert clean['error'] is None and clean['unreadable'] == 0
+    assert clean['clusters_scanned'] == 4096
+    assert damaged['unreadable'] == 1
+    assert [(row[0], row[2], row[4]) for row in damaged['rows']] == [
+        (4458, 301, [(0x01000000, '\\frag.bin (byte offset 4096)')])]
+    assert failed['error']
+    report = fleet.report_json(results)
+    assert (report['unreadable'], report['failed']) == (1, 1)
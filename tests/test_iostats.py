@@ -0,0 +1,157 @@
+import csv
+import ctypes
+import json
+import os
+import time
+
+import pytest
+
+import iostats
+import volume as win_volume
+from fake_kernel32 import FakeDisk
+from iostats import IoStats
+from volume import Volume
+
+MB = 1 << 20
+
+
+@pytest.fixture
+def enable(fake_kernel32, monkeypatch, capsys):
+    """Installs a FakeKernel32 for a disk and enables recording: call it
+    with the disk. Both iostats.recorder and win_volume.kernel32 are put
+    back afterwards."""
+    def enable(disk):
+        fake_kernel32(disk)
+        monkeypatch.setattr(iostats, 'recorder', None)
+        monkeypatch.setattr(win_volume, 'kernel32', win_volume.kernel32)
+        return iostats.enable(heatmap_bucket=MB)
+    yield enable
+    capsys.readouterr()
+
+
+def counts(stats):
+    return dict((op, s.count) for op, s in stats.ops.items())
+
+
+def test_ioctls_are_counted_by_name(enable, fake_disk):
+    stats = enable(fake_disk)
+    assert isinstance(win_volume.kernel32, iostats.InstrumentedKernel32)
+    volume = Volume('X').open()
+    opened = counts(stats)
+    assert opened == {'FSCTL_IS_VOLUME_MOUNTED': 1, 'IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS': 1,
+                      'FSCTL_GET_RETRIEVAL_POINTER_BASE': 1}
+    assert stats.ops['IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS'].bytes == 32     # One DISK_EXTENT
+    volume.read_bitmap(0, 16)
+    volume.read_bitmap(0, 1024)
+    assert counts(stats) == dict(opened, FSCTL_GET_VOLUME_BITMAP=2)
+    bitmap = stats.ops['FSCTL_GET_VOLUME_BITMAP']
+    assert bitmap.errors == 0       # The first read's ERROR_MORE_DATA is a success
+    assert bitmap.bytes == (16 + 16) + (16 + 128)
+    assert volume.query_usn_journal() is None
+    assert stats.ops['FSCTL_QUERY_USN_JOURNAL'].errors == 1
+    volume.close()
+
+
+def test_bytes_returned_come_from_the_byref_argument(enable, fake_disk):
+    stats = enable(fake_disk)
+    volume = Volume('X').open_handle()
+    out_size = ctypes.c_ulong()
+    kernel32 = win_volume.kernel32
+    buf = ctypes.create_string_buffer(64)
+    start = ctypes.c_ulonglong(0)
+    kernel32.DeviceIoControl(volume.handle, win_volume.FSCTL_GET_VOLUME_BITMAP, ctypes.byref(start), 8,
+                             buf, 24, ctypes.byref(out_size), None)
+    assert out_size.value == 24
+    assert stats.ops['FSCTL_GET_VOLUME_BITMAP'].bytes == 24
+    volume.close()
+
+
+def test_histogram_buckets():
+    stats = IoStats()
+    for us in (0, 1, 2, 3, 4, 7, 8, 1023, 1024):
+        stats.record('read', us / 1e6)
+    stats.record('read', 10 ** 6)       # 11.6 days
+    assert stats.ops['read'].histogram[:12] == [1, 1, 2, 2, 1, 0, 0, 0, 0, 0, 1, 1]
+    assert stats.ops['read'].histogram[-1] == 1
+    histogram = stats.to_dict()['operations']['read']['histogram_us']
+    assert list(histogram.items())[:5] == [('<1', 1), ('<2', 1), ('<4', 2), ('<8', 2), ('<16', 1)]
+    assert list(histogram)[-1] == '>=%d' % (1 << 30)
+    assert len(histogram) == iostats.HISTOGRAM_BUCKETS
+    stats = IoStats()
+    stats.record('read', 5e-6)
+    assert stats.to_dict()['operations']['read']['histogram_us'] == {'<1': 0, '<2': 0, '<4': 0, '<8': 1}
+
+
+def heatmap(stats):
+    return [(cell['disk_offset'], cell['reads']) for cell in stats.to_dict()['heatmap']]
+
+
+def test_heatmap_places_reads_by_disk_offset(enable, fake_disk, capsys):
+    stats = enable(fake_disk)
+    volume = Volume('X').open()
+    buf = ctypes.create_string_buffer(4096)
+    for offset in (0, 4096, MB, 3 * MB - 4096):
+        assert volume.read_at(offset, buf, 4096) == (0, 4096)
+    volume.close()
+    assert heatmap(stats) == [(MB, 2), (2 * MB, 1), (3 * MB, 1)]     # The volume starts 1 MB in
+    assert stats.ops['read'].count == 4 and stats.ops['read'].bytes == 4 * 4096
+
+
+def test_heatmap_of_spanned_volume_uses_volume_offsets(enable):
+    stats = enable(FakeDisk(total_clusters=1024, extents=[(1, MB, 2 * MB), (2, MB, 2 * MB)]))
+    volume = Volume('X').open()
+    buf = ctypes.create_string_buffer(4096)
+    volume.read_at(3 * MB, buf, 4096)
+    volume.close()
+    assert heatmap(stats) == [(3 * MB, 1)]
+
+
+def recorded():
+    stats = IoStats(heatmap_bucket=MB)
+    stats.record('read', 0.002, 4096, 0, 5 * MB)
+    stats.record('read', 0.5, 0, 23, 7 * MB + 1)
+    stats.record('FSCTL_GET_VOLUME_BITMAP', 3e-5, 144)
+    return stats
+
+
+def test_write_csv(tmp_path):
+    path = str(tmp_path / 'stats.csv')
+    recorded().write(path)
+    for name in ('stats.csv', 'stats_heatmap.csv'):
+        with open(str(tmp_path / name), newline='') as f:
+            rows = list(csv.reader(f))
+        assert len(rows) > 1 and all(len(row) == len(rows[0]) for row in rows)
+    with open(path, newline='') as f:
+        rows = dict((row['operation'], row) for row in csv.DictReader(f))
+    assert (rows['read']['count'], rows['read']['errors'], rows['read']['max_ms']) == ('2', '1', '500.000')
+    assert rows['read']['<2048us'] == '1' and rows['read']['more'] == '0'
+    with open(str(tmp_path / 'stats_heatmap.csv'), newline='') as f:
+        assert [row['disk_offset'] for row in csv.DictReader(f)] == [str(5 * MB), str(7 * MB)]
+    assert sorted(os.listdir(str(tmp_path))) == ['stats.csv', 'stats_heatmap.csv']
+
+
+def test_write_json(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    recorded().write(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert data['operations']['read']['bytes'] == 4096
+    assert data['heatmap'] == [{'disk_offset': 5 * MB, 'reads': 1, 'mean_ms': 2.0, 'max_ms': 2.0},
+                               {'disk_offset': 7 * MB, 'reads': 1, 'mean_ms': 500.0, 'max_ms': 500.0}]
+
+
+def test_timer_rewrites_the_file(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    stats = recorded()
+    stats.start_timer(path, 0.01)
+    try:
+        deadline = time.time() + 5
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)        # Let it rewrite the file a few times
+    finally:
+        stats.stop_timer()
+    assert os.path.exists(path) and stats.timer is None
+    os.remove(path)
+    time.sleep(0.05)
+    assert not os.path.exists(path)
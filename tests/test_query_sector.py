@@ -0,0 +1,86 @@
+from bitmap import FullBitmap
+from query_sector import parse_sector_list, query_sectors
+
+FIRST_SECTOR = 2048     # The fake volume starts 1 MB into disk 0
+
+
+def test_parse_plain_list_and_ranges():
+    lines = ['100\n', '  200-203 \n', '300, 301\n', '\n', '405-400\n']
+    assert list(parse_sector_list(lines)) == [(100, 100), (200, 203), (300, 300), (301, 301), (400, 405)]
+
+
+def test_parse_skips_comments_and_junk():
+    lines = ['# bad sectors\n', 'not a sector\n', '12x\n', '7\n']
+    assert list(parse_sector_list(lines)) == [(7, 7)]
+
+
+def test_parse_badblocks_output():
+    assert list(parse_sector_list(['1234\n', '1235\n'])) == [(1234, 1234), (1235, 1235)]
+
+
+def test_parse_smartctl_self_test_log():
+    lines = [
+        'SMART Self-test log structure revision number 1\n',
+        'Num  Test_Description    Status                  Remaining  LifeTime(hours)  LBA_of_first_error\n',
+        '# 1  Short offline       Completed: read failure       90%     12345         987654\n',
+        '# 2  Extended offline    Completed without error       00%     12000         -\n',
+    ]
+    assert list(parse_sector_list(lines)) == [(987654, 987654)]
+
+
+def test_lookup_attributes_each_match_to_its_cluster(fake_disk, open_volume):
+    # Enough streams per cluster that one group's output holds several clusters' matches
+    fake_disk.add_stream(100, 1, '\\a.txt')
+    fake_disk.add_stream(100, 1, '\\a.txt:ads', flags=0x03000000)
+    fake_disk.add_stream(150, 2, '\\b.txt')
+    volume = open_volume(fake_disk)
+    files = volume.lookup_cluster_files([200, 150, 100, 101, 151, 100])
+    assert files == {
+        100: [(0x01000000, '\\a.txt'), (0x03000000, '\\a.txt:ads')],
+        101: [],
+        150: [(0x01000000, '\\b.txt')],
+        151: [(0x01000000, '\\b.txt')],
+        200: [],
+    }
+
+
+def test_lookup_across_groups(fake_disk, open_volume):
+    for cluster in range(0, 1000, 7):
+        fake_disk.add_stream(cluster, 1, '\\file%s' % cluster)
+    volume = open_volume(fake_disk)
+    files = volume.lookup_cluster_files(range(0, 1000, 7), group_size=16)
+    assert all(files[cluster] == [(0x01000000, '\\file%s' % cluster)] for cluster in range(0, 1000, 7))
+
+
+def test_query_sectors_rows(fake_disk, open_volume):
+    fake_disk.add_stream(10, 1, '\\used.txt')
+    fake_disk.add_bad_sector(20 * 8 + 3)
+    volume = open_volume(fake_disk)
+    bitmap = FullBitmap(volume.load_bitmap())
+    ranges = [(5, 6), (FIRST_SECTOR + 80, FIRST_SECTOR + 81), (FIRST_SECTOR + 160, FIRST_SECTOR + 175)]
+    rows = query_sectors(volume, bitmap, ranges)
+    assert rows == [
+        (5, 6, None, False, [], ''),
+        (FIRST_SECTOR + 80, FIRST_SECTOR + 81, 10, True, [(0x01000000, '\\used.txt')], 'ok'),
+        (FIRST_SECTOR + 160, FIRST_SECTOR + 167, 20, False, [], 'CRC error'),
+        (FIRST_SECTOR + 168, FIRST_SECTOR + 175, 21, False, [], 'ok'),
+    ]
+
+
+def test_image_lookup(image_volume):
+    files = image_volume.lookup_cluster_files([101, 201, 402, 503, 600, 710])
+    assert files[101] == [(0x01000000, '\\docs\\report.txt (byte offset 4096)')]
+    assert files[201] == [(0x01000000, '\\docs\\report.txt (byte offset 20480)')]
+    assert files[402] == [(0x01000000, '\\frag.bin:ads (byte offset 8192)')]
+    assert files[503] == [(0x01000000, '\\frag.bin (byte offset 20480)')]
+    assert files.get(600) is None       # Deleted file
+    assert files[710] == [(0x01000000, '\\sparse.bin (byte offset 45056)')]
+
+
+def test_file_index_matches_volume_lookup(image_volume):
+    clusters = [16, 50, 101, 201, 301, 402, 503, 600, 700, 705, 1000, 2002]
+    expected = image_volume.lookup_cluster_files(clusters)
+    index = image_volume.build_file_index()
+    found = index.lookup_cluster_files(clusters)
+    assert set(found) == set(expected)
+    assert index.matches(image_volume)
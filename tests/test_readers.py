@@ -0,0 +1,162 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from ntfs_image import NtfsImage
+from readers import OverlappedReader, SyncReader, ThreadPoolReader
+from scan import SurfaceScan
+from simulated_disk import DiskModel, SimulatedDisk, install
+import volume as win_volume
+from volume import Volume
+
+CLUSTER = 4096
+BAD_OFFSET = 0x22d400    # Image sector 4458, the third sector of volume cluster 301
+
+
+def requests_for(clusters, count=1):
+    return [(cluster * CLUSTER, count * CLUSTER) for cluster in clusters]
+
+
+def test_sync_reader_in_order_with_media_error(fake_disk, open_volume):
+    fake_disk.add_bad_sector(8 * 8 + 5)     # In cluster 8
+    volume = open_volume(fake_disk)
+    reader = SyncReader(volume, 4 * CLUSTER)
+    results = [(offset, err, out_size) for offset, size, err, out_size, data in reader.read(
+        requests_for(range(0, 16, 4), 4))]
+    assert results == [(0, 0, 4 * CLUSTER), (4 * CLUSTER, 0, 4 * CLUSTER), (8 * CLUSTER, 23, 0),
+                       (12 * CLUSTER, 0, 4 * CLUSTER)]
+
+
+def test_thread_pool_reader_yields_in_request_order():
+    # Later requests finish first; each read leaves its offset in the buffer
+    def read_into(offset, buf, size):
+        time.sleep(0.001 * (8 - offset // CLUSTER % 8))
+        struct.pack_into('<Q', buf, 0, offset)
+        return (23, 0) if offset == 5 * CLUSTER else (0, size)
+
+    reader = ThreadPoolReader(read_into, queue_depth=4, buffer_size=CLUSTER)
+    try:
+        results = [(offset, err, out_size, bytes(data[:8])) for offset, size, err, out_size, data
+                   in reader.read(requests_for(range(16)))]
+    finally:
+        reader.close()
+    assert [offset for offset, err, out_size, data in results] == [c * CLUSTER for c in range(16)]
+    for offset, err, out_size, data in results:
+        if offset == 5 * CLUSTER:
+            assert (err, out_size, data) == (23, 0, b'')
+        else:
+            assert (err, out_size, struct.unpack('<Q', data)[0]) == (0, CLUSTER, offset)
+
+
+def test_thread_pool_reader_keeps_queue_depth_in_flight():
+    lock = threading.Lock()
+    state = {'now': 0, 'max': 0}
+
+    def read_into(offset, buf, size):
+        with lock:
+            state['now'] += 1
+            state['max'] = max(state['max'], state['now'])
+        time.sleep(0.002)
+        with lock:
+            state['now'] -= 1
+        return 0, size
+
+    reader = ThreadPoolReader(read_into, queue_depth=4, buffer_size=CLUSTER)
+    try:
+        assert len(list(reader.read(requests_for(range(32))))) == 32
+    finally:
+        reader.close()
+    assert 1 < state['max'] <= 4
+
+
+def test_pipeline_rejects_oversized_read():
+    reader = ThreadPoolReader(lambda offset, buf, size: (0, size), queue_depth=2, buffer_size=CLUSTER)
+    try:
+        with pytest.raises(ValueError):
+            list(reader.read([(0, 2 * CLUSTER)]))
+    finally:
+        reader.close()
+
+
+def test_image_reads_come_back_in_order_with_their_data(image_path, mapfile, capsys):
+    image = NtfsImage(image_path, mapfile=mapfile([BAD_OFFSET])).open()
+    reader = ThreadPoolReader(image.read_at, queue_depth=4, buffer_size=CLUSTER)
+    try:
+        results = [(offset // CLUSTER, err, bytes(data[:8])) for offset, size, err, out_size, data
+                   in reader.read(requests_for([100, 101, 102, 300, 301, 2000, 2001]))]
+    finally:
+        reader.close()
+        image.close()
+    assert [cluster for cluster, err, data in results] == [100, 101, 102, 300, 301, 2000, 2001]
+    for cluster, err, data in results:
+        if cluster == 301:
+            assert err and data == b''
+        else:
+            assert err == 0 and struct.unpack('<Q', data)[0] == cluster
+
+
+@pytest.fixture
+def simulated_volume(capsys):
+    """A volume on a SimulatedDisk with bad sectors in clusters 40 and 300
+    (volume sectors 323 and 2401), opened for overlapped reads."""
+    model = DiskModel(1024 * 8, bad=[40 * 8 + 3, 300 * 8 + 1])
+    disk = SimulatedDisk(1024, model)
+    with install(disk):
+        volume = Volume('X', unbuffered=True).open()
+        capsys.readouterr()
+        yield volume, disk
+        volume.close()
+
+
+def test_overlapped_reader_in_order_with_media_error(simulated_volume):
+    volume, disk = simulated_volume
+    reader = OverlappedReader(volume, queue_depth=4, buffer_size=8 * CLUSTER)
+    try:
+        results = [(offset // CLUSTER, err, out_size) for offset, size, err, out_size, data
+                   in reader.read(requests_for(range(0, 64, 8), 8))]
+    finally:
+        reader.close()
+    assert [cluster for cluster, err, out_size in results] == list(range(0, 64, 8))
+    assert [cluster for cluster, err, out_size in results if err] == [40]
+    assert all(out_size == 8 * CLUSTER for cluster, err, out_size in results if not err)
+
+
+def test_overlapped_reader_cancels_reads_left_in_flight(simulated_volume):
+    volume, disk = simulated_volume
+    reader = OverlappedReader(volume, queue_depth=4, buffer_size=CLUSTER)
+    try:
+        reads = reader.read(requests_for(range(100)))
+        next(reads)
+        reads.close()
+    finally:
+        reader.close()
+    assert win_volume.kernel32.completions == {}
+
+
+@pytest.mark.parametrize('queue_depth', [1, 4])
+def test_scan_finds_bad_clusters_and_sectors(simulated_volume, queue_depth):
+    volume, disk = simulated_volume
+    scan = SurfaceScan(volume, 64 * CLUSTER, queue_depth, slow_ms=0)
+    try:
+        findings = scan.scan()
+    finally:
+        scan.close()
+    first = volume.cluster_to_sector(0)
+    assert [(cluster, err, sectors) for cluster, err, sectors in findings] == [
+        (40, 23, [first + 40 * 8 + 3]),
+        (300, 23, [first + 300 * 8 + 1]),
+    ]
+
+
+def test_scan_of_image_with_thread_pool(image_path, mapfile, capsys):
+    image = NtfsImage(image_path, mapfile=mapfile([BAD_OFFSET])).open()
+    scan = SurfaceScan(image, 16 * CLUSTER, queue_depth=4, slow_ms=0)
+    try:
+        findings = scan.scan()
+    finally:
+        scan.close()
+        image.close()
+    assert isinstance(scan.reader, ThreadPoolReader)
+    assert [(cluster, sectors) for cluster, err, sectors in findings] == [(301, [4458])]
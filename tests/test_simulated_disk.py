@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import probe
+import readers
+import scan
+import volume as win_volume
+from compare_strategies import damaged_clusters, run_strategy
+from probe import ClusterProbe
+from scan import SurfaceScan
+from simulated_disk import DiskModel, SimulatedDisk, install
+from volume import Volume
+
+
+def strategy_args(**kwargs):
+    values = dict(size_gb=1, used_percent=50, areas=3, radius=500, density=0.05, error_ms=1500.0, seed=7,
+                  chunk_size=4, queue_depth=1, slow_ms=200, margin=64, rewrite=False)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def test_install_restores_kernel32_and_time():
+    real_kernel32 = win_volume.kernel32
+    disk = SimulatedDisk(1024, DiskModel(1024 * 8))
+    with install(disk) as clock:
+        assert win_volume.kernel32.disk is disk
+        assert probe.time is clock and readers.time is clock and scan.time is clock
+    assert win_volume.kernel32 is real_kernel32
+    assert probe.time is time and readers.time is time and scan.time is time
+
+
+def test_install_restores_after_an_error():
+    disk = SimulatedDisk(1024, DiskModel(1024 * 8))
+    try:
+        with install(disk):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert scan.time is time
+
+
+def test_model_costs():
+    model = DiskModel(1000000, bad=[5000], weak={6000: 500.0})
+    err, ms = model.read(0, 8)
+    assert err == 0 and ms < 1
+    err, ms = model.read(8, 8)          # Sequential: no seek
+    assert model.seeks == 0
+    err, ms = model.read(4992, 16)
+    assert err == 23 and ms > 1500 and model.seeks == 1
+    err, ms = model.read(6000, 8)
+    assert err == 0 and ms > 500
+    model.write(5000, 1)
+    assert model.read(4992, 16)[0] == 0 and model.reallocated == 1
+
+
+def test_generated_models_are_deterministic():
+    first = DiskModel.generate(10 ** 7, areas=5, seed=3)
+    second = DiskModel.generate(10 ** 7, areas=5, seed=3)
+    assert first.bad == second.bad and first.weak == second.weak and first.centres == second.centres
+    assert first.bad != DiskModel.generate(10 ** 7, areas=5, seed=4).bad
+
+
+def test_scan_finds_all_the_bad_clusters():
+    args = strategy_args()
+    result = run_strategy('scan', args)
+    assert result['bad_found'] == result['bad_clusters'] > 0
+    assert result['simulated_seconds'] > 0
+    assert scan.time is time
+
+
+def test_strategies_are_repeatable_and_rewrite_reallocates():
+    args = strategy_args(rewrite=True)
+    first = run_strategy('hotspots', args)
+    second = run_strategy('hotspots', args)
+    for key in ('simulated_seconds', 'reads', 'seeks', 'bad_found', 'weak_found', 'rewritten'):
+        assert first[key] == second[key]
+    assert first['rewritten'] and first['reallocated_sectors'] >= first['rewritten']
+
+
+def test_damaged_clusters():
+    model = DiskModel(8000, bad=[80, 81, 800], weak={805: 300.0, 1600: 300.0}, flaky={2400: 0.5})
+    disk = SimulatedDisk(1000, model)
+    assert damaged_clusters(disk) == ({10, 100}, {200, 300})
+
+
+def test_probe_and_scan_find_a_weak_sector(capsys):
+    weak = 300 * 8 + 5          # Volume sector, in cluster 300
+    disk = SimulatedDisk(1024, DiskModel(1024 * 8, weak={weak: 500.0}))
+    with install(disk):
+        volume = Volume('X', unbuffered=True).open()
+        try:
+            sector = volume.cluster_to_sector(0) + weak
+            err, out_size, ms, slow = ClusterProbe(volume, slow_ms=200).probe(300)
+            assert (err, out_size) == (0, 4096) and ms > 500
+            assert [s for s, sector_ms in slow] == [sector] and slow[0][1] > 500
+            assert ClusterProbe(volume, slow_ms=200).probe(301)[3] == []
+            assert ClusterProbe(volume, slow_ms=0).probe(300)[3] == []
+            for queue_depth in (1, 4):
+                scan = SurfaceScan(volume, 64 * 4096, queue_depth, slow_ms=200)
+                try:
+                    assert scan.scan() == []
+                finally:
+                    scan.close()
+                assert [(cluster, [s for s, sector_ms in sectors]) for cluster, sectors in scan.slow] == [
+                    (300, [sector])]
+        finally:
+            volume.close()
@@ -0,0 +1,125 @@
+import os
+import types
+
+import pytest
+
+import snapshot
+from fake_kernel32 import FakeDisk
+from snapshot import load_snapshot, open_snapshot, snapshot_path
+from volume import Volume
+
+HALF = 512 * 4096
+
+
+@pytest.fixture(params=['one extent', 'two extents'])
+def disk(request):
+    if request.param == 'one extent':
+        disk = FakeDisk(total_clusters=1024)
+    else:
+        disk = FakeDisk(total_clusters=1024, extents=[(1, 1 << 20, HALF), (2, 1 << 20, HALF)])
+    disk.set_bitmap(b'\x0f\x00\xff\x81')
+    return disk
+
+
+@pytest.fixture
+def journal():
+    return types.SimpleNamespace(UsnJournalID=7, NextUsn=1000)
+
+
+@pytest.fixture
+def open_cached(fake_kernel32, tmp_path, capsys):
+    """Opens a Volume on a FakeDisk through the snapshot cache in tmp_path:
+    call it with the disk and the journal the volume reports. Returns the
+    volume, its bitmap, and whether the bitmap was read from the volume."""
+    volumes = []
+
+    def open_cached(disk, journal):
+        fake_kernel32(disk)
+        volume = Volume('X')
+        volumes.append(volume)
+        volume.query_usn_journal = lambda: journal
+        loads = []
+        load_bitmap = volume.load_bitmap
+
+        def counted(*args):
+            loads.append(args)
+            return load_bitmap(*args)
+        volume.load_bitmap = counted
+        bitmap = open_snapshot(volume, str(tmp_path))
+        capsys.readouterr()
+        return volume, bitmap, bool(loads)
+    yield open_cached
+    for volume in volumes:
+        if volume.handle is not None:
+            volume.close()
+
+
+def geometry(volume):
+    return (volume.extents, volume.start, volume.end, volume.bytes_per_sector, volume.cluster_size,
+            volume.total_clusters)
+
+
+def saved_journal(path):
+    with open(path, 'rb') as f:
+        magic, serial, journal_id, next_usn = snapshot._HEADER.unpack_from(f.read())[:4]
+    return journal_id, next_usn
+
+
+def test_second_open_uses_the_snapshot(disk, journal, open_cached, tmp_path):
+    live, live_bitmap, loaded = open_cached(disk, journal)
+    assert loaded and os.path.exists(snapshot_path(str(tmp_path), disk.serial))
+    cached, bitmap, loaded = open_cached(disk, journal)
+    assert not loaded
+    assert geometry(cached) == geometry(live)
+    assert len(cached.extents) == len(disk.extents)
+    assert bytes(bitmap.data) == bytes(live_bitmap.data) == bytes(disk.bitmap)
+    assert bitmap.total_clusters == 1024
+    assert cached.cluster_to_sector(600) == live.cluster_to_sector(600)
+
+
+@pytest.mark.parametrize('field', ['UsnJournalID', 'NextUsn'])
+def test_journal_change_reloads_and_rewrites(disk, journal, open_cached, tmp_path, field):
+    open_cached(disk, journal)
+    setattr(journal, field, getattr(journal, field) + 1)
+    disk.set_bitmap(b'\xff')
+    volume, bitmap, loaded = open_cached(disk, journal)
+    assert loaded and bytes(bitmap.data) == bytes(disk.bitmap)
+    assert saved_journal(snapshot_path(str(tmp_path), disk.serial)) == (journal.UsnJournalID, journal.NextUsn)
+    assert not open_cached(disk, journal)[2]
+
+
+def test_serial_change_reloads(disk, journal, open_cached, tmp_path):
+    volume = open_cached(disk, journal)[0]
+    path = snapshot_path(str(tmp_path), disk.serial)
+    assert load_snapshot(volume, path, disk.serial + 1, journal) is None
+    disk.serial += 1
+    assert open_cached(disk, journal)[2]
+    assert os.path.exists(snapshot_path(str(tmp_path), disk.serial))
+    assert not open_cached(disk, journal)[2]
+
+
+def damage(path, how):
+    with open(path, 'rb') as f:
+        data = f.read()
+    sizes = {'short header': 10, 'no extents': snapshot._HEADER.size,
+             'half an extent': snapshot._HEADER.size + snapshot._EXTENT.size // 2,
+             'short bitmap': len(data) - 1, 'empty': 0}
+    data = b'QSSNAP0\0' + data[8:] if how == 'bad magic' else data[:sizes[how]]
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('how', ['short header', 'no extents', 'half an extent', 'short bitmap', 'empty',
+                                 'bad magic'])
+def test_damaged_snapshot_is_replaced(disk, journal, open_cached, tmp_path, how):
+    live = geometry(open_cached(disk, journal)[0])
+    damage(snapshot_path(str(tmp_path), disk.serial), how)
+    volume, bitmap, loaded = open_cached(disk, journal)
+    assert loaded and geometry(volume) == live and bytes(bitmap.data) == bytes(disk.bitmap)
+    assert not open_cached(disk, journal)[2]
+
+
+def test_no_snapshot_without_a_journal(disk, open_cached, tmp_path):
+    assert open_cached(disk, None)[2]
+    assert open_cached(disk, None)[2]
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,98 @@
+import pytest
+
+from ntfs_image import NtfsImage
+from verify import byte_ranges, merge_extents, merge_ranges, print_verify_results, verify_tree
+
+CLUSTER = 4096
+VOLUME_START = 1 << 20      # Image offset of the image fixture's volume
+
+
+def sector_offset(cluster, sector=0):
+    """Image offset of a sector of a volume cluster in the image fixture."""
+    return VOLUME_START + cluster * CLUSTER + sector * 512
+
+
+@pytest.fixture
+def open_image(image_path, mapfile, capsys):
+    """Opens the image fixture with the given sectors unreadable."""
+    images = []
+
+    def open_image(bad_offsets):
+        image = NtfsImage(image_path, mapfile=mapfile(bad_offsets)).open()
+        images.append(image)
+        capsys.readouterr()
+        return image
+    yield open_image
+    for image in images:
+        image.close()
+
+
+def statuses(files):
+    return dict((result.path, result.status) for result in files)
+
+
+def test_verify_tree_finds_the_damaged_file(open_image, capsys):
+    image = open_image([sector_offset(301, 2)])     # \frag.bin VCN 1
+    files = verify_tree(image, '/', 4 * CLUSTER)
+    assert statuses(files) == {'\\docs\\report.txt': 'ok', '\\frag.bin': 'unreadable', '\\sparse.bin': 'ok',
+                               '\\last.txt': 'ok'}
+    [frag] = [result for result in files if result.path == '\\frag.bin']
+    assert frag.bad == [(5120, 5631)] and frag.slow == []
+    capsys.readouterr()
+    print_verify_results(files)
+    out = capsys.readouterr().out
+    assert 'UNREADABLE \\frag.bin (8192 bytes): bytes 5120-5631\n' in out
+    assert '3 file(s) readable, 1 unreadable' in out
+
+
+def test_verify_tree_merges_ranges_in_a_file(open_image):
+    image = open_image([sector_offset(100, 7), sector_offset(101, 0), sector_offset(200, 1)])
+    files = verify_tree(image, '\\docs', 4 * CLUSTER, max_gap_bytes=0)
+    [report] = files
+    assert report.bad == [(3584, 4607), (16896, 17407)]     # The first two sectors touch
+
+
+def test_verify_tree_ignores_slack_past_the_end_of_the_data(open_image):
+    # \frag.bin is 8192 bytes: its clusters from VCN 2 on hold no data
+    image = open_image([sector_offset(500, 0), sector_offset(2002, 0), sector_offset(2002, 5)])
+    iter_tree_files = image.iter_tree_files
+
+    def shortened(root):
+        # \last.txt ends 300 bytes into its last cluster, before the second bad sector
+        for path, size, extents in iter_tree_files(root):
+            yield path, 2 * CLUSTER + 300 if path == '\\last.txt' else size, extents
+    image.iter_tree_files = shortened
+    files = verify_tree(image, '/', 4 * CLUSTER)
+    assert statuses(files)['\\frag.bin'] == 'ok'
+    [last] = [result for result in files if result.path == '\\last.txt']
+    assert last.bad == [(2 * CLUSTER, 2 * CLUSTER + 299)]
+
+
+@pytest.mark.parametrize('extents, max_gap, expected', [
+    ([], 0, ([], [])),
+    ([(10, 5), (12, 2)], 0, ([10], [5])),                 # Inside another
+    ([(10, 5), (12, 10)], 0, ([10], [12])),               # Overlapping
+    ([(10, 5), (15, 5)], 0, ([10], [10])),                # Touching
+    ([(10, 5), (16, 5)], 0, ([10, 16], [5, 5])),
+    ([(10, 5), (18, 2)], 3, ([10], [10])),                # Exactly max_gap apart
+    ([(10, 5), (19, 2)], 3, ([10, 19], [5, 2])),
+    ([(0, 1), (2, 1), (4, 1), (100, 1)], 1, ([0, 100], [5, 1])),
+])
+def test_merge_extents(extents, max_gap, expected):
+    assert merge_extents(extents, max_gap) == expected
+
+
+@pytest.mark.parametrize('ranges, expected', [
+    ([], []),
+    ([(10, 19), (0, 9)], [(0, 19)]),                      # Touching, out of order
+    ([(0, 9), (11, 19)], [(0, 9), (11, 19)]),
+    ([(0, 100), (10, 20), (50, 150)], [(0, 150)]),
+])
+def test_merge_ranges(ranges, expected):
+    assert merge_ranges(ranges) == expected
+
+
+def test_byte_ranges(image_volume):
+    first = image_volume.cluster_to_sector(301)
+    assert byte_ranges(image_volume, 301, []) == [(0, CLUSTER)]
+    assert byte_ranges(image_volume, 301, [first + 2, first + 7]) == [(1024, 512), (3584, 512)]
@@ -0,0 +1,150 @@
+"""Verifying that every file in a directory tree can still be read.
+
+Reading the files one by one through the filesystem seeks all over a
+fragmented disk. Instead, the extents of every file are collected first,
+sorted by LCN and merged into large reads, and the volume is read in a
+single pass from its lowest cluster to its highest, as a surface scan
+would. The unreadable and slow clusters found are then mapped back to byte
+ranges of the files using them.
+"""
+import bisect
+import logging
+
+from scan import SurfaceScan, print_progress
+
+logger = logging.getLogger(__name__)
+
+# Reading across a gap between extents this small costs less than seeking over it
+MERGE_GAP_BYTES = 1024 * 1024
+
+
+class FileResult:
+    """What verify_tree() found for one file."""
+
+    def __init__(self, path, size, extents):
+        self.path = path
+        self.size = size
+        self.extents = extents  # [(VCN, LCN, cluster count)], or None if the file couldn't be opened
+        self.bad = []           # Unreadable (first byte, last byte) ranges of the file
+        self.slow = []          # Slow (first byte, last byte) ranges
+
+    @property
+    def status(self):
+        if self.extents is None:
+            return 'not opened'
+        if self.bad:
+            return 'unreadable'
+        if self.slow:
+            return 'slow'
+        return 'ok' if self.extents else 'resident'
+
+
+def merge_extents(extents, max_gap):
+    """Returns (starts, lengths) of the reads covering a list of (LCN,
+    cluster count) extents sorted by LCN: extents that overlap, touch or are
+    at most `max_gap` clusters apart are read together."""
+    starts, lengths = [], []
+    end = None
+    for lcn, count in extents:
+        if end is not None and lcn <= end + max_gap:
+            end = max(end, lcn + count)
+            lengths[-1] = end - starts[-1]
+        else:
+            starts.append(lcn)
+            lengths.append(count)
+            end = lcn + count
+    return starts, lengths
+
+
+def byte_ranges(volume, cluster, sectors):
+    """Returns the (offset, length) ranges within a cluster covered by the
+    given physical disk sectors of it, or all of it if there are none."""
+    if not sectors:
+        return [(0, volume.cluster_size)]
+    first_sector = volume.cluster_to_sector(cluster)
+    return [((sector - first_sector) * volume.bytes_per_sector, volume.bytes_per_sector) for sector in sectors]
+
+
+def merge_ranges(ranges):
+    """Sorts (first, last) byte ranges and joins those that touch."""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [tuple(r) for r in merged]
+
+
+def verify_tree(volume, root, chunk_size, queue_depth=1, slow_ms=0, max_gap_bytes=MERGE_GAP_BYTES):
+    """Reads every file under `root` in LCN order and returns a FileResult
+    for each, in the order the files were found."""
+    cluster_size = volume.cluster_size
+    print('Finding the extents of the files in %s...' % root)
+    files = []
+    extents = []        # (LCN, cluster count, index in files, VCN)
+    for path, size, file_extents in volume.iter_tree_files(root):
+        result = FileResult(path, size, file_extents)
+        for vcn, lcn, count in file_extents or ():
+            extents.append((lcn, count, len(files), vcn))
+        files.append(result)
+    if not files:
+        print('No files found.')
+        return files
+    extents.sort()
+    starts, lengths = merge_extents([extent[:2] for extent in extents], max(0, max_gap_bytes // cluster_size))
+    total = sum(lengths)
+    print('%s file(s), %s extent(s): reading %s clusters (%.1f MB) in %s run(s)...'
+          % (len(files), len(extents), total, total * cluster_size / 1e6, len(starts)))
+
+    scan = SurfaceScan(volume, chunk_size, queue_depth, slow_ms)
+    try:
+        scan.scan_runs(starts, lengths, print_progress(total) if total else None)
+    finally:
+        scan.close()
+    print('%s unreadable and %s slow cluster(s) found in %s reads.' % (len(scan.findings), len(scan.slow), scan.reads))
+
+    damage = {}     # Cluster -> ([(offset, length)] unreadable, [(offset, length)] slow)
+    for cluster, err, sectors in scan.findings:
+        damage.setdefault(cluster, ([], []))[0].extend(byte_ranges(volume, cluster, sectors))
+    for cluster, sectors in scan.slow:
+        damage.setdefault(cluster, ([], []))[1].extend(
+            byte_ranges(volume, cluster, [sector for sector, ms in sectors]))
+    clusters = sorted(damage)
+    for lcn, count, index, vcn in extents:
+        result = files[index]
+        for cluster in clusters[bisect.bisect_left(clusters, lcn):bisect.bisect_left(clusters, lcn + count)]:
+            base = (vcn + cluster - lcn) * cluster_size
+            for ranges, found in zip((result.bad, result.slow), damage[cluster]):
+                for offset, length in found:
+                    first, last = base + offset, min(base + offset + length, result.size) - 1
+                    if first <= last:   # Past the end of the data, in the last cluster's slack
+                        ranges.append((first, last))
+    for result in files:
+        result.bad = merge_ranges(result.bad)
+        result.slow = merge_ranges(result.slow)
+    return files
+
+
+def format_ranges(ranges):
+    return ', '.join('%s-%s' % (first, last) if first != last else str(first) for first, last in ranges)
+
+
+def print_verify_results(files):
+    """Prints the files that couldn't be read in full, or read slowly, and
+    counts of the rest."""
+    counts = {}
+    for result in files:
+        status = result.status
+        counts[status] = counts.get(status, 0) + 1
+        if status == 'unreadable':
+            print('UNREADABLE %s (%s bytes): bytes %s' % (result.path, result.size, format_ranges(result.bad)))
+            if result.slow:
+                print('           slow: bytes %s' % format_ranges(result.slow))
+        elif status == 'slow':
+            print('SLOW       %s (%s bytes): bytes %s' % (result.path, result.size, format_ranges(result.slow)))
+        elif status == 'not opened':
+            print('NOT OPENED %s' % result.path)
+    print('%s file(s) readable, %s unreadable, %s slow, %s not opened; %s resident or empty (not read).'
+          % (counts.get('ok', 0), counts.get('unreadable', 0), counts.get('slow', 0),
+             counts.get('not opened', 0), counts.get('resident', 0)))
@@ -0,0 +1,761 @@
+import ctypes
+import functools
+import logging
+import os
+import time
+
+import iostats
+from win_types import *
+
+logger = logging.getLogger(__name__)
+kernel32 = ctypes.windll.kernel32 if hasattr(ctypes, 'windll') else None
+
+
+class VolumeError(RuntimeError):
+    """Raised when a volume can be opened but isn't one we can work with."""
+
+
+def get_error_string(code):
+    msg_buf = ctypes.create_unicode_buffer(256)
+    msg_len = kernel32.FormatMessageW(
+        0x1000,     # flags = _FROM_SYSTEM
+        None,       # lpSource - ignored for these flags
+        code,       # dwMessageId
+        0,          # Language ID
+        msg_buf,
+        len(msg_buf),   # buffer size / minimum size to allocate
+        None,       # arg list
+    )
+    return msg_buf.value
+
+
+def aligned_buffer(size, alignment=4096):
+    """Returns a ctypes char array of `size` bytes starting on an `alignment`
+    boundary, as FILE_FLAG_NO_BUFFERING reads require."""
+    raw = ctypes.create_string_buffer(size + alignment)
+    pad = -ctypes.addressof(raw) % alignment
+    return (ctypes.c_char * size).from_buffer(raw, pad)
+
+
+def get_disk_extents(handle):
+    """Returns the (disk number, starting offset, length) of every extent of
+    an open volume, making room for as many as it has."""
+    out_size = ctypes.c_ulong()
+    count = 1
+    while True:
+        buf = ctypes.create_string_buffer(
+            VOLUME_DISK_EXTENTS.Extents.offset + count * ctypes.sizeof(DISK_EXTENT))
+        res = kernel32.DeviceIoControl(
+            handle,
+            IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS,
+            None,                   # lpInputBuffer
+            0,
+            buf,
+            ctypes.sizeof(buf),     # out buffer size
+            ctypes.byref(out_size), # lpBytesReturned
+            None,                   # lpOverlapped
+        )
+        vde = VOLUME_DISK_EXTENTS.from_buffer(buf)
+        if res != 0:
+            break
+        err = kernel32.GetLastError()
+        if err != 234 or vde.NumberOfDiskExtents <= count:     # ERR_MORE_DATA
+            logger.fatal("Failed to get volume's on-disk location")
+            raise ctypes.WinError(err)
+        count = vde.NumberOfDiskExtents
+    extents = []
+    for i in range(vde.NumberOfDiskExtents):
+        extent = DISK_EXTENT.from_buffer(buf, VOLUME_DISK_EXTENTS.Extents.offset + i * ctypes.sizeof(DISK_EXTENT))
+        extents.append((extent.DiskNumber, extent.StartingOffset, extent.ExtentLength))
+    return extents
+
+
+def get_retrieval_pointers(handle, buffer_size=64 * 1024):
+    """Yields (VCN, LCN, cluster count) for every extent of an open file
+    that is allocated on disk, following FSCTL_GET_RETRIEVAL_POINTERS
+    through as many calls as it takes. Resident and empty files have none."""
+    out_size = ctypes.c_ulong()
+    buf = ctypes.create_string_buffer(buffer_size)
+    vcn = ctypes.c_longlong(0)
+    while True:
+        res = kernel32.DeviceIoControl(
+            handle,
+            FSCTL_GET_RETRIEVAL_POINTERS,
+            ctypes.byref(vcn),
+            ctypes.sizeof(vcn),
+            buf,
+            ctypes.sizeof(buf),
+            ctypes.byref(out_size),
+            None,
+        )
+        if res == 0:
+            err = kernel32.GetLastError()
+            if err == 38:       # ERROR_HANDLE_EOF - nothing (more) allocated
+                return
+            if err != 234:
+                raise ctypes.WinError(err)
+        rpb = RETRIEVAL_POINTERS_BUFFER.from_buffer(buf)
+        extents = (RETRIEVAL_POINTERS_EXTENT * rpb.ExtentCount).from_buffer(buf, RETRIEVAL_POINTERS_BUFFER.NextVcn.offset)
+        start_vcn = rpb.StartingVcn
+        for extent in extents:
+            if extent.Lcn != -1:
+                yield start_vcn, extent.Lcn, extent.NextVcn - start_vcn
+            start_vcn = extent.NextVcn
+        if res != 0 or rpb.ExtentCount == 0:
+            return
+        vcn.value = start_vcn
+
+
+@functools.lru_cache(maxsize=None)
+def lookup_input_type(count):
+    """Returns a LOOKUP_STREAM_FROM_CLUSTER_INPUT variant with room for `count` clusters."""
+    return type('LOOKUP_STREAM_FROM_CLUSTER_INPUT_%s' % count, (ctypes.Structure,), {
+        '_fields_': [
+            ('Flags', ctypes.c_ulong),
+            ('NumberOfClusters', ctypes.c_ulong),
+            ('Cluster', ctypes.c_ulonglong * count),
+        ],
+    })
+
+
+class VolumeBackend:
+    """What query_sector.py and the scanners need from a volume, whatever it
+    is read from: its geometry, its bitmap, which files use a cluster, and
+    reads from it. Volume is a mounted Windows volume; ntfs_image.NtfsImage
+    is an NTFS volume inside an image file.
+
+    Subclasses set name, extents, disk_number, start, end, bytes_per_sector,
+    cluster_size and total_clusters in open(), and implement the methods
+    that raise NotImplementedError here.
+    """
+
+    can_rewrite = False     # Whether main() can rewrite clusters with the dummy file trick
+    _cluster_buf = None     # Reused by read_cluster()
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load_bitmap(self):
+        """Returns the whole bitmap in FSCTL_GET_VOLUME_BITMAP's output format."""
+        raise NotImplementedError
+
+    def read_bitmap(self, start_lcn, size):
+        """Returns (starting LCN, bitmap data) for up to `size` bytes of the
+        bitmap from `start_lcn`, rounded down to a multiple of 8."""
+        raise NotImplementedError
+
+    def read_at(self, offset, buf, size):
+        """Reads `size` bytes at a byte offset within the volume into `buf`.
+        Returns (error code, bytes read); the error code is zero on success."""
+        raise NotImplementedError
+
+    def lookup_cluster_files(self, clusters):
+        """Returns a dict of cluster -> list of (flags, file name) for a set
+        of in-use clusters."""
+        raise NotImplementedError
+
+    def build_file_index(self):
+        """Returns a file_index.FileIndex of every file on the volume."""
+        raise NotImplementedError
+
+    def get_serial_number(self):
+        """Returns the volume's 32-bit serial number, as `vol` shows it."""
+        raise NotImplementedError
+
+    def iter_tree_files(self, root):
+        """Yields (path, size, extents) for every file under directory `root`
+        (or just `root`, if it is a file), where extents is a list of (VCN,
+        LCN, cluster count) for the file's data on disk, empty for resident
+        and empty files, or None if the file couldn't be opened."""
+        raise NotImplementedError
+
+    def read_cluster(self, cluster):
+        """Reads one cluster into a buffer the volume keeps for the purpose.
+        Returns (error code, bytes read); the error code is zero on success."""
+        if self._cluster_buf is None or len(self._cluster_buf) != self.cluster_size:
+            self._cluster_buf = aligned_buffer(self.cluster_size)
+        return self.read_at(cluster * self.cluster_size, self._cluster_buf, self.cluster_size)
+
+    def cluster_to_sector(self, cluster):
+        """Returns the first physical disk sector of a cluster."""
+        return (self.start + cluster * self.cluster_size) // self.bytes_per_sector
+
+    def sector_to_cluster(self, sector, disk_number=None):
+        """Returns the cluster holding a physical disk sector, or None if the
+        sector is outside this volume."""
+        if disk_number is not None and disk_number != self.disk_number:
+            return None
+        offset = sector * self.bytes_per_sector
+        if offset < self.start or offset >= self.end:
+            return None
+        return (offset - self.start) // self.cluster_size
+
+
+class Volume(VolumeBackend):
+    """An open handle to a mounted NTFS volume, plus the geometry needed to
+    turn a physical disk sector into a cluster number.
+
+    Everything that main() used to set up for a single query lives here, so
+    that several queries (or a whole batch of them) can share one setup.
+    """
+
+    can_rewrite = True
+
+    def __init__(self, drive_letter, unbuffered=False):
+        if drive_letter.startswith('\\\\?\\'):
+            # A volume GUID path (\\?\Volume{...}\), for volumes without a drive letter
+            self.path = drive_letter.rstrip('\\') + '\\'
+            self.name = drive_letter.rstrip('\\')
+        else:
+            self.name = r'\\.\%s:' % drive_letter
+            self.path = '%s:\\' % drive_letter
+        self.unbuffered = unbuffered    # Reads must then be sector-aligned, see aligned_buffer()
+        self.handle = None
+        self.extents = None         # List of (disk number, starting offset, length)
+        self.disk_number = None
+        self.start = None           # Byte offset of the volume on the physical disk
+        self.end = None             # First byte offset AFTER the end of the volume
+        self.bytes_per_sector = None
+        self.cluster_size = None
+        self.total_clusters = None
+        self._out_size = ctypes.c_ulong()
+        # Reused by every read_bitmap() and lookup_clusters() call; both grow as needed
+        self._start_lcn = ctypes.c_ulonglong()
+        self._bitmap_buf = ctypes.create_string_buffer(0)
+        self._lookup_in = lookup_input_type(64)()
+        self._lookup_buf = ctypes.create_string_buffer(4096)
+
+    def open(self):
+        self.open_handle()
+        return self.inspect()
+
+    def inspect(self):
+        """Checks that the volume on an open handle is usable, and finds its
+        extents and geometry."""
+        self._check_mounted()
+        self._get_extents()
+        self._get_geometry()
+        self._check_filesystem()
+        self._check_retrieval_pointer_base()
+        return self
+
+    def open_handle(self):
+        """Opens the volume handle only, without any of the checks and
+        geometry queries that open() goes on to do."""
+        print("Opening %s..." % self.name)
+        self.handle = kernel32.CreateFileW(
+            self.name,
+            2 << 30,    # GENERIC_READ
+            0x3,        # FILE_SHARE_READ | FILE_SHARE_WRITE
+            None,       # securitydescriptor
+            0x3,        # OPEN_EXISTING
+            #0x80000000, # WRITE_THROUGH
+            0x20000000 if self.unbuffered else 0,     # FILE_FLAG_NO_BUFFERING
+            None,       # hTemplateFile
+        )
+        if self.handle == INVALID_HANDLE:
+            logger.fatal('Failed to open a handle to the volume. Do you have admin privileges?')
+            raise ctypes.WinError()
+        logger.info("Volume handle: %s" % self.handle)
+        return self
+
+    def close(self):
+        res = kernel32.CloseHandle(self.handle)
+        if res == 0:
+            logger.fatal('Error closing volume handle')
+            raise ctypes.WinError()
+        self.handle = None
+
+    def __exit__(self, *exc_info):
+        if self.handle is not None:
+            self.close()
+
+    def _check_mounted(self):
+        # 0x00090028  FSCTL_IS_VOLUME_MOUNTED
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_IS_VOLUME_MOUNTED,
+            None,
+            0,
+            None,
+            0,
+            ctypes.byref(self._out_size),  # lpBytesReturned - don't care (is 0)
+            None,           # lpOverlapped
+        )
+        err = kernel32.GetLastError()
+        if err != 0:
+            raise VolumeError(" Error %s checking volume mount status: %s" % (err, get_error_string(err)))
+        print(" Volume is%s mounted" % ('' if res else ' not'))
+
+    def geometry(self):
+        """Everything open() finds out about the volume, as the keyword
+        arguments to restore_geometry()."""
+        return {
+            'extents': self.extents,
+            'bytes_per_sector': self.bytes_per_sector,
+            'cluster_size': self.cluster_size,
+            'total_clusters': self.total_clusters,
+        }
+
+    def restore_geometry(self, extents, bytes_per_sector, cluster_size, total_clusters):
+        """Sets up a volume opened with open_handle() from a saved geometry()."""
+        self._set_extents(extents)
+        self.bytes_per_sector = bytes_per_sector
+        self.cluster_size = cluster_size
+        self.total_clusters = total_clusters
+
+    def _set_extents(self, extents):
+        self.extents = extents
+        if len(extents) == 1:
+            self.disk_number, self.start, length = extents[0]
+            self.end = self.start + length
+
+    def _get_extents(self):
+        self._set_extents(get_disk_extents(self.handle))
+        if len(self.extents) > 1:
+            # Spanned, striped or mirrored: sectors can only be mapped given the disk they're on
+            print(" Volume has %s extents:" % len(self.extents))
+            for disk_number, start, length in self.extents:
+                print("  %s bytes on \\\\.\\PhysicalDisk%s starting at disk offset %s" % (length, disk_number, start))
+            return
+        print(" Volume is located on \\\\.\\PhysicalDisk%s" % self.disk_number)
+        print("  %s bytes starting at disk offset %s" % (self.end - self.start, self.start))
+
+    def _get_geometry(self):
+        spc = ctypes.c_ulong()
+        bps = ctypes.c_ulong()
+        cfree = ctypes.c_ulong()
+        ctotal = ctypes.c_ulong()
+        res = kernel32.GetDiskFreeSpaceW(
+            self.path,
+            ctypes.byref(spc),      # Sectors per Cluster
+            ctypes.byref(bps),      # Bytes / sector
+            ctypes.byref(cfree),    # free clusters
+            ctypes.byref(ctotal),   # Total clusters
+        )
+        if res == 0:
+            err = kernel32.GetLastError()
+            raise VolumeError(" Error %s: %s" % (err, get_error_string(err)))
+        self.bytes_per_sector = bps.value
+        self.cluster_size = bps.value * spc.value
+        self.total_clusters = ctotal.value
+        print("  %s bytes per sector, %s sectors per cluster (%s bytes per cluster)"
+              % (self.bytes_per_sector, spc.value, self.cluster_size))
+
+    def _check_filesystem(self):
+        fs_flags = ctypes.c_uint()
+        buf = ctypes.create_unicode_buffer(32)    # FS type name buffer
+        res = kernel32.GetVolumeInformationW(
+            self.path,
+            None,       # lpVolNameBuffer
+            0,          # nVolNameSize
+            None,       # lpVolSerial
+            ctypes.byref(self._out_size),  # max path component length, but we don't care
+            ctypes.byref(fs_flags),
+            buf,
+            ctypes.sizeof(buf),
+        )
+        if res == 0:
+            logger.fatal('Error calling GetVolumeInformation')
+            raise ctypes.WinError()
+        if fs_flags.value & 0x80000:
+            logger.warning('Volume is read-only')
+        if buf.value != 'NTFS':
+            logger.fatal('Only tested on NTFS -- FS type is "%s"' % buf.value)
+            raise VolumeError('Only tested on NTFS -- FS type is "%s"' % buf.value)
+
+    def _check_retrieval_pointer_base(self):
+        buf = ctypes.c_ulonglong()
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_GET_RETRIEVAL_POINTER_BASE,
+            None,
+            0,
+            ctypes.byref(buf),
+            ctypes.sizeof(buf),
+            ctypes.byref(self._out_size),  # lpBytesReturned
+            None,                       # lpOverlapped
+        )
+        if res == 0:
+            logger.fatal('Failure when requesting FS starting cluster')
+            raise ctypes.WinError()
+        if buf.value != 0:
+            raise RuntimeError('First cluster offset in volume is not zero (got %s instead)' % buf.value)
+
+    def get_serial_number(self):
+        serial = ctypes.c_ulong()
+        res = kernel32.GetVolumeInformationW(
+            self.path,
+            None,       # lpVolNameBuffer
+            0,          # nVolNameSize
+            ctypes.byref(serial),
+            None,       # lpMaximumComponentLength
+            None,       # lpFileSystemFlags
+            None,       # lpFileSystemNameBuffer
+            0,          # nFileSystemNameSize
+        )
+        if res == 0:
+            logger.fatal('Error calling GetVolumeInformation')
+            raise ctypes.WinError()
+        return serial.value
+
+    def iter_tree_files(self, root):
+        """Walks `root` with os.walk(); other volumes mounted in the tree
+        are skipped, since their clusters aren't on this one."""
+        serial = self.get_serial_number()
+        if os.stat(root).st_dev != serial:
+            raise VolumeError('%s is not on %s' % (root, self.name))
+        if os.path.isdir(root):
+            tree = os.walk(root, onerror=lambda e: logger.warning('Skipping %s: %s' % (e.filename, e)))
+        else:
+            tree = [(os.path.dirname(root), [], [os.path.basename(root)])]
+        for dirpath, dirnames, filenames in tree:
+            dirnames[:] = [name for name in dirnames if self._same_volume(os.path.join(dirpath, name), serial)]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    size = os.stat(path).st_size
+                except OSError as e:
+                    logger.info('Could not stat %s: %s' % (path, e))
+                    yield path, None, None
+                    continue
+                yield path, size, self.file_extents(path)
+
+    @staticmethod
+    def _same_volume(path, serial):
+        try:
+            return os.stat(path).st_dev == serial
+        except OSError:
+            return False
+
+    def file_extents(self, path):
+        """Returns the (VCN, LCN, cluster count) extents of a file's data,
+        or None if it can't be opened."""
+        handle = kernel32.CreateFileW(
+            path,
+            0x80,           # FILE_READ_ATTRIBUTES
+            0x7,            # FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE
+            None,
+            0x3,            # OPEN_EXISTING
+            0x02000000,     # FILE_FLAG_BACKUP_SEMANTICS
+            None,
+        )
+        if handle == INVALID_HANDLE:
+            logger.info('Could not open %s: error %s' % (path, kernel32.GetLastError()))
+            return None
+        try:
+            return list(get_retrieval_pointers(handle))
+        except OSError as e:
+            logger.info('Could not get the extents of %s: %s' % (path, e))
+            return None
+        finally:
+            kernel32.CloseHandle(handle)
+
+    def query_usn_journal(self):
+        """Returns the USN_JOURNAL_DATA_V0 of the volume's change journal, or
+        None if the journal isn't active."""
+        journal = USN_JOURNAL_DATA_V0()
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_QUERY_USN_JOURNAL,
+            None,
+            0,
+            ctypes.byref(journal),
+            ctypes.sizeof(journal),
+            ctypes.byref(self._out_size),
+            None,
+        )
+        if res == 0:
+            err = kernel32.GetLastError()
+            if err in (1178, 1179):     # ERROR_JOURNAL_DELETE_IN_PROGRESS, ERROR_JOURNAL_NOT_ACTIVE
+                return None
+            raise ctypes.WinError(err)
+        return journal
+
+    def read_usn_changes(self, journal_id, start_usn, stop_usn, buffer_size=64 * 1024):
+        """Reads the change journal records from `start_usn` up to (not
+        including) `stop_usn`. Returns a dict of file reference number ->
+        all the USN_REASON_* flags recorded for it, or None if the journal
+        no longer has records going back that far, or was deleted."""
+        rujd = READ_USN_JOURNAL_DATA_V0(StartUsn=start_usn, ReasonMask=0xffffffff, ReturnOnlyOnClose=0,
+                                        Timeout=0, BytesToWaitFor=0, UsnJournalID=journal_id)
+        buf = ctypes.create_string_buffer(buffer_size)
+        changes = {}
+        while rujd.StartUsn < stop_usn:
+            res = kernel32.DeviceIoControl(
+                self.handle,
+                FSCTL_READ_USN_JOURNAL,
+                ctypes.byref(rujd),
+                ctypes.sizeof(rujd),
+                buf,
+                ctypes.sizeof(buf),
+                ctypes.byref(self._out_size),
+                None,
+            )
+            if res == 0:
+                err = kernel32.GetLastError()
+                # ERROR_JOURNAL_DELETE_IN_PROGRESS, _NOT_ACTIVE, ERROR_JOURNAL_ENTRY_DELETED
+                if err in (1178, 1179, 1181):
+                    return None
+                logger.fatal('Failed to read the change journal from USN %s' % rujd.StartUsn)
+                raise ctypes.WinError(err)
+            # The output starts with the USN to continue from
+            offs = 8
+            while offs < self._out_size.value:
+                record = USN_RECORD_V2.from_buffer(buf, offs)
+                if record.Usn >= stop_usn:
+                    return changes
+                changes[record.FileReferenceNumber] = changes.get(record.FileReferenceNumber, 0) | record.Reason
+                offs += record.RecordLength
+            next_usn = ctypes.c_longlong.from_buffer(buf).value
+            if next_usn <= rujd.StartUsn:
+                break
+            rujd.StartUsn = next_usn
+        return changes
+
+    def cluster_to_sector(self, cluster):
+        """Returns the first physical disk sector of a cluster. For volumes
+        with several extents, this is a sector on whichever disk holds it."""
+        if len(self.extents) > 1:
+            disk_number, offset = self.logical_to_physical(cluster * self.cluster_size)[0]
+            return offset // self.bytes_per_sector
+        return super().cluster_to_sector(cluster)
+
+    def sector_to_cluster(self, sector, disk_number=None):
+        """Returns the cluster holding a physical disk sector, or None if the
+        sector is outside this volume. Volumes with several extents need to
+        be told which disk the sector is on."""
+        if len(self.extents) > 1:
+            offset = sector * self.bytes_per_sector
+            if disk_number is None:
+                raise VolumeError('This volume spans %s extents; the disk number is needed '
+                                  'to look up a sector' % len(self.extents))
+            if not any(disk == disk_number and start <= offset < start + length
+                       for disk, start, length in self.extents):
+                return None
+            return self.physical_to_logical(disk_number, offset) // self.cluster_size
+        return super().sector_to_cluster(sector, disk_number)
+
+    def physical_to_logical(self, disk_number, offset):
+        """Maps a byte offset on a physical disk to a byte offset within the volume."""
+        phys = VOLUME_PHYSICAL_OFFSET(DiskNumber=disk_number, Offset=offset)
+        logical = VOLUME_LOGICAL_OFFSET()
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            IOCTL_VOLUME_PHYSICAL_TO_LOGICAL,
+            ctypes.byref(phys),
+            ctypes.sizeof(phys),
+            ctypes.byref(logical),
+            ctypes.sizeof(logical),
+            ctypes.byref(self._out_size),
+            None,
+        )
+        if res == 0:
+            logger.fatal('Failed to map disk %s offset %s to a volume offset' % (disk_number, offset))
+            raise ctypes.WinError()
+        return logical.LogicalOffset
+
+    def logical_to_physical(self, offset):
+        """Maps a byte offset within the volume to a list of (disk number,
+        byte offset), with more than one entry for mirrored volumes."""
+        logical = VOLUME_LOGICAL_OFFSET(LogicalOffset=offset)
+        phys = VOLUME_PHYSICAL_OFFSETS()
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            IOCTL_VOLUME_LOGICAL_TO_PHYSICAL,
+            ctypes.byref(logical),
+            ctypes.sizeof(logical),
+            ctypes.byref(phys),
+            ctypes.sizeof(phys),
+            ctypes.byref(self._out_size),
+            None,
+        )
+        if res == 0:
+            logger.fatal('Failed to map volume offset %s to a disk offset' % offset)
+            raise ctypes.WinError()
+        return [(phys.PhysicalOffset[i].DiskNumber, phys.PhysicalOffset[i].Offset)
+                for i in range(min(phys.NumberOfPhysicalOffsets, len(phys.PhysicalOffset)))]
+
+    def load_bitmap(self):
+        """Loads the whole volume bitmap. Returns the raw FSCTL_GET_VOLUME_BITMAP
+        output buffer (a VOLUME_BITMAP_BUFFER header followed by the bits)."""
+        # Try to get volume bitmap size
+        buf = ctypes.create_string_buffer(32)       # Doesn't seem to like having just a 16-byte buffer, even though in theory that's enough for header
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_GET_VOLUME_BITMAP,
+            ctypes.byref(ctypes.c_ulonglong(0)),        # lpInputBuffer - struct of one LARGE_INTEGER for starting LCN
+            8,
+            buf,
+            ctypes.sizeof(buf),         # out buffer size
+            ctypes.byref(self._out_size),  # lpBytesReturned
+            None,                       # lpOverlapped
+        )
+        if res != 0:
+            raise VolumeError("Unexpected success from GET_VOLUME_BITMAP with no output buffer! Aborting.")
+        err = kernel32.GetLastError()
+        if err == 122:      #  ERROR_INSUFFICIENT_BUFFER
+            raise VolumeError(" GET_VOLUME_BITMAP reported buffer is too small, required size not known. Aborting.")
+        if err != 234:      # ERROR_MORE_DATA_AVAILABLE is expected
+            logger.fatal('Failed to get size of volume bitmap')
+            raise ctypes.WinError(err)
+        header = VOLUME_BITMAP_BUFFER.from_buffer(buf)
+        if header.BitmapSize == 0:
+            raise VolumeError(" Error: GET_VOLUME_BITMAP result shows bitmap size is zero? Aborting.")
+
+        bm_buf = ctypes.create_string_buffer(33 + header.BitmapSize // 8)
+        print("Loading volume bitmap (%s bytes)..." % ctypes.sizeof(bm_buf))
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_GET_VOLUME_BITMAP,
+            ctypes.byref(ctypes.c_ulonglong(0)),    # lpInputBuffer
+            8,
+            bm_buf,
+            ctypes.sizeof(bm_buf),  # out buffer size
+            ctypes.byref(self._out_size),  # lpBytesReturned
+            None,                   # lpOverlapped
+        )
+        if res == 0:
+            raise ctypes.WinError()
+        print('Successfully loaded bitmap.\n')
+        return bm_buf
+
+    def read_bitmap(self, start_lcn, size):
+        """Reads up to `size` bytes of the volume bitmap, starting at the
+        given LCN (which NTFS rounds down to a multiple of 8).
+
+        Returns (starting LCN, bitmap data); the data is shorter than `size`
+        when the window runs past the end of the volume.
+        """
+        if ctypes.sizeof(self._bitmap_buf) < ctypes.sizeof(VOLUME_BITMAP_BUFFER) + size:
+            self._bitmap_buf = ctypes.create_string_buffer(ctypes.sizeof(VOLUME_BITMAP_BUFFER) + size)
+        buf = self._bitmap_buf
+        self._start_lcn.value = start_lcn
+        res = kernel32.DeviceIoControl(
+            self.handle,
+            FSCTL_GET_VOLUME_BITMAP,
+            ctypes.byref(self._start_lcn),     # lpInputBuffer - STARTING_LCN_INPUT_BUFFER
+            8,
+            buf,
+            ctypes.sizeof(buf),
+            ctypes.byref(self._out_size),
+            None,
+        )
+        if res == 0:
+            err = kernel32.GetLastError()
+            if err != 234:      # ERROR_MORE_DATA just means the window doesn't reach the end of the volume
+                logger.fatal('Failed to read volume bitmap at LCN %s' % start_lcn)
+                raise ctypes.WinError(err)
+        header = VOLUME_BITMAP_BUFFER.from_buffer(buf)
+        data_len = min(size, (header.BitmapSize + 7) // 8)
+        return header.StartingLcn, ctypes.string_at(ctypes.addressof(buf) + ctypes.sizeof(VOLUME_BITMAP_BUFFER),
+                                                    data_len)
+
+    def read_at(self, offset, buf, size):
+        stats = iostats.recorder
+        if stats is not None:
+            started = time.perf_counter()
+        res = kernel32.SetFilePointerEx(
+            self.handle,
+            ctypes.c_longlong(offset),
+            None,       # lpNewFilePointer
+            0,          # FILE_BEGIN   (_CURRENT = 1, _END = 2)
+        )
+        if res == 0:
+            logger.fatal('Failed to seek to cluster location')
+            raise ctypes.WinError()
+        res = kernel32.ReadFile(
+            self.handle,
+            buf,
+            size,
+            ctypes.byref(self._out_size),
+            None,
+        )
+        err = 0 if res else kernel32.GetLastError()
+        if stats is not None:
+            stats.record('read', time.perf_counter() - started, self._out_size.value, err, (self.start or 0) + offset)
+        return err, self._out_size.value
+
+    def build_file_index(self):
+        from file_index import FileIndex      # file_index imports this module
+        return FileIndex.build(self)
+
+    def lookup_clusters(self, clusters):
+        """Finds the streams using a group of clusters with a single
+        FSCTL_LOOKUP_STREAM_FROM_CLUSTER call.
+
+        Returns a list of (cluster, flags, file name) for every match, with
+        the input cluster each entry answers.
+        """
+        if len(clusters) > len(self._lookup_in.Cluster):
+            self._lookup_in = lookup_input_type(len(clusters))()
+        lookup_in = self._lookup_in
+        lookup_in.NumberOfClusters = len(clusters)
+        for i, cluster in enumerate(clusters):
+            lookup_in.Cluster[i] = cluster
+        while True:
+            buf = self._lookup_buf
+            res = kernel32.DeviceIoControl(
+                self.handle,
+                FSCTL_LOOKUP_STREAM_FROM_CLUSTER,
+                ctypes.byref(lookup_in),
+                LOOKUP_STREAM_FROM_CLUSTER_INPUT.Cluster.offset + len(clusters) * ctypes.sizeof(ctypes.c_ulonglong),
+                buf,
+                ctypes.sizeof(buf),
+                ctypes.byref(self._out_size),
+                None,
+            )
+            if res != 0:
+                break
+            err = kernel32.GetLastError()
+            if err != 234:
+                raise ctypes.WinError(err)
+            required = LOOKUP_STREAM_FROM_CLUSTER_OUTPUT.from_buffer(buf).BufferSizeRequired
+            if required > ctypes.sizeof(buf):
+                # Grow the buffer to what NTFS says it needs, and keep it for later lookups
+                self._lookup_buf = ctypes.create_string_buffer(required)
+                continue
+            if len(clusters) > 1:
+                # Split the group rather than lose results
+                half = len(clusters) // 2
+                return self.lookup_clusters(clusters[:half]) + self.lookup_clusters(clusters[half:])
+            logger.warning('Got more file matches than will fit in buffer! Some results will not be shown')
+            break
+        lookup_output = LOOKUP_STREAM_FROM_CLUSTER_OUTPUT.from_buffer(buf)
+        matches = []
+        if lookup_output.NumberOfMatches == 0:
+            return matches
+        offs = lookup_output.Offset
+        while True:
+            stream_entry = LOOKUP_STREAM_FROM_CLUSTER_ENTRY.from_buffer(buf, offs)
+            matches.append((stream_entry.Cluster, stream_entry.Flags,
+                            ctypes.wstring_at(ctypes.byref(stream_entry, LOOKUP_STREAM_FROM_CLUSTER_ENTRY.FileName.offset))))
+            if stream_entry.OffsetToNext == 0: break
+            offs += stream_entry.OffsetToNext
+        return matches
+
+    def lookup_cluster_files(self, clusters, group_size=64):
+        """Finds the streams using each of a set of in-use clusters.
+
+        Clusters are looked up in groups of neighbouring LCNs, each group
+        with one FSCTL_LOOKUP_STREAM_FROM_CLUSTER call, and each match is
+        attributed to the cluster its entry names.
+
+        Returns a dict of cluster -> list of (flags, file name).
+        """
+        clusters = sorted(set(clusters))
+        results = dict((cluster, []) for cluster in clusters)
+        for i in range(0, len(clusters), group_size):
+            for cluster, flags, name in self.lookup_clusters(clusters[i:i + group_size]):
+                if cluster in results:
+                    results[cluster].append((flags, name))
+        return results
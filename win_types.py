@@ -3,7 +3,7 @@ from ctypes import c_bool, c_char_p, c_longlong, c_ulong, c_ulonglong, c_void_p,
 
 
 # Constants
-INVALID_HANDLE = ctypes.c_void_p(-1)
+INVALID_HANDLE = ctypes.c_void_p(-1).value    # As returned by functions with restype c_void_p
  
 # IOCTLs - see WinIoCtl.h
 # (DEVTYPE << 16 | ACCESS << 14 | FUNC << 2 | METHOD)
@@ -13,11 +13,18 @@ FSCTL_IS_VOLUME_MOUNTED              = 0x00090028   # func 10, method 0
 FSCTL_GET_VOLUME_BITMAP              = 0x0009006f   # func 27, method 3
 FSCTL_GET_RETRIEVAL_POINTERS         = 0x00090073   # func 28, method 3
 FSCTL_MOVE_FILE                      = 0x00090074   # func 29, method 0
+FSCTL_ENUM_USN_DATA                  = 0x000900b3   # func 44, method 3
+FSCTL_READ_USN_JOURNAL               = 0x000900bb   # func 46, method 3
+FSCTL_QUERY_USN_JOURNAL              = 0x000900f4   # func 61, method 0
 FSCTL_LOOKUP_STREAM_FROM_CLUSTER     = 0x000901fc   # func 127, method 0
 FSCTL_GET_RETRIEVAL_POINTER_BASE     = 0x00090234   # func 141, method 0
 FSCTL_QUERY_FILE_SYSTEM_RECOGNITION  = 0x0009024c   # func 147, method 0
 
 IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS = 0x00560000   # func 0, method 0
+IOCTL_VOLUME_LOGICAL_TO_PHYSICAL     = 0x00560020   # func 8, method 0
+IOCTL_VOLUME_PHYSICAL_TO_LOGICAL     = 0x00560024   # func 9, method 0
+
+IOCTL_DISK_GET_DRIVE_GEOMETRY        = 0x00070000   # func 0, method 0
 
 
 # Structures
@@ -33,7 +40,34 @@ class VOLUME_DISK_EXTENTS(ctypes.Structure):
         ('NumberOfDiskExtents', ctypes.c_ulong),
         ('Extents', DISK_EXTENT * 1),
         # Call to IOCTL_VOLUME_GET_VOLUME_DISK_EXTENTS will
-        # fail with ERROR_MORE_DATA if more than one extent exists
+        # fail with ERROR_MORE_DATA if more than one extent exists;
+        # NumberOfDiskExtents then says how many to make room for
+    ]
+
+class VOLUME_LOGICAL_OFFSET(ctypes.Structure):
+    _fields_ = [
+        ('LogicalOffset', ctypes.c_longlong),
+    ]
+
+class VOLUME_PHYSICAL_OFFSET(ctypes.Structure):
+    _fields_ = [
+        ('DiskNumber', ctypes.c_ulong),
+        ('Offset', ctypes.c_longlong),
+    ]
+
+class VOLUME_PHYSICAL_OFFSETS(ctypes.Structure):
+    _fields_ = [
+        ('NumberOfPhysicalOffsets', ctypes.c_ulong),
+        ('PhysicalOffset', VOLUME_PHYSICAL_OFFSET * 4),    # More than one for mirrors
+    ]
+
+class DISK_GEOMETRY(ctypes.Structure):
+    _fields_ = [
+        ('Cylinders', ctypes.c_longlong),
+        ('MediaType', ctypes.c_ulong),
+        ('TracksPerCylinder', ctypes.c_ulong),
+        ('SectorsPerTrack', ctypes.c_ulong),
+        ('BytesPerSector', ctypes.c_ulong),
     ]
 
 class VOLUME_BITMAP_BUFFER(ctypes.Structure):
@@ -72,7 +106,75 @@ class RETRIEVAL_POINTERS_BUFFER(ctypes.Structure):
         ('StartingVcn', ctypes.c_ulonglong),
         ('NextVcn', ctypes.c_ulonglong),
         ('Lcn', ctypes.c_ulonglong),
-        # NextVcn and Lcn repeat for as many entries as ExtentCount
+        # NextVcn and Lcn repeat for as many entries as ExtentCount; see RETRIEVAL_POINTERS_EXTENT
+    ]
+
+class RETRIEVAL_POINTERS_EXTENT(ctypes.Structure):
+    _fields_ = [
+        ('NextVcn', ctypes.c_longlong),
+        ('Lcn', ctypes.c_longlong),             # -1 for sparse or compressed-away runs
+    ]
+
+class MFT_ENUM_DATA_V0(ctypes.Structure):
+    _fields_ = [
+        ('StartFileReferenceNumber', ctypes.c_ulonglong),
+        ('LowUsn', ctypes.c_longlong),
+        ('HighUsn', ctypes.c_longlong),
+    ]
+
+class USN_RECORD_V2(ctypes.Structure):
+    _fields_ = [
+        ('RecordLength', ctypes.c_ulong),
+        ('MajorVersion', ctypes.c_ushort),
+        ('MinorVersion', ctypes.c_ushort),
+        ('FileReferenceNumber', ctypes.c_ulonglong),
+        ('ParentFileReferenceNumber', ctypes.c_ulonglong),
+        ('Usn', ctypes.c_longlong),
+        ('TimeStamp', ctypes.c_longlong),
+        ('Reason', ctypes.c_ulong),
+        ('SourceInfo', ctypes.c_ulong),
+        ('SecurityId', ctypes.c_ulong),
+        ('FileAttributes', ctypes.c_ulong),
+        ('FileNameLength', ctypes.c_ushort),    # In bytes, not null-terminated
+        ('FileNameOffset', ctypes.c_ushort),
+    ]
+
+class READ_USN_JOURNAL_DATA_V0(ctypes.Structure):
+    _fields_ = [
+        ('StartUsn', ctypes.c_longlong),
+        ('ReasonMask', ctypes.c_ulong),
+        ('ReturnOnlyOnClose', ctypes.c_ulong),
+        ('Timeout', ctypes.c_ulonglong),
+        ('BytesToWaitFor', ctypes.c_ulonglong), # 0 returns at once, even with no records
+        ('UsnJournalID', ctypes.c_ulonglong),
+    ]
+
+class USN_JOURNAL_DATA_V0(ctypes.Structure):
+    _fields_ = [
+        ('UsnJournalID', ctypes.c_ulonglong),   # Changes whenever the journal is recreated
+        ('FirstUsn', ctypes.c_longlong),
+        ('NextUsn', ctypes.c_longlong),
+        ('LowestValidUsn', ctypes.c_longlong),
+        ('MaxUsn', ctypes.c_longlong),
+        ('MaximumSize', ctypes.c_ulonglong),
+        ('AllocationDelta', ctypes.c_ulonglong),
+    ]
+
+class FILE_ID_DESCRIPTOR(ctypes.Structure):
+    _fields_ = [
+        ('dwSize', ctypes.c_ulong),
+        ('Type', ctypes.c_int),                 # 0 = FileIdType
+        ('FileId', ctypes.c_longlong),
+        ('Padding', ctypes.c_ubyte * 8),        # Rest of the union with ObjectId / ExtendedFileId
+    ]
+
+class OVERLAPPED(ctypes.Structure):
+    _fields_ = [
+        ('Internal', ctypes.c_void_p),          # ULONG_PTR - status code
+        ('InternalHigh', ctypes.c_void_p),      # ULONG_PTR - bytes transferred
+        ('Offset', ctypes.c_ulong),
+        ('OffsetHigh', ctypes.c_ulong),
+        ('hEvent', ctypes.c_void_p),
     ]
 
 class MOVE_FILE_DATA(ctypes.Structure):
@@ -84,59 +186,110 @@ class MOVE_FILE_DATA(ctypes.Structure):
     ]
 
     
-# Function arg/return types
-ctypes.windll.kernel32.CreateFileW.restype = ctypes.c_void_p    # HANDLE
-ctypes.windll.kernel32.CreateFileW.argtypes = [
-    c_wchar_p,  # lpFileName
-    c_ulong,    # dwDesiredAccess
-    c_ulong,    # dwShareMode
-    c_void_p,   # lpSecurityAttributes
-    c_ulong,    # dwCreationDisposition
-    c_ulong,    # dwFlagsAndAttributes
-    c_void_p,   # hTemplateFile
-]
-ctypes.windll.kernel32.SetFilePointerEx.restype = ctypes.c_bool
-ctypes.windll.kernel32.SetFilePointerEx.argtypes = [
-    c_void_p,               # HANDLE hFile
-    c_longlong,             # liDistanceToMove
-    POINTER(c_longlong),    # *QWORD lpNewFilePointer
-    c_ulong,                # dwMoveMethod
-]
-ctypes.windll.kernel32.WriteFile.restype = ctypes.c_bool
-ctypes.windll.kernel32.WriteFile.argtypes = [
-    c_void_p,           # HANDLE hFile
-    c_char_p,           # lpBuffer
-    c_ulong,            # nNumberOfBytesToWrite
-    POINTER(c_ulong),   # lpNumberOfBytesWritten
-    c_void_p,           # lpOverlapped
-]
-ctypes.windll.kernel32.DeviceIoControl.restype = ctypes.c_bool
-ctypes.windll.kernel32.DeviceIoControl.argtypes = [
-    c_void_p,   # hDevice
-    c_ulong,    # dwIoControlCode
-    c_void_p,   # lpInBuffer
-    c_ulong,    # nInBufferSize
-    c_void_p,   # lpOutBuffer
-    c_ulong,    # nOutBufferSize
-    POINTER(c_ulong),   # lpBytesReturned
-    c_void_p,   # lpOverlapped
-]
-ctypes.windll.kernel32.GetDiskFreeSpaceW.restype = ctypes.c_bool
-ctypes.windll.kernel32.GetDiskFreeSpaceW.argtypes = [
-    c_wchar_p,          # lpRootPathName
-    POINTER(c_ulong),   # lpSectorsPerCluster
-    POINTER(c_ulong),   # lpBytesPerSector
-    POINTER(c_ulong),   # lpNumberOfFreeClusters
-    POINTER(c_ulong),   # lpTotalNumberOfClusters
-]
-ctypes.windll.kernel32.GetVolumeInformationW.restype = ctypes.c_bool
-ctypes.windll.kernel32.GetVolumeInformationW.argtypes = [
-    c_wchar_p,          # lpRootPathName
-    c_wchar_p,          # lpVolumeNameBuffer
-    c_ulong,            # nVolumeNameSize
-    POINTER(c_ulong),   # LPDWORD lpVolumeSerialNumber
-    POINTER(c_ulong),   # LPDWORD lpMaximumComponentLength
-    POINTER(c_ulong),   # LPDWORD lpFileSystemFlags
-    c_wchar_p,          # lpFileSystemNameBuffer
-    c_ulong,            # nFileSystemNameSize
-]
\ No newline at end of file
+# Function arg/return types (only on Windows, so the structures can be used anywhere)
+if hasattr(ctypes, 'windll'):
+    ctypes.windll.kernel32.CreateFileW.restype = ctypes.c_void_p    # HANDLE
+    ctypes.windll.kernel32.CreateFileW.argtypes = [
+        c_wchar_p,  # lpFileName
+        c_ulong,    # dwDesiredAccess
+        c_ulong,    # dwShareMode
+        c_void_p,   # lpSecurityAttributes
+        c_ulong,    # dwCreationDisposition
+        c_ulong,    # dwFlagsAndAttributes
+        c_void_p,   # hTemplateFile
+    ]
+    ctypes.windll.kernel32.SetFilePointerEx.restype = ctypes.c_bool
+    ctypes.windll.kernel32.SetFilePointerEx.argtypes = [
+        c_void_p,               # HANDLE hFile
+        c_longlong,             # liDistanceToMove
+        POINTER(c_longlong),    # *QWORD lpNewFilePointer
+        c_ulong,                # dwMoveMethod
+    ]
+    ctypes.windll.kernel32.WriteFile.restype = ctypes.c_bool
+    ctypes.windll.kernel32.WriteFile.argtypes = [
+        c_void_p,           # HANDLE hFile
+        c_char_p,           # lpBuffer
+        c_ulong,            # nNumberOfBytesToWrite
+        POINTER(c_ulong),   # lpNumberOfBytesWritten
+        c_void_p,           # lpOverlapped
+    ]
+    ctypes.windll.kernel32.DeviceIoControl.restype = ctypes.c_bool
+    ctypes.windll.kernel32.DeviceIoControl.argtypes = [
+        c_void_p,   # hDevice
+        c_ulong,    # dwIoControlCode
+        c_void_p,   # lpInBuffer
+        c_ulong,    # nInBufferSize
+        c_void_p,   # lpOutBuffer
+        c_ulong,    # nOutBufferSize
+        POINTER(c_ulong),   # lpBytesReturned
+        c_void_p,   # lpOverlapped
+    ]
+    ctypes.windll.kernel32.GetDiskFreeSpaceW.restype = ctypes.c_bool
+    ctypes.windll.kernel32.GetDiskFreeSpaceW.argtypes = [
+        c_wchar_p,          # lpRootPathName
+        POINTER(c_ulong),   # lpSectorsPerCluster
+        POINTER(c_ulong),   # lpBytesPerSector
+        POINTER(c_ulong),   # lpNumberOfFreeClusters
+        POINTER(c_ulong),   # lpTotalNumberOfClusters
+    ]
+    ctypes.windll.kernel32.GetVolumeInformationW.restype = ctypes.c_bool
+    ctypes.windll.kernel32.GetVolumeInformationW.argtypes = [
+        c_wchar_p,          # lpRootPathName
+        c_wchar_p,          # lpVolumeNameBuffer
+        c_ulong,            # nVolumeNameSize
+        POINTER(c_ulong),   # LPDWORD lpVolumeSerialNumber
+        POINTER(c_ulong),   # LPDWORD lpMaximumComponentLength
+        POINTER(c_ulong),   # LPDWORD lpFileSystemFlags
+        c_wchar_p,          # lpFileSystemNameBuffer
+        c_ulong,            # nFileSystemNameSize
+    ]
+    ctypes.windll.kernel32.CreateEventW.restype = ctypes.c_void_p   # HANDLE
+    ctypes.windll.kernel32.CreateEventW.argtypes = [
+        c_void_p,           # lpEventAttributes
+        c_bool,             # bManualReset
+        c_bool,             # bInitialState
+        c_wchar_p,          # lpName
+    ]
+    ctypes.windll.kernel32.GetOverlappedResult.restype = ctypes.c_bool
+    ctypes.windll.kernel32.GetOverlappedResult.argtypes = [
+        c_void_p,           # HANDLE hFile
+        c_void_p,           # LPOVERLAPPED lpOverlapped
+        POINTER(c_ulong),   # lpNumberOfBytesTransferred
+        c_bool,             # bWait
+    ]
+    ctypes.windll.kernel32.CancelIoEx.restype = ctypes.c_bool
+    ctypes.windll.kernel32.CancelIoEx.argtypes = [
+        c_void_p,           # HANDLE hFile
+        c_void_p,           # LPOVERLAPPED lpOverlapped
+    ]
+    ctypes.windll.kernel32.FindFirstVolumeW.restype = ctypes.c_void_p   # HANDLE
+    ctypes.windll.kernel32.FindFirstVolumeW.argtypes = [
+        c_wchar_p,          # lpszVolumeName
+        c_ulong,            # cchBufferLength
+    ]
+    ctypes.windll.kernel32.FindNextVolumeW.restype = ctypes.c_bool
+    ctypes.windll.kernel32.FindNextVolumeW.argtypes = [
+        c_void_p,           # hFindVolume
+        c_wchar_p,          # lpszVolumeName
+        c_ulong,            # cchBufferLength
+    ]
+    ctypes.windll.kernel32.FindVolumeClose.restype = ctypes.c_bool
+    ctypes.windll.kernel32.FindVolumeClose.argtypes = [
+        c_void_p,           # hFindVolume
+    ]
+    ctypes.windll.kernel32.GetVolumePathNamesForVolumeNameW.restype = ctypes.c_bool
+    ctypes.windll.kernel32.GetVolumePathNamesForVolumeNameW.argtypes = [
+        c_wchar_p,          # lpszVolumeName
+        c_wchar_p,          # lpszVolumePathNames - list of null-terminated strings
+        c_ulong,            # cchBufferLength
+        POINTER(c_ulong),   # lpcchReturnLength
+    ]
+    ctypes.windll.kernel32.OpenFileById.restype = ctypes.c_void_p   # HANDLE
+    ctypes.windll.kernel32.OpenFileById.argtypes = [
+        c_void_p,           # hVolumeHint
+        c_void_p,           # lpFileId - FILE_ID_DESCRIPTOR
+        c_ulong,            # dwDesiredAccess
+        c_ulong,            # dwShareMode
+        c_void_p,           # lpSecurityAttributes
+        c_ulong,            # dwFlagsAndAttributes
+    ]